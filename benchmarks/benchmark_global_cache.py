@@ -0,0 +1,295 @@
+"""
+Micro benchmarks of the global cache read and write paths.
+
+Run against a scratch redis database (it is flushed), e.g.:
+
+    python -m benchmarks.benchmark_global_cache --db 15
+"""
+import argparse
+from time import perf_counter
+from types import SimpleNamespace
+
+from redis import Redis
+
+from global_cache import utils_codec
+from global_cache import utils_global_cache
+from global_cache import utils_write_behind
+
+
+def create_device():
+    return SimpleNamespace(
+        id='f' * 24, owner_id=5, organization_id=15, label='device_label', name='device_name',
+        description='device description', tags=['a', 'b'], context={'lat': 6.2, 'lng': -75.5},
+        ubi_context={}, state=0, enabled=True, created_at=191919881, last_activity=188826663,
+        variables=[])
+
+
+def create_variable():
+    return SimpleNamespace(
+        id='f' * 24, device_id='f' * 24, label='variable_label', name='variable_name',
+        description='variable description', icon='variable_icon', unit='Meters', type=2, state=1,
+        tags=['a', 'b'], properties={'max': 10, 'min': 7}, derived_expr='',
+        created_at=1921882882, last_activity=363663663,
+        last_value={'value': 21.12, 'context': {'lat': 6.2, 'lng': -75.5}})
+
+
+class BaselineVariable(object):
+    """
+    Variable built as before the declarative schema, the baseline of benchmark_construction:
+    no __slots__, the options are set on every instance and the hash key is formatted on
+    every access.
+    """
+
+    def __init__(self, stored_object=None, deployment=utils_global_cache.default_deployment,
+                 entity='variable', primary_key=None, primary_key_name='id', attributes=None,
+                 attributes_mapper=None, connection=None, codec=None, local_cache=None):
+        self.connection = connection
+        self.codec = {True: utils_global_cache.default_codec, False: codec}.get(codec is None)
+        self.local_cache = local_cache
+        self.deployment = deployment
+        self.stored_object = stored_object
+        self.entity = entity
+        self.primary_key = primary_key
+        self.primary_key_name = primary_key_name
+        self.attributes = {True: utils_global_cache.Variable.attributes, False: attributes}.get(
+            attributes is None)
+        self.attributes_mapper = attributes_mapper
+        self.record = None
+
+    @property
+    def hash_key(self):
+        return u'{0}:{1}:{2}:{3}'.format(
+            self.deployment, self.entity, self.primary_key_name, self.primary_key)
+
+    @property
+    def name(self):
+        return self.record.get('name')
+
+
+def timed(function, iterations):
+    start = perf_counter()
+    for _ in range(iterations):
+        function()
+    return (perf_counter() - start) / iterations
+
+
+def benchmark_attribute_reads(connection, iterations):
+    """
+    Compares reading fields with one HGET per property against a single HMGET.
+    """
+    variable = create_variable()
+    utils_global_cache.Variable(variable, connection=connection).save()
+    print('attribute reads (per entity, {0} iterations)'.format(iterations))
+    for count in (1, 5, 10, 15):
+        names = utils_global_cache.Variable.attributes[:count]
+        entity = utils_global_cache.Variable(primary_key=variable.id, connection=connection)
+
+        def per_property():
+            for name in names:
+                entity.get_attribute(name)
+
+        def batched():
+            entity.get_attributes(names)
+
+        single = timed(per_property, iterations)
+        multiple = timed(batched, iterations)
+        print('  {0:>2} fields: HGET x N {1:8.1f}us  HMGET {2:8.1f}us  saved/field {3:6.1f}us'.format(
+            count, single * 1e6, multiple * 1e6, (single - multiple) * 1e6 / count))
+
+
+def benchmark_bulk_save(connection, iterations):
+    """
+    Compares saving entities and their label index with separate script calls, one
+    script call per entity and Entity.save_many.
+    """
+    device = create_device()
+    variables = []
+    for index in range(iterations):
+        variable = create_variable()
+        variable.id = '{0:024x}'.format(index)
+        variable.label = 'variable_{0}'.format(index)
+        variable.datasource = device
+        variables.append(variable)
+
+    def separately():
+        for variable in variables:
+            entity = utils_global_cache.Variable(variable, connection=connection)
+            entity.save(include_labels=False)
+            for label_entity in entity.label_entities():
+                label_entity.save()
+
+    def one_by_one():
+        for variable in variables:
+            utils_global_cache.Variable(variable, connection=connection).save()
+
+    def bulk():
+        utils_global_cache.Variable.save_many(variables, connection=connection)
+
+    print('bulk save ({0} variables with their label index)'.format(iterations))
+    for name, function in (('save() x 2', separately), ('save()', one_by_one), ('save_many()', bulk)):
+        elapsed = timed(function, 1)
+        print('  {0:<12} {1:8.3f}s  {2:10.0f} entities/s'.format(name, elapsed, iterations / elapsed))
+
+
+def benchmark_codecs(connection, iterations):
+    """
+    Compares the stored size and the encode/decode cost of the attribute codecs.
+    """
+    variable = create_variable()
+    variable.properties = {'points': [{'value': index * 1.5, 'context': {'lat': 6.2, 'lng': -75.5}}
+                                      for index in range(50)]}
+    codecs = [('json', utils_codec.JsonCodec()), ('json+zlib', utils_codec.CompressedCodec())]
+    if utils_codec.msgpack is not None:
+        codecs += [('msgpack', utils_codec.MsgpackCodec()),
+                   ('msgpack+zlib', utils_codec.CompressedCodec(utils_codec.MsgpackCodec()))]
+    print('codecs (one variable, {0} iterations)'.format(iterations))
+    for name, codec in codecs:
+        entity = utils_global_cache.Variable(variable, connection=connection, codec=codec)
+        keys, values = entity.save_arguments()
+        entity.save()
+
+        def encode():
+            entity.save_arguments()
+
+        def decode():
+            for value in values:
+                utils_codec.decode_field(value)
+
+        print('  {0:<13} {1:6d} bytes  encode {2:7.1f}us  decode {3:7.1f}us'.format(
+            name, sum(len(value) for value in values),
+            timed(encode, iterations) * 1e6, timed(decode, iterations) * 1e6))
+
+
+def benchmark_construction(connection, iterations):
+    """
+    Measures the pure python overhead of building entities and reading snapshot attributes,
+    against BaselineVariable (the entity without __slots__, cached hash key and record).
+    """
+    values = {name: name for name in utils_global_cache.Variable.attributes}
+    variable = utils_global_cache.Variable(primary_key='{0:024x}'.format(1), connection=connection)
+    variable.record = utils_global_cache.EntityRecord.create(values)
+    baseline = BaselineVariable(primary_key='{0:024x}'.format(1), connection=connection)
+    baseline.record = dict(values)
+    cases = (
+        ('Variable()', lambda: BaselineVariable(primary_key='{0:024x}'.format(1)),
+         lambda: utils_global_cache.Variable(primary_key='{0:024x}'.format(1))),
+        ('VariableByLabel()', None,
+         lambda: utils_global_cache.VariableByLabel(primary_key='owner:device:variable')),
+        ('hash_key', lambda: baseline.hash_key, lambda: variable.hash_key),
+        ('snapshot attribute', lambda: baseline.name, lambda: variable.name),
+    )
+    print('construction and attribute access ({0} iterations)'.format(iterations))
+    print('  {0:<19} {1:>9} {2:>9}'.format('', 'baseline', 'entity'))
+    for name, before, after in cases:
+        elapsed = '{0:7.2f}us'.format(timed(before, iterations) * 1e6) if before else '-'
+        print('  {0:<19} {1:>9} {2:7.2f}us'.format(name, elapsed, timed(after, iterations) * 1e6))
+
+
+def benchmark_touch(connection, iterations):
+    """
+    Compares updating the hot fields of a variable with save_attribute against
+    Variable.touch and the pipelined Variable.touch_many.
+    """
+    device = create_device()
+    variable = create_variable()
+    variable.device_id = device.id
+    variable.datasource = device
+    entity = utils_global_cache.Variable(variable, connection=connection)
+    entity.save()
+    utils_global_cache.Device(device, connection=connection).save()
+
+    def save_attributes():
+        entity.save_attribute('last_value', {'value': 1.5})
+        entity.save_attribute('last_activity', utils_global_cache.utc_now_milliseconds())
+
+    def touch():
+        entity.touch({'value': 1.5})
+
+    def touch_many():
+        utils_global_cache.Variable.touch_many(
+            [(entity, {'value': 1.5}, None)] * iterations, connection=connection)
+
+    print('hot field updates ({0} iterations)'.format(iterations))
+    for name, function, count in (('save_attribute()', save_attributes, iterations),
+                                  ('touch()', touch, iterations), ('touch_many()', touch_many, 1)):
+        elapsed = timed(function, count) * count
+        print('  {0:<17} {1:10.0f} updates/s'.format(name, iterations / elapsed))
+
+
+def benchmark_delta_save(connection, iterations):
+    """
+    Re-saves unchanged variables with save_many and with save_many_delta.
+    """
+    device = create_device()
+    variables = []
+    for index in range(iterations):
+        variable = create_variable()
+        variable.id = '{0:024x}'.format(index)
+        variable.label = 'variable_{0}'.format(index)
+        variable.datasource = device
+        variables.append(variable)
+    print('re-sync of unchanged entities ({0} variables)'.format(iterations))
+    elapsed = timed(lambda: utils_global_cache.Variable.save_many(variables, connection=connection), 1)
+    print('  {0:<18} {1:8.3f}s'.format('save_many()', elapsed))
+    # stores the fingerprints, the fields written by save_many are saved again
+    utils_global_cache.Variable.save_many_delta(variables, connection=connection)
+    totals = {}
+
+    def delta():
+        totals.update(utils_global_cache.Variable.save_many_delta(variables, connection=connection))
+
+    elapsed = timed(delta, 1)
+    print('  {0:<18} {1:8.3f}s  {2} bytes not sent'.format(
+        'save_many_delta()', elapsed, totals['bytes_saved']))
+
+
+def benchmark_write_behind(connection, iterations):
+    """
+    Compares a burst of save_attribute calls on one variable written through against
+    the same burst coalesced by a WriteBehindBuffer.
+    """
+    variable = create_variable()
+    entity = utils_global_cache.Variable(variable, connection=connection)
+    write_behind = utils_write_behind.WriteBehindBuffer(max_pending=iterations)
+    buffered = utils_global_cache.Variable(variable, connection=connection, write_behind=write_behind)
+
+    def burst(cache):
+        def run():
+            for index in range(iterations):
+                cache.save_attribute('last_value', {'value': index})
+            write_behind.flush()
+        return run
+
+    print('burst of {0} updates of one variable'.format(iterations))
+    for name, cache in (('write through', entity), ('write behind', buffered)):
+        elapsed = timed(burst(cache), 1)
+        print('  {0:<14} {1:8.3f}s  {2:10.0f} updates/s'.format(name, elapsed, iterations / elapsed))
+
+
+benchmarks = [
+    benchmark_construction,
+    benchmark_attribute_reads,
+    benchmark_bulk_save,
+    benchmark_codecs,
+    benchmark_touch,
+    benchmark_delta_save,
+    benchmark_write_behind,
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--iterations', type=int, default=1000)
+    arguments = parser.parse_args()
+    connection = Redis(host=arguments.host, port=arguments.port, db=arguments.db)
+    for benchmark in benchmarks:
+        connection.flushdb()
+        benchmark(connection, arguments.iterations)
+    connection.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Request scoped batching of the entity reads (DataLoader style).
+
+The entities created inside an entity_batch context are collected, the first property
+read of any of them loads all the collected entities together, with one pipelined
+round trip per chunk (HGETALL for the entities, the label script for the label
+entities), every later property read of those entities is answered from memory:
+
+    with entity_batch(connection):
+        variables = [Variable(primary_key=pk, connection=connection) for pk in ids]
+        data = [{'name': variable.name, 'unit': variable.unit} for variable in variables]
+
+turns the 2 * N reads of the loop into one round trip. Entities created after a batch
+was resolved are collected by the next one. Collected entities that are never read are
+loaded anyway. The entities built to be saved (from a stored object) and the ones the
+package builds internally (batched=False) are not collected.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from global_cache.utils_global_cache import (
+    EntityRecord, batch_state, decode_attributes, default_chunk_size, iterate_chunks, list_to_dict,
+    resolve_labels, resolve_labels_pipelined)
+
+
+class EntityBatch(object):
+    """
+    :param connection: connection of the batched reads, the read connection of every
+    entity (see Entity.read_connection) if None.
+    :param chunk_size: entities read per pipeline.
+    """
+
+    def __init__(self, connection=None, chunk_size=default_chunk_size):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.round_trips = 0
+        self.loaded = 0
+
+    def add(self, entity):
+        self.pending.append(entity)
+
+    def resolve(self):
+        """
+        Loads the pending entities, the entities that are not cached are read as usual
+        (read through included).
+        """
+        pending, self.pending = self.pending, []
+        groups = OrderedDict()
+        for entity in pending:
+            entity.batch = None
+            if entity.record is not None or (entity.nested_key is not None and entity.known_absent()):
+                continue
+            connection, read_only = {
+                True: entity.read_connection,
+                False: lambda: (self.connection, False)}.get(self.connection is None)()
+            group = (id(connection), read_only, entity.nested_key, entity.hash_tags)
+            groups.setdefault(group, (connection, []))[1].append(entity)
+        for (_, read_only, nested_key, hash_tags), (connection, entities) in groups.items():
+            for chunk in iterate_chunks(entities, self.chunk_size):
+                values = self.read(connection, read_only, nested_key, hash_tags, [
+                    entity.hash_key for entity in chunk])
+                self.round_trips += 1 + (nested_key is not None and hash_tags)
+                for entity, data in zip(chunk, values):
+                    if not data and nested_key is not None:
+                        entity.absent()
+                    if not data:
+                        continue
+                    data = decode_attributes(data)
+                    entity.record = EntityRecord.create(
+                        {name: getattr(data.get(name), 'get', lambda k: None)('value') for name in data})
+                    self.loaded += 1
+
+    @staticmethod
+    def read(connection, read_only, nested_key, hash_tags, keys):
+        """
+        :return: list with the raw hash (dict) of every key, of the entity it points to for
+        label keys, None or empty for missing entities.
+        """
+        if nested_key is None:
+            pipeline = connection.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hgetall(key)
+            return pipeline.execute()
+        values = {True: lambda: resolve_labels_pipelined(connection, keys, []),
+                  False: lambda: resolve_labels(connection, keys=keys, args=[nested_key],
+                                                read_only=read_only)}.get(hash_tags)()
+        return [data and list_to_dict(data) for data in values]
+
+    def stats(self):
+        return {'pending': len(self.pending), 'round_trips': self.round_trips, 'loaded': self.loaded}
+
+
+@contextmanager
+def entity_batch(connection=None, chunk_size=default_chunk_size):
+    """
+    Collects the entities created by the current thread until the context exits, see
+    EntityBatch. Contexts can be nested, the inner one collects until it exits.
+    :return: the EntityBatch.
+    """
+    batch = EntityBatch(connection, chunk_size)
+    previous = batch_state.batch
+    batch_state.batch = batch
+    try:
+        yield batch
+    finally:
+        batch_state.batch = previous
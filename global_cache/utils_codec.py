@@ -0,0 +1,154 @@
+"""
+Encoding of the attribute values stored in the global cache hashes.
+
+Every field of an entity hash stores a value together with the timestamp of its
+last update. Two layouts exist:
+
+* version 0, the original JSON envelope: {"value": ..., "updated_timestamp": ...}
+* version 1: <marker byte><updated timestamp digits>:<payload>, the marker byte tells
+  which codec encoded the payload and whether it is zlib compressed.
+
+Readers decode both layouts whatever the codec configured for writing, so codecs
+can be switched without migrating the stored data.
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# marker flag set on payloads compressed with zlib
+compressed_flag = 0x10
+timestamp_separator = b':'
+
+
+def decode_binary_string(value):
+    return getattr(value, 'decode', lambda c: value)('utf-8')
+
+
+def encode_binary_string(value):
+    return getattr(value, 'encode', lambda c: value)('utf-8')
+
+
+class Codec(object):
+    """
+    Base codec, marker identifies the payloads written by the codec, script_readable tells
+    if the scripts can decode its fields (see touch_variable_script).
+    """
+    marker = None
+    script_readable = False
+
+    def encode_value(self, value):
+        raise NotImplementedError('This method is not implemented')
+
+    def decode_value(self, payload):
+        raise NotImplementedError('This method is not implemented')
+
+    def encode(self, value, timestamp):
+        return self.encode_payload(self.marker, self.encode_value(value), timestamp)
+
+    @staticmethod
+    def encode_payload(marker, payload, timestamp):
+        timestamp = b'' if timestamp is None else encode_binary_string(u'{0}'.format(timestamp))
+        return bytes(bytearray([marker])) + timestamp + timestamp_separator + payload
+
+
+class JsonCodec(Codec):
+    """
+    Writes the original JSON envelope, readable by every version of this package.
+    """
+    marker = 0x01
+    script_readable = True
+
+    def encode_value(self, value):
+        return encode_binary_string(json.dumps(value, separators=(',', ':')))
+
+    def decode_value(self, payload):
+        return json.loads(decode_binary_string(payload))
+
+    def encode(self, value, timestamp):
+        return json.dumps({
+            'value': value,
+            'updated_timestamp': timestamp
+        })
+
+
+class MsgpackCodec(Codec):
+    """
+    Compact binary codec, requires the msgpack package.
+    """
+    marker = 0x02
+    script_readable = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('The msgpack package is required by MsgpackCodec')
+
+    def encode_value(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode_value(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CompressedCodec(Codec):
+    """
+    Wraps a codec compressing with zlib the payloads bigger than threshold bytes,
+    smaller values are written by the wrapped codec unchanged.
+
+    encode_value, decode_value and marker are the ones of the wrapped codec (uncompressed
+    payloads), the compression flag is part of the marker byte written by encode, so
+    compressed payloads are decompressed by decode_field. The scripts can't decompress them,
+    the codec is not script_readable.
+    """
+
+    def __init__(self, codec=None, threshold=1024, level=6):
+        self.codec = JsonCodec() if codec is None else codec
+        self.threshold = threshold
+        self.level = level
+
+    @property
+    def marker(self):
+        return self.codec.marker
+
+    def encode_value(self, value):
+        return self.codec.encode_value(value)
+
+    def decode_value(self, payload):
+        return self.codec.decode_value(payload)
+
+    def encode(self, value, timestamp):
+        payload = self.codec.encode_value(value)
+        if len(payload) < self.threshold:
+            return self.codec.encode(value, timestamp)
+        return self.encode_payload(self.codec.marker | compressed_flag,
+                                   zlib.compress(payload, self.level), timestamp)
+
+
+codecs = {JsonCodec.marker: JsonCodec()}
+if msgpack is not None:
+    codecs[MsgpackCodec.marker] = MsgpackCodec()
+default_codec = codecs.get(JsonCodec.marker)
+
+
+def decode_field(value):
+    """
+    Decodes a stored field written by any codec.
+    :return: dict with the keys value and updated_timestamp, None if value can't be decoded.
+    """
+    try:
+        if value[:1] in (b'{', u'{', b'"', u'"'):
+            result = json.loads(decode_binary_string(value))
+            # fields written by the former save_attribute were JSON encoded twice
+            result = json.loads(result) if isinstance(result, str) else result
+            return {'value': result.get('value'), 'updated_timestamp': result.get('updated_timestamp')}
+        marker = bytearray(value[:1])[0]
+        header, payload = value[1:].split(timestamp_separator, 1)
+        codec = codecs[marker & ~compressed_flag]
+        payload = zlib.decompress(payload) if marker & compressed_flag else payload
+        return {'value': codec.decode_value(payload),
+                'updated_timestamp': int(header) if header else None}
+    except (TypeError, ValueError, AttributeError, KeyError, IndexError, zlib.error):
+        return None
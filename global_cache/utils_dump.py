@@ -0,0 +1,178 @@
+"""
+Dump of the keys of a deployment (entity hashes, label indexes and their companion
+sets and hashes) to a local file, and bulk restore of that file, used to warm up an
+empty redis (failover, new region) without replaying every save.
+
+File layout: the magic header followed by chunks, every chunk is
+<payload length uint32><crc32 of the payload uint32><payload>, the payload being the
+zlib compressed records of up to chunk_size keys. A record is
+<type byte><key><pttl int64><item count uint32><items>, every string (key, field,
+value, member) is written as <length uint32><bytes>. The records don't depend on
+the redis version, unlike the DUMP/RESTORE serialization.
+"""
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from global_cache.utils_global_cache import (
+    decode_binary_string, default_chunk_size, default_deployment, escape_pattern, iterate_chunks)
+
+magic = b'GCDUMP\x00\x01'
+hash_type = 1
+set_type = 2
+key_types = {'hash': hash_type, 'set': set_type}
+chunk_header = struct.Struct('>II')
+record_header = struct.Struct('>BqI')
+length_header = struct.Struct('>I')
+
+
+def pack_string(value):
+    value = getattr(value, 'encode', lambda c: value)('utf-8')
+    return length_header.pack(len(value)) + value
+
+
+def unpack_string(payload, offset):
+    length, = length_header.unpack_from(payload, offset)
+    offset += length_header.size
+    return payload[offset:offset + length], offset + length
+
+
+def pack_record(key_type, key, pttl, items):
+    parts = [record_header.pack(key_type, pttl, len(items)), pack_string(key)]
+    parts += [pack_string(item) for item in items]
+    return b''.join(parts)
+
+
+def unpack_records(payload):
+    """
+    :return: generator of (type, key, pttl, items) records, items is the flat list of
+    field/value pairs of hashes, of members of sets.
+    """
+    offset = 0
+    while offset < len(payload):
+        key_type, pttl, count = record_header.unpack_from(payload, offset)
+        key, offset = unpack_string(payload, offset + record_header.size)
+        items = []
+        for _ in range(count):
+            item, offset = unpack_string(payload, offset)
+            items.append(item)
+        yield key_type, key, pttl, items
+
+
+def read_records(connection, keys):
+    """
+    Reads the keys with two pipelined round trips (type and ttl, then the values).
+    :return: list of packed records, keys of other types or deleted meanwhile are skipped.
+    """
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.type(key)
+        pipeline.pttl(key)
+    types = pipeline.execute()
+    found = []
+    pipeline = connection.pipeline(transaction=False)
+    for key, key_type, pttl in zip(keys, types[::2], types[1::2]):
+        key_type = key_types.get(decode_binary_string(key_type))
+        if key_type is None:
+            continue
+        found.append((key_type, key, pttl))
+        {hash_type: pipeline.hgetall, set_type: pipeline.smembers}.get(key_type)(key)
+    records = []
+    for (key_type, key, pttl), value in zip(found, pipeline.execute()):
+        if not value:
+            continue
+        items = {True: lambda: [item for pair in value.items() for item in pair],
+                 False: lambda: sorted(value)}.get(key_type == hash_type)()
+        records.append(pack_record(key_type, key, pttl, items))
+    return records
+
+
+def dump(connection, path, deployment=default_deployment, chunk_size=default_chunk_size,
+         scan_count=None, compression_level=6):
+    """
+    Writes every hash and set of the deployment to path.
+    :param chunk_size: keys per chunk, also the keys read per pipeline.
+    :return: dict with the number of keys, chunks and bytes written.
+    """
+    stats = {'keys': 0, 'chunks': 0, 'bytes': len(magic)}
+    keys = connection.scan_iter(match=u'{0}:*'.format(escape_pattern(deployment)), count=scan_count)
+    with open(path, 'wb') as dump_file:
+        dump_file.write(magic)
+        for chunk in iterate_chunks(keys, chunk_size):
+            records = read_records(connection, chunk)
+            if not records:
+                continue
+            payload = zlib.compress(b''.join(records), compression_level)
+            dump_file.write(chunk_header.pack(len(payload), zlib.crc32(payload)))
+            dump_file.write(payload)
+            stats['keys'] += len(records)
+            stats['chunks'] += 1
+            stats['bytes'] += chunk_header.size + len(payload)
+    return stats
+
+
+def read_chunks(path):
+    """
+    :return: generator of the decompressed chunk payloads of a dump file.
+    :raise ValueError: if the file is not a dump or a chunk is corrupted.
+    """
+    with open(path, 'rb') as dump_file:
+        if dump_file.read(len(magic)) != magic:
+            raise ValueError('{0} is not a global cache dump'.format(path))
+        index = 0
+        while True:
+            header = dump_file.read(chunk_header.size)
+            if not header:
+                return
+            if len(header) != chunk_header.size:
+                raise ValueError('Truncated chunk {0} in {1}'.format(index, path))
+            length, checksum = chunk_header.unpack(header)
+            payload = dump_file.read(length)
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                raise ValueError('Corrupted chunk {0} in {1}'.format(index, path))
+            yield zlib.decompress(payload)
+            index += 1
+
+
+def restore_chunk(connection, payload, replace=True):
+    """
+    Writes the records of a chunk with one pipelined round trip.
+    :return: number of keys restored.
+    """
+    pipeline = connection.pipeline(transaction=False)
+    count = 0
+    for key_type, key, pttl, items in unpack_records(payload):
+        if replace:
+            pipeline.delete(key)
+        if key_type == hash_type:
+            pipeline.hset(key, mapping=dict(zip(items[::2], items[1::2])))
+        else:
+            pipeline.sadd(key, *items)
+        if pttl > 0:
+            pipeline.pexpire(key, pttl)
+        count += 1
+    pipeline.execute()
+    return count
+
+
+def restore(connection, path, workers=4, replace=True):
+    """
+    Loads a dump file, the chunks are checked and written by a pool of threads,
+    at most 2 * workers chunks are kept in memory.
+    :param replace: delete the existing keys before writing them, otherwise hash fields
+    and set members are merged into them.
+    :return: dict with the number of keys and chunks restored.
+    :raise ValueError: if the file is corrupted, chunks read before are restored.
+    """
+    stats = {'keys': 0, 'chunks': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for payload in read_chunks(path):
+            pending.append(executor.submit(restore_chunk, connection, payload, replace))
+            if len(pending) >= 2 * workers:
+                stats['keys'] += pending.pop(0).result()
+                stats['chunks'] += 1
+        for future in pending:
+            stats['keys'] += future.result()
+            stats['chunks'] += 1
+    return stats
@@ -1,10 +1,20 @@
+import hashlib
+import re
+import threading
 import redis
-import json
 from time import time
 
+from global_cache.utils_codec import (
+    default_codec, decode_binary_string, decode_field, encode_binary_string)
+from global_cache.utils_local_cache import missing
+
 
 not_implemented_error = 'This method is not implemented'
 default_deployment = 'INDUSTRIAL'
+# number of commands sent per pipeline by the bulk operations
+default_chunk_size = 500
+# script commands of the read write and of the read only (replicas) script calls
+script_commands = {False: ('EVALSHA', 'EVAL'), True: ('EVALSHA_RO', 'EVAL_RO')}
 get_all_attributes_by_label_script = """
 local id = redis.call('hget', KEYS[1], KEYS[2]);
 return redis.call('hgetall', tostring(id))
@@ -13,55 +23,761 @@ get_attribute_by_label_script = """
 local id = redis.call('hget', KEYS[1], KEYS[2]);
 return redis.call('hget', tostring(id), KEYS[3])
 """
-save_json_document_to_hash_set_script = """
+get_id_and_attribute_by_label_script = """
+local id = redis.call('hget', KEYS[1], KEYS[2]);
+if not id then
+    return {false, false}
+end
+return {id, redis.call('hget', id, KEYS[3])}
+"""
+get_attributes_by_label_script = """
+local id = redis.call('hget', KEYS[1], KEYS[2]);
+if not id then
+    return {}
+end
+return redis.call('hmget', id, unpack(ARGV))
+"""
+resolve_labels_script = """
+local nestedKey = ARGV[1];
+local result = {};
+for i = 1, #KEYS, 1 do
+    local id = redis.call('hget', KEYS[i], nestedKey);
+    local values = false;
+    if id and redis.call('exists', id) == 1 then
+        if #ARGV > 1 then
+            values = redis.call('hmget', id, unpack(ARGV, 2));
+        else
+            values = redis.call('hgetall', id);
+        end
+    end
+    result[i] = values;
+end
+return result
+"""
+# Last writer wins: a field is not overwritten by a value older (updated_timestamp)
+# than the stored one, values without timestamp are always written.
+guarded_set_function = """
+local function fieldTimestamp(raw)
+    if not raw then
+        return nil;
+    end
+    local first = string.sub(raw, 1, 1);
+    if first == '{' or first == '"' then
+        local timestamp = string.match(raw, '"updated_timestamp":%s*(%d+)}$');
+        if timestamp then
+            return tonumber(timestamp);
+        end
+        local ok, document = pcall(cjson.decode, raw);
+        if ok and type(document) == 'string' then
+            ok, document = pcall(cjson.decode, document);
+        end
+        if ok and type(document) == 'table' then
+            return tonumber(document['updated_timestamp']);
+        end
+        return nil;
+    end
+    return tonumber(string.match(raw, '^.(%d+):'));
+end
+local function guardedSet(key, field, value)
+    local timestamp = fieldTimestamp(value);
+    if timestamp then
+        local current = fieldTimestamp(redis.call('hget', key, field));
+        if current and timestamp < current then
+            return 0;
+        end
+    end
+    redis.call('hset', key, field, value);
+    return 1;
+end
+"""
+
+# KEYS[1] hash key followed by the field names, ARGV their values followed by the optional
+# ttl of the hash in milliseconds ('0' or absent to keep it without expiration).
+# Returns for every field 1 if it was written, 0 if a newer value was stored.
+save_json_document_to_hash_set_script = guarded_set_function + """
 local keysCount = #KEYS;
 local hashKey = KEYS[1];
+local applied = {};
 for i = 2, keysCount, 1 do
-    redis.call('hset', hashKey, KEYS[i], ARGV[i - 1])
+    applied[i - 1] = guardedSet(hashKey, KEYS[i], ARGV[i - 1]);
+end
+local ttl = tonumber(ARGV[keysCount]);
+if ttl and ttl > 0 then
+    redis.call('pexpire', hashKey, ttl);
+end
+return applied;
+"""
+
+# saveFields writes the field/value pairs of key starting at ARGV[position] (number of
+# fields followed by the pairs), saveLabels writes KEYS[firstLabel..] and replaces the
+# set of label keys pointing to the entity (indexKey): the labels of the previous save
+# that are not saved anymore (renamed) are deleted if they still point to the entity.
+# readIndexes reads the secondary indexes section: ARGV[argPosition] member (primary key),
+# the number of indexed attributes followed by attribute/number of index keys pairs, the
+# index keys being KEYS[keyPosition..]. saveIndexes adds the member to the index sets of
+# the written attributes and removes it from the sets of their previous values, kept as
+# JSON lists in the entries hash. expireKeys sets the ttl (milliseconds, nil or 0 for no
+# expiration) of the keys of an entity and extends the ttl of its index sets, shared with
+# other entities, to at least ttl.
+save_labels_function = guarded_set_function + """
+local appliedFields = {};
+local function setField(key, field, value)
+    local applied = guardedSet(key, field, value);
+    appliedFields[key] = appliedFields[key] or {};
+    appliedFields[key][field] = applied;
+    return applied;
+end
+local function saveFields(key, position)
+    local count = tonumber(ARGV[position]);
+    local applied = {};
+    for i = 1, count, 1 do
+        applied[i] = setField(key, ARGV[position + 2 * i - 1], ARGV[position + 2 * i]);
+    end
+    return applied, position + 2 * count + 1;
+end
+local function readIndexes(keyPosition, argPosition)
+    local indexes = {member = ARGV[argPosition], attributes = {}};
+    local count = tonumber(ARGV[argPosition + 1]);
+    argPosition = argPosition + 2;
+    for i = 1, count, 1 do
+        local keysCount = tonumber(ARGV[argPosition + 1]);
+        local keys = {};
+        for j = keyPosition, keyPosition + keysCount - 1, 1 do
+            keys[#keys + 1] = KEYS[j];
+        end
+        indexes.attributes[i] = {ARGV[argPosition], keys};
+        keyPosition = keyPosition + keysCount;
+        argPosition = argPosition + 2;
+    end
+    return indexes, keyPosition, argPosition;
+end
+local function saveIndexes(hashKey, entriesKey, indexes)
+    for _, index in ipairs(indexes.attributes) do
+        local attribute, keys = index[1], index[2];
+        if (appliedFields[hashKey] or {})[attribute] ~= 0 then
+            local saved = {};
+            for _, key in ipairs(keys) do
+                saved[key] = true;
+                redis.call('sadd', key, indexes.member);
+            end
+            local previous = redis.call('hget', entriesKey, attribute);
+            if previous then
+                for _, key in ipairs(cjson.decode(previous)) do
+                    if not saved[key] then
+                        redis.call('srem', key, indexes.member);
+                    end
+                end
+            end
+            redis.call('hset', entriesKey, attribute, #keys > 0 and cjson.encode(keys) or '[]');
+        end
+    end
+end
+local function expireKeys(ttl, keys, indexes)
+    if not ttl or ttl <= 0 then
+        return;
+    end
+    for _, key in ipairs(keys) do
+        redis.call('pexpire', key, ttl);
+    end
+    for _, index in ipairs(indexes.attributes) do
+        for _, key in ipairs(index[2]) do
+            if redis.call('pttl', key) < ttl then
+                redis.call('pexpire', key, ttl);
+            end
+        end
+    end
+end
+local function saveLabels(indexKey, firstLabel, nestedKey, position)
+    if firstLabel > #KEYS then
+        return {}, position;
+    end
+    local labels = {};
+    for i = firstLabel, #KEYS, 1 do
+        local applied;
+        applied, position = saveFields(KEYS[i], position);
+        labels[KEYS[i]] = true;
+    end
+    local pointer = redis.call('hget', KEYS[firstLabel], nestedKey);
+    local moved = {};
+    for _, label in ipairs(redis.call('smembers', indexKey)) do
+        if not labels[label] and redis.call('hget', label, nestedKey) == pointer then
+            redis.call('del', label);
+            table.insert(moved, label);
+        end
+    end
+    redis.call('del', indexKey);
+    redis.call('sadd', indexKey, unpack(KEYS, firstLabel));
+    return moved, position;
+end
+"""
+
+# Saves an entity, its secondary indexes and its label index entries atomically.
+# KEYS[1] hash key of the entity, KEYS[2] set of the label keys pointing to it,
+# KEYS[3] index entries hash of the entity, KEYS[4..] index keys followed by the label keys.
+# ARGV[1] field of the label hashes holding the entity pointer, the indexes section (see
+# readIndexes), then for the entity and every label key: the number of fields followed
+# by the field/value pairs, last the optional ttl of the keys (see expireKeys).
+# Returns the applied flags of the entity fields (see save_json_document_to_hash_set_script)
+# and the deleted label keys.
+save_entity_with_labels_script = save_labels_function + """
+local indexes, firstLabel, position = readIndexes(4, 2);
+local applied, moved;
+applied, position = saveFields(KEYS[1], position);
+saveIndexes(KEYS[1], KEYS[3], indexes);
+moved, position = saveLabels(KEYS[2], firstLabel, ARGV[1], position);
+expireKeys(tonumber(ARGV[position]), {KEYS[1], KEYS[2], KEYS[3], unpack(KEYS, firstLabel)}, indexes);
+return {applied, moved};
+"""
+
+# Fingerprint of a field: fingerprint of its value and updated_timestamp of the stored
+# field, any write of the field changes its timestamp and invalidates the fingerprint.
+# KEYS[1] hash key of the entity, KEYS[2] fingerprints hash, KEYS[3] set of the label keys
+# pointing to the entity, KEYS[4..] label keys. ARGV field/fingerprint pairs.
+# Returns the changed flag of every field and 1 if the label index must be saved.
+changed_attributes_script = guarded_set_function + """
+local changed = {};
+for i = 1, #ARGV, 2 do
+    local current = ARGV[i + 1] .. ':' .. tostring(fieldTimestamp(redis.call('hget', KEYS[1], ARGV[i])));
+    changed[#changed + 1] = (redis.call('hget', KEYS[2], ARGV[i]) == current) and 0 or 1;
+end
+local labelsChanged = 0;
+for i = 4, #KEYS, 1 do
+    if redis.call('sismember', KEYS[3], KEYS[i]) == 0 or redis.call('exists', KEYS[i]) == 0 then
+        labelsChanged = 1;
+    end
+end
+return {changed, labelsChanged};
+"""
+
+# Writes the changed fields of an entity and their fingerprints (see
+# changed_attributes_script), their secondary indexes and optionally its label index entries.
+# KEYS[1] hash key of the entity, KEYS[2] fingerprints hash, KEYS[3] set of the label keys
+# pointing to the entity, KEYS[4] index entries hash, KEYS[5..] index keys followed by the
+# label keys. ARGV[1] field of the label hashes holding the entity pointer, the indexes
+# section, the number of fields followed by field/value/fingerprint triples, then the
+# fields of every label key and the ttl as save_entity_with_labels_script.
+# Returns the applied flags of the fields and the deleted label keys.
+save_changed_attributes_script = save_labels_function + """
+local indexes, firstLabel, position = readIndexes(5, 2);
+local count = tonumber(ARGV[position]);
+local applied = {};
+for i = 0, count - 1, 1 do
+    local field, value = ARGV[position + 1 + 3 * i], ARGV[position + 2 + 3 * i];
+    applied[i + 1] = setField(KEYS[1], field, value);
+    if applied[i + 1] == 1 then
+        local fingerprint = ARGV[position + 3 + 3 * i];
+        redis.call('hset', KEYS[2], field, fingerprint .. ':' .. tostring(fieldTimestamp(value)));
+    end
+end
+saveIndexes(KEYS[1], KEYS[4], indexes);
+local moved;
+moved, position = saveLabels(KEYS[3], firstLabel, ARGV[1], position + 1 + 3 * count);
+expireKeys(tonumber(ARGV[position]), {KEYS[1], KEYS[2], KEYS[3], KEYS[4], unpack(KEYS, firstLabel)},
+           indexes);
+return {applied, moved};
+"""
+
+# Deletes an entity and the label keys still pointing to it, and removes it from its
+# secondary indexes.
+# KEYS[1] hash key, KEYS[2] fingerprints hash, KEYS[3] index entries hash, KEYS[4] set of the
+# label keys pointing to it, ARGV[1] member, ARGV[2] field of the label hashes holding the
+# entity pointer. Returns the number of deleted keys of the entity and the deleted label keys.
+delete_entity_script = """
+for _, entries in ipairs(redis.call('hvals', KEYS[3])) do
+    for _, key in ipairs(cjson.decode(entries)) do
+        redis.call('srem', key, ARGV[1]);
+    end
+end
+local labels = {};
+for _, label in ipairs(redis.call('smembers', KEYS[4])) do
+    if redis.call('hget', label, ARGV[2]) == KEYS[1] then
+        redis.call('del', label);
+        table.insert(labels, label);
+    end
+end
+return {redis.call('del', KEYS[1], KEYS[2], KEYS[3], KEYS[4]), labels};
+"""
+
+# Removes from the index sets the members whose hash doesn't exist anymore (expired with
+# their retention), the index sets are shared and only extended by the saves.
+# KEYS index keys, ARGV member/hash key pairs. Returns the removed members.
+prune_index_script = """
+local removed = {};
+for i = 1, #ARGV, 2 do
+    if redis.call('exists', ARGV[i + 1]) == 0 then
+        for _, key in ipairs(KEYS) do
+            redis.call('srem', key, ARGV[i]);
+        end
+        table.insert(removed, ARGV[i]);
+    end
+end
+return removed;
+"""
+
+# Updates the hot fields of a variable and the last_activity of its device.
+# KEYS[1] variable key, KEYS[2] device key, '' or absent to use the device_id of the variable.
+# ARGV[1] 'label' if KEYS[1] is a variable label key, ARGV[2] 'label' if KEYS[2] is a
+# device label key, 'defer' to return the device key without updating it (redis cluster,
+# the device is in another slot), 'skip' to leave the device to the caller, ARGV[3] encoded
+# last_value, ARGV[4] encoded last_activity,
+# ARGV[5] prefix of the device keys, ARGV[6] '1' if the device ids are hash tagged,
+# ARGV[7] and ARGV[8] optional ttl in milliseconds of the variable and of the device keys,
+# extended by the touch (the label keys given included).
+# Older values than the stored ones are skipped, see guarded_set_function.
+# The device_id of the variable is only decoded (KEYS[2] absent) for the JSON and msgpack
+# layouts, the script fails with an error for the others (compressed payloads): pass the
+# device key, see Codec.script_readable.
+# Returns nothing if the variable is not cached, else the variable key, the device key (false
+# if the device is not cached) and the applied flags of last_value, last_activity and of the
+# device last_activity (only the first two with 'defer').
+touch_variable_script = guarded_set_function + """
+local function resolve(key, keyType)
+    if keyType == 'label' then
+        return redis.call('hget', key, 'id');
+    end
+    return key;
+end
+local function extend(ttl, key, label)
+    ttl = tonumber(ttl);
+    if ttl and ttl > 0 then
+        redis.call('pexpire', key, ttl);
+        if label then
+            redis.call('pexpire', label, ttl);
+        end
+    end
+end
+-- value of a field, false for the layouts that can't be decoded here
+local function decodeValue(raw)
+    local first = string.byte(raw, 1);
+    if first == 123 or first == 34 then
+        local document = cjson.decode(raw);
+        if type(document) == 'string' then
+            document = cjson.decode(document);
+        end
+        return document['value'];
+    end
+    local payload = string.match(raw, '^.%d*:(.*)$');
+    if first == 2 and payload and cmsgpack then
+        return cmsgpack.unpack(payload);
+    end
+    return false;
+end
+local variableKey = resolve(KEYS[1], ARGV[1]);
+if not variableKey or redis.call('exists', variableKey) == 0 then
+    return {};
+end
+-- the device is resolved first, a device_id that can't be decoded fails before any write
+local deviceKey = false;
+if KEYS[2] and KEYS[2] ~= '' then
+    deviceKey = resolve(KEYS[2], ARGV[2]);
+end
+local rawDeviceId = not deviceKey and ARGV[2] ~= 'skip' and redis.call('hget', variableKey, 'device_id');
+if rawDeviceId then
+    local deviceId = decodeValue(rawDeviceId);
+    if deviceId == false then
+        return redis.error_reply('touch: the device_id of ' .. variableKey .. ' can not be decoded');
+    end
+    if type(deviceId) == 'string' or type(deviceId) == 'number' then
+        deviceId = tostring(deviceId);
+        if ARGV[6] == '1' then
+            deviceId = '{' .. deviceId .. '}';
+        end
+        deviceKey = ARGV[5] .. deviceId;
+    end
+end
+local applied = {guardedSet(variableKey, 'last_value', ARGV[3]),
+                 guardedSet(variableKey, 'last_activity', ARGV[4])};
+extend(ARGV[7], variableKey, ARGV[1] == 'label' and KEYS[1]);
+if deviceKey and ARGV[2] == 'defer' then
+    return {variableKey, deviceKey, applied};
+end
+if not deviceKey or redis.call('exists', deviceKey) == 0 then
+    applied[3] = 0;
+    return {variableKey, false, applied};
+end
+applied[3] = guardedSet(deviceKey, 'last_activity', ARGV[4]);
+extend(ARGV[8], deviceKey, ARGV[2] == 'label' and KEYS[2]);
+return {variableKey, deviceKey, applied};
+"""
+
+# Scripts of the entities with hash_tags, they only access the keys of one cluster slot.
+# KEYS[1] hash key, ARGV[1] '1' to only write existing hashes, ARGV[2] ttl of the hash in
+# milliseconds ('0' for no expiration), then field/value pairs.
+# Returns the applied flags of the fields, see guarded_set_function.
+save_fields_script = guarded_set_function + """
+local applied = {};
+if ARGV[1] == '1' and redis.call('exists', KEYS[1]) == 0 then
+    return applied;
+end
+for i = 3, #ARGV, 2 do
+    applied[#applied + 1] = guardedSet(KEYS[1], ARGV[i], ARGV[i + 1]);
+end
+local ttl = tonumber(ARGV[2]);
+if ttl and ttl > 0 then
+    redis.call('pexpire', KEYS[1], ttl);
+end
+return applied;
+"""
+# KEYS[1] set of the label keys pointing to an entity, ARGV[1] its ttl in milliseconds ('0'
+# for no expiration), ARGV[2..] the label keys saved now.
+# Returns the label keys of the set that are not saved anymore (renamed).
+update_label_index_script = """
+local saved = {};
+for i = 2, #ARGV, 1 do
+    saved[ARGV[i]] = true;
+end
+local removed = {};
+for _, label in ipairs(redis.call('smembers', KEYS[1])) do
+    if not saved[label] then
+        table.insert(removed, label);
+    end
+end
+redis.call('del', KEYS[1]);
+if #ARGV > 1 then
+    redis.call('sadd', KEYS[1], unpack(ARGV, 2));
+    if tonumber(ARGV[1]) > 0 then
+        redis.call('pexpire', KEYS[1], ARGV[1]);
+    end
+end
+return removed;
+"""
+# Deletes the label KEYS[1] if its ARGV[1] field still points to ARGV[2].
+delete_label_script = """
+if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('del', KEYS[1]);
+end
+return 0;
+"""
+# Sets the ttl ARGV[2] (milliseconds) of the label KEYS[1] and of the entity its ARGV[1]
+# field points to.
+extend_label_ttl_script = """
+local id = redis.call('hget', KEYS[1], ARGV[1]);
+redis.call('pexpire', KEYS[1], ARGV[2]);
+if id then
+    redis.call('pexpire', id, ARGV[2]);
 end
+return id;
 """
 
 
-def decode_binary_string(value):
-    return getattr(value, 'decode', lambda c: value)('utf-8')
+def decode_attribute_value(value):
+    return getattr(decode_field(value), 'get', lambda k: None)('value')
+
+
+def list_to_dict(values):
+    return dict(zip(values[::2], values[1::2]))
+
+
+def decode_attributes(result):
+    new_result = {}
+    for key in result:
+        value = decode_field(result.get(key))
+        if value is not None:
+            new_result[decode_binary_string(key)] = value
+    return new_result
 
 
 def utc_now_milliseconds():
     return int(time() * 1000)
 
 
+def is_no_script_error(error):
+    return isinstance(error, getattr(redis.exceptions, 'NoScriptError', ())) or \
+        error.args[0].startswith("NOSCRIPT")
+
+
 def script_load(script):
     sha = [None]
 
-    def call(conn, keys=None, args=None, force_eval=False):
+    def load(conn):
+        if not sha[0]:
+            sha[0] = conn.execute_command(
+                "SCRIPT", "LOAD", script, parse="LOAD")
+        return sha[0]
+
+    def call(conn, keys=None, args=None, force_eval=False, read_only=False):
         keys = {True: lambda: keys, False: lambda: []}.get(keys is not None)()
         args = {True: lambda: args, False: lambda: []}.get(args is not None)()
+        evalsha, eval_command = script_commands.get(read_only)
         if not force_eval:
-            if not sha[0]:
-                sha[0] = conn.execute_command(
-                    "SCRIPT", "LOAD", script, parse="LOAD")
+            load(conn)
             try:
-                return conn.execute_command("EVALSHA", sha[0], len(keys), *(keys + args))
+                return conn.execute_command(evalsha, sha[0], len(keys), *(keys + args))
             except redis.exceptions.ResponseError as msg:
-                if not msg.args[0].startswith("NOSCRIPT"):
+                if not is_no_script_error(msg):
                     raise
         return conn.execute_command(
-            "EVAL", script, len(keys), *(keys + args))
+            eval_command, script, len(keys), *(keys + args))
 
+    call.load = load
     return call
 
 
+def escape_pattern(value):
+    """
+    Escapes the glob special characters of value for SCAN MATCH.
+    """
+    return re.sub(r'([*?\[\]\\])', r'\\\1', value)
+
+
+def iterate_chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def execute_scripts(conn, calls, chunk_size=default_chunk_size):
+    """
+    Runs many script calls using one pipeline (one round trip) per chunk of calls.
+    :param conn: redis connection.
+    :param calls: iterable of (script, keys, args) tuples, script as returned by script_load.
+    It is consumed lazily so only one chunk is kept in memory.
+    :param chunk_size: maximum number of calls sent per pipeline.
+    :return: list with the result of every call.
+    """
+    results = []
+    for chunk in iterate_chunks(calls, chunk_size):
+        pipeline = conn.pipeline(transaction=False)
+        for script, keys, args in chunk:
+            pipeline.execute_command("EVALSHA", script.load(conn), len(keys), *(keys + args))
+        for (script, keys, args), result in zip(chunk, pipeline.execute(raise_on_error=False)):
+            if isinstance(result, redis.exceptions.ResponseError) and is_no_script_error(result):
+                result = script(conn, keys=keys, args=args, force_eval=True)
+            elif isinstance(result, Exception):
+                raise result
+            results.append(result)
+    return results
+
+
 get_all_attributes_nested_script = script_load(get_all_attributes_by_label_script)
 get_attribute_nested_script = script_load(get_attribute_by_label_script)
 save_json_document_to_hash_set = script_load(save_json_document_to_hash_set_script)
+resolve_labels = script_load(resolve_labels_script)
+get_attributes_nested_script = script_load(get_attributes_by_label_script)
+get_id_and_attribute_nested_script = script_load(get_id_and_attribute_by_label_script)
+save_entity_with_labels = script_load(save_entity_with_labels_script)
+changed_attributes = script_load(changed_attributes_script)
+save_changed_attributes = script_load(save_changed_attributes_script)
+delete_entity = script_load(delete_entity_script)
+prune_index = script_load(prune_index_script)
+save_fields = script_load(save_fields_script)
+update_label_index = script_load(update_label_index_script)
+delete_label = script_load(delete_label_script)
+touch_variable = script_load(touch_variable_script)
+extend_label_ttl = script_load(extend_label_ttl_script)
+
+
+def field_arguments(names, values):
+    """
+    :return: [number of fields, name1, value1, name2, value2...] as read by the save scripts.
+    """
+    arguments = [len(names)]
+    for name, value in zip(names, values):
+        arguments += [name, value]
+    return arguments
+
+
+class EntityRecord(object):
+    """
+    In memory copy of the attribute values of an entity. The values are kept in a tuple,
+    their positions in a mapping shared (created once) by the records of the same set of
+    attribute names: the names are hash fields, any string works.
+    """
+    __slots__ = ('positions', 'values', 'complete')
+    record_positions = {}
+
+    def __init__(self, positions, values, complete):
+        self.positions = positions
+        self.values = values
+        self.complete = complete
+
+    @classmethod
+    def create(cls, values, complete=True):
+        """
+        :param values: dict attribute name -> decoded value.
+        :param complete: True if values holds every attribute stored for the entity,
+        so attributes absent from the record are known to be absent from the cache.
+        """
+        names = tuple(sorted(values))
+        positions = cls.record_positions.get(names)
+        if positions is None:
+            positions = {name: index for index, name in enumerate(names)}
+            cls.record_positions[names] = positions
+        return cls(positions, tuple(values[name] for name in names), complete)
+
+    def get(self, attribute_name, default=missing):
+        position = self.positions.get(attribute_name)
+        if position is None:
+            return None if self.complete else default
+        return self.values[position]
+
+    def as_dict(self):
+        return {name: self.values[position] for name, position in self.positions.items()}
+
+
+# options of an entity declared as class attributes of the Entity subclasses, every
+# instance can override them with the constructor arguments
+entity_options = ('deployment', 'entity', 'primary_key_name', 'primary_key', 'stored_object',
+                  'attributes', 'attributes_mapper', 'connection', 'codec', 'local_cache', 'hash_tags',
+                  'replicas', 'write_behind', 'retention')
+key_prefixes = {}
+# entity name -> Entity class, filled by EntityMeta, see Entity.iter_all
+entity_classes = {}
+
+
+class BatchState(threading.local):
+    # batch collecting the entities created by the thread, see utils_batch.entity_batch
+    batch = None
+
+
+batch_state = BatchState()
+
+
+def key_prefix(deployment, entity, primary_key_name):
+    prefix = key_prefixes.get((deployment, entity, primary_key_name))
+    if prefix is None:
+        prefix = u'{0}:{1}:{2}:'.format(deployment, entity, primary_key_name)
+        key_prefixes[(deployment, entity, primary_key_name)] = prefix
+    return prefix
+
+
+def hash_tag(primary_key):
+    return u'{{{0}}}'.format(primary_key)
+
+
+def untag(primary_key):
+    """
+    :return: the primary key of a hash tagged primary key, e.g. '{abc}' -> 'abc'.
+    """
+    if primary_key[:1] == '{' and primary_key[-1:] == '}':
+        return primary_key[1:-1]
+    return primary_key
+
+
+def index_key(deployment, entity, attribute_name, value):
+    """
+    :return: key of the set of the primary keys of the entities whose attribute holds value.
+    """
+    return u'{0}{1}:{2}'.format(key_prefix(deployment, entity, 'index'), attribute_name, value)
+
+
+def is_combined_result(result):
+    """
+    :return: True for results of the scripts saving labels or indexes ({applied, moved}),
+    False for the applied flags of save_json_document_to_hash_set_script.
+    """
+    return bool(result) and isinstance(result[0], list)
+
+
+def retention_ttl(retention):
+    """
+    :param retention: utils_retention.RetentionPolicy, None for keys without expiration.
+    :return: ttl argument of the save scripts, in milliseconds, '0' for no expiration.
+    """
+    return '0' if retention is None else '{0}'.format(retention.ttl_ms)
+
+
+def route_read(replicas, connection, keys=(), follows_pointers=False):
+    """
+    :param replicas: utils_replicas.ReplicaSet of connection, None to read from connection.
+    :param follows_pointers: the read follows the label -> entity pointers of keys, see
+    ReplicaSet.connection_for.
+    :return: (connection of a read of keys, True if its scripts must run read only).
+    """
+    if replicas is None:
+        return connection, False
+    read_connection, replica = replicas.connection_for(connection, keys, follows_pointers)
+    return read_connection, replica and replicas.read_only_scripts
 
 
-class Entity(object):
+def attribute_accessor(name, nested_key=None):
+    """
+    :return: property reading the attribute name of the cached entity, label entities
+    read the attribute of the entity their nested_key points to.
+    """
+    if nested_key is None:
+        return property(lambda self: self.get_attribute(name))
+    return property(lambda self: self.get_attribute_nested(nested_key, name))
+
+
+def default_mapper(stored_object, value):
+    return value
+
+
+def attribute_mappers(attributes, attributes_mapper):
+    """
+    :return: list of (attribute name, mapper(stored object, value) of the saved value).
+    """
+    return [(attribute_name, (attributes_mapper or {}).get(attribute_name, default_mapper))
+            for attribute_name in attributes or []]
+
+
+def entity_option(name):
+    def get_option(cls):
+        return cls.defaults.get(name)
+
+    def set_option(cls, value):
+        cls.defaults[name] = value
+        if name in ('attributes', 'attributes_mapper'):
+            cls.mappers = attribute_mappers(cls.attributes, cls.attributes_mapper)
+        # subclasses inherit the option unless they declare it
+        for subclass in cls.__subclasses__():
+            if name not in subclass.declared_options:
+                setattr(subclass, name, value)
+
+    return property(get_option, set_option)
+
+
+class EntityMeta(type):
+    """
+    Builds the schema of the Entity classes once per class:
+    the entity options declared as class attributes are moved to cls.defaults (they are
+    instance slots, the class attribute stays readable through the metaclass), an accessor
+    is generated for every attribute (every attribute of nested_entity for label entities)
+    the class doesn't define and the instances get __slots__.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        defaults = {}
+        for base in reversed(bases):
+            defaults.update(getattr(base, 'defaults', {}))
+        declared = [option for option in entity_options if option in namespace]
+        for option in declared:
+            defaults[option] = namespace.pop(option)
+        namespace['defaults'] = defaults
+        namespace['declared_options'] = tuple(declared)
+        namespace.setdefault('__slots__', ())
+        cls = super(EntityMeta, mcs).__new__(mcs, name, bases, namespace)
+        cls.mappers = attribute_mappers(cls.attributes, cls.attributes_mapper)
+        accessors = {True: lambda: cls.attributes if cls.nested_key is None else [],
+                     False: lambda: cls.nested_entity.attributes}.get(cls.nested_entity is None)()
+        for attribute_name in accessors or []:
+            if not any(attribute_name in klass.__dict__ for klass in cls.__mro__):
+                setattr(cls, attribute_name, attribute_accessor(attribute_name, cls.nested_key))
+        if cls.entity is not None and cls.nested_key is None:
+            entity_classes.setdefault(cls.entity, cls)
+        return cls
+
+
+for entity_option_name in entity_options:
+    setattr(EntityMeta, entity_option_name, entity_option(entity_option_name))
+
+
+class Entity(object, metaclass=EntityMeta):
     """
     This class represents an entity with attributes that will be stored to cache
     as a hash set in redis. Every attribute will be stored as key/value element
     of a hash set.
+
+    Subclasses declare their schema as class attributes (entity, primary_key_name,
+    attributes, attributes_mapper...), see EntityMeta.
     """
+    __slots__ = entity_options + ('record', 'cached_hash_key', 'batch')
     # deployment used to identify different subsystems
     deployment = default_deployment
     # The name of the entity
@@ -72,111 +788,647 @@ class Entity(object):
     attributes = []
     attributes_mapper = {}
     connection = None
+    # encodes the attribute values, see utils_codec
+    codec = default_codec
+    # optional utils_local_cache.LocalCache in front of the field reads
+    local_cache = None
+    # redis cluster key scheme: the primary key is written as hash tag so every key of
+    # an entity maps to the same slot, the scripts only access the keys of one slot
+    # and the label reads take two steps, see utils_migration to convert the keys.
+    hash_tags = False
+    # optional utils_replicas.ReplicaSet of connection serving the reads
+    replicas = None
+    # optional utils_write_behind.WriteBehindBuffer coalescing the saves before writing them
+    write_behind = None
+    # optional utils_retention.RetentionPolicy, ttl of the keys written by the save scripts
+    retention = None
+    # hash field holding the key of the entity a label entity points to
+    nested_key = None
+    # class of the entity a label entity points to
+    nested_entity = None
+    # loads the entities missing from the cache, see utils_loader.ReadThroughLoader
+    loader = None
+    # attributes with a secondary index (set of primary keys per value, per item of list
+    # values) maintained by the save scripts, see find_by_index
+    indexes = []
+    # hot attributes -> attribute holding the datapoint timestamp they are saved with, the
+    # clock of touch, instead of the time of the save (see attribute_timestamp)
+    timestamp_attributes = {}
 
     def __init__(self, stored_object=None, deployment=default_deployment,
                  entity=None, primary_key=None, primary_key_name=None, attributes=None,
-                 attributes_mapper=None, connection=None):
-        self.connection = {True: self.connection, False: connection}.get(connection is None)
+                 attributes_mapper=None, connection=None, snapshot=False, codec=None,
+                 local_cache=None, hash_tags=None, replicas=None, write_behind=None, retention=None,
+                 batched=True):
+        """
+        :param batched: False for the entities built internally (keys, hydrated entities),
+        never collected by an entity_batch. The entities built from a stored_object to be
+        saved are not either, the label entities are (their key comes from the object).
+        """
+        defaults = self.defaults
+        self.retention = defaults['retention'] if retention is None else retention
+        self.write_behind = defaults['write_behind'] if write_behind is None else write_behind
+        self.hash_tags = defaults['hash_tags'] if hash_tags is None else hash_tags
+        self.replicas = defaults['replicas'] if replicas is None else replicas
+        self.connection = defaults['connection'] if connection is None else connection
+        self.codec = defaults['codec'] if codec is None else codec
+        self.local_cache = defaults['local_cache'] if local_cache is None else local_cache
         self.deployment = deployment
         self.stored_object = stored_object
-        self.entity = entity
+        self.entity = defaults['entity'] if entity is None else entity
         self.primary_key = primary_key
-        self.primary_key_name = primary_key_name
-        self.attributes = attributes
-        self.attributes_mapper = attributes_mapper
+        self.primary_key_name = (defaults['primary_key_name'] if primary_key_name is None
+                                 else primary_key_name)
+        self.attributes = defaults['attributes'] if attributes is None else attributes
+        self.attributes_mapper = (defaults['attributes_mapper'] if attributes_mapper is None
+                                  else attributes_mapper)
+        self.record = None
+        self.cached_hash_key = None
+        # pending batch load of the entity, see get_record_value
+        collected = batched and (stored_object is None or self.nested_key is not None)
+        self.batch = batch_state.batch if collected else None
+        if self.batch is not None:
+            self.batch.add(self)
+        if snapshot:
+            self.load()
 
     @property
     def hash_key(self):
         """
+        Key of the hash set of the entity, computed again only when one of the attributes it
+        is built from changes.
+        :return: {deployment}:{entity}:{primary_key_name}:{primary_key}
+        """
+        key = (self.deployment, self.entity, self.primary_key_name, self.primary_key, self.hash_tags)
+        cached = self.cached_hash_key
+        if cached is None or cached[0] != key:
+            cached = self.cached_hash_key = (key, self.entity_key(self.primary_key_name))
+        return cached[1]
+
+    def entity_key(self, key_type):
+        """
+        :return: {deployment}:{entity}:{key_type}:{primary_key}, the primary key being a hash
+        tag if hash_tags.
+        """
+        primary_key = hash_tag(self.primary_key) if self.hash_tags else self.primary_key
+        return u'{0}{1}'.format(key_prefix(self.deployment, self.entity, key_type), primary_key)
+
+    def read_connection(self, *keys):
+        """
+        :param keys: keys read, the hash of the entity by default.
+        :return: (connection, read_only) of a read, see route_read.
+        """
+        return route_read(self.replicas, self.connection, keys or (self.hash_key,))
+
+    def nested_read_connection(self):
+        """
+        :return: (connection, read_only) of a read following the nested_key pointer, the key
+        of the entity it points to is only known by redis so the read goes to the primary
+        while any key written by this process is pinned, see route_read.
+        """
+        return route_read(self.replicas, self.connection, (self.hash_key,), follows_pointers=True)
 
-        :return:
+    def ttl_argument(self):
         """
-        return u'{0}:{1}:{2}:{3}'.format(
-            self.deployment, self.entity, self.primary_key_name, self.primary_key)
+        :return: ttl in milliseconds of the keys written by the save scripts, '0' to keep
+        them without expiration, see retention.
+        """
+        return retention_ttl(self.retention)
+
+    def extend_ttl(self, target_key=None):
+        """
+        Sliding expiration: extends the ttl of the hash read (and of the entity a label points
+        to) at most once per refresh_interval of the retention, on the primary connection.
+        :param target_key: key of the entity a label points to, if it was read.
+        """
+        retention = self.retention
+        if retention is None or not retention.due(self.hash_key):
+            return
+        ttl = retention.ttl_ms
+        if self.nested_key is not None and target_key is None and not self.hash_tags:
+            extend_label_ttl(self.connection, keys=[self.hash_key], args=[self.nested_key, ttl])
+            return
+        if self.nested_key is not None and target_key is None:
+            target_key = self.connection.hget(self.hash_key, self.nested_key)
+        pipeline = self.connection.pipeline(transaction=False)
+        for key in [self.hash_key] + [target_key] * bool(target_key):
+            pipeline.pexpire(key, ttl)
+        pipeline.execute()
+
+    @property
+    def label_index_key(self):
+        """
+        Key of the set of label keys pointing to the entity, used to delete the
+        label index entries of renamed entities.
+        """
+        return self.entity_key('label_index')
+
+    @property
+    def index_entries_key(self):
+        """
+        Key of the hash of the index keys holding the entity, per indexed attribute.
+        """
+        return self.entity_key('index_entries')
+
+    def index_keys(self, attribute_name, value):
+        """
+        :return: keys of the index sets of an attribute value, one per item of list values.
+        """
+        items = value if isinstance(value, (list, tuple, set)) else [value]
+        keys = [index_key(self.deployment, self.entity, attribute_name, item)
+                for item in items if item is not None]
+        return sorted(set(keys))
+
+    def index_arguments(self, names, values):
+        """
+        :param values: encoded values of the attributes names.
+        :return: index keys and args of the indexes section of the save scripts (see
+        readIndexes) for the indexed attributes among names. Entities with hash_tags are
+        not indexed, the index sets being in other cluster slots.
+        """
+        keys, args = [], [self.primary_key, 0]
+        if self.hash_tags or not self.indexes:
+            return keys, args
+        for attribute_name in set(names).intersection(self.indexes):
+            attribute_keys = self.index_keys(attribute_name, decode_attribute_value(
+                values[names.index(attribute_name)]))
+            keys += attribute_keys
+            args += [attribute_name, len(attribute_keys)]
+            args[1] += 1
+        return keys, args
+
+    @property
+    def fingerprint_key(self):
+        """
+        Key of the hash of the fingerprints of the attributes written by save_delta.
+        """
+        return self.entity_key('fingerprint')
 
     def get_attribute(self, attribute_name):
-        result = self.get_value(attribute_name)
-        try:
-            result = json.loads(decode_binary_string(result))
-            value = result.get('value')
-        except (TypeError, ValueError, AttributeError):
-            value = None
-        return value
+        value = self.get_record_value(attribute_name)
+        if value is not missing:
+            return value
+        value = self.get_value(attribute_name)
+        if value is None and self.read_through():
+            return self.get_record_value(attribute_name)
+        return decode_attribute_value(value)
+
+    def get_attribute_with_age(self, attribute_name, max_age_ms=None, stale_while_revalidate=True):
+        """
+        Reads an attribute from redis (not from the record) with the age of its value,
+        computed from its updated_timestamp.
+        :param max_age_ms: values older than max_age_ms are refreshed with the loader of the
+        entity class: in background, returning the stale value, if stale_while_revalidate,
+        before returning otherwise.
+        :return: (value, age in milliseconds), age is None for missing values and values
+        stored without timestamp.
+        """
+        field = decode_field(self.get_value(attribute_name))
+        if field is None and self.read_through():
+            return self.get_record_value(attribute_name), 0
+        return fresh_value(self, field, attribute_name, max_age_ms, stale_while_revalidate)
+
+    @classmethod
+    def from_hash_key(cls, hash_key, **kwargs):
+        """
+        :return: entity of the hash key {deployment}:{entity}:{primary_key_name}:{primary_key}.
+        """
+        deployment, entity, primary_key_name, primary_key = decode_binary_string(hash_key).split(':', 3)
+        kwargs.setdefault('hash_tags', untag(primary_key) != primary_key)
+        return cls(primary_key=untag(primary_key), deployment=deployment, entity=entity,
+                   primary_key_name=primary_key_name, **kwargs)
+
+    def read_through(self):
+        """
+        Loads the entity with the loader of its class if its hash doesn't exist, the
+        loaded values are kept in the record of the entity.
+        :return: True if the entity was loaded.
+        """
+        if self.loader is None or self.nested_key is not None or self.connection.exists(self.hash_key):
+            return False
+        values = self.loader.load(self)
+        if values is not None:
+            self.record = EntityRecord.create(values)
+            return True
+        # loaded by another process
+        return bool(self.connection.exists(self.hash_key)) and self.load() is self
+
+    def get_record_value(self, attribute_name):
+        if self.record is None and self.batch is not None:
+            self.batch.resolve()
+        if self.record is None:
+            return missing
+        return self.record.get(attribute_name)
+
+    def get_attributes(self, attribute_names):
+        """
+        Reads several attributes with a single HMGET round trip.
+        :param attribute_names: names of the attributes to read.
+        :return: dict mapping every requested name to its value (None if missing).
+        """
+        attribute_names = list(attribute_names)
+        values = self.get_values(attribute_names)
+        if all(value is None for value in values) and self.read_through():
+            return {attribute_name: self.get_record_value(attribute_name)
+                    for attribute_name in attribute_names}
+        return {attribute_name: decode_attribute_value(value)
+                for attribute_name, value in zip(attribute_names, values)}
+
+    def fetch(self, *attribute_names):
+        """
+        Prefetches the given attributes in one round trip (HMGET, or the projection script
+        for entities with a nested_key), later property reads of those attributes are
+        answered from memory. Without attribute names the whole entity is loaded.
+        :return: self, so it can be chained: Variable(...).fetch('name', 'unit').name
+        """
+        if not attribute_names:
+            return self.load()
+        values = {} if self.record is None else self.record.as_dict()
+        values.update({True: lambda: self.get_attributes(attribute_names),
+                       False: lambda: self.get_attributes_nested(self.nested_key, attribute_names)}.get(
+            self.nested_key is None)())
+        complete = self.record is not None and self.record.complete
+        self.record = EntityRecord.create(values, complete=complete)
+        return self
+
+    def load(self):
+        """
+        Reads the whole entity in one round trip (HGETALL, or the label script for
+        entities with a nested_key) and keeps the decoded values in memory, every
+        property read is answered from that snapshot until refresh() is called.
+        :return: self
+        """
+        data = {True: self.get_all_attributes,
+                False: lambda: self.get_all_attributes_nested(self.nested_key)}.get(
+            self.nested_key is None)()
+        if not data and self.read_through():
+            return self
+        self.record = EntityRecord.create(
+            {key: getattr(data.get(key), 'get', lambda k: None)('value') for key in data})
+        return self
+
+    @classmethod
+    def iter_all(cls, entity=None, deployment=default_deployment, connection=None,
+                 batch_size=default_chunk_size, scan_count=None):
+        """
+        Iterates over every cached entity of a type with SCAN, reading the entities with one
+        pipelined round trip (HGETALL) per batch of keys, so only one batch is kept in memory.
+        Like SCAN, an entity may be returned more than once and entities written during the
+        iteration may be missed.
+        :param entity: entity name, e.g. Entity.iter_all(entity='variable'), the entity of
+        the class by default, e.g. Variable.iter_all().
+        :param scan_count: COUNT hint of the SCAN calls.
+        :return: generator of entities of the registered class of the entity name, loaded
+        as by load(). Without connection the keys are read from the replicas of the class.
+        """
+        entity = cls.entity if entity is None else entity
+        entity_class = {True: cls, False: entity_classes.get(entity, cls)}.get(entity == cls.entity)
+        primary_key_name = entity_class.primary_key_name or 'id'
+        replicas = {True: entity_class.replicas, False: None}.get(connection is None)
+        connection = {True: entity_class.connection, False: connection}.get(connection is None)
+        read_connection = route_read(replicas, connection)[0]
+        prefix = key_prefix(deployment, entity, primary_key_name)
+        keys = read_connection.scan_iter(match=escape_pattern(prefix) + '*', count=scan_count)
+        for chunk in iterate_chunks(keys, batch_size):
+            pipeline = read_connection.pipeline(transaction=False)
+            for key in chunk:
+                pipeline.hgetall(key)
+            for key, data in zip(chunk, pipeline.execute()):
+                if not data:
+                    continue
+                item = entity_class.from_hash_key(key, connection=connection, replicas=replicas,
+                                                  batched=False)
+                data = decode_attributes(data)
+                item.record = EntityRecord.create(
+                    {name: getattr(data.get(name), 'get', lambda k: None)('value') for name in data})
+                yield item
+
+    def refresh(self):
+        return self.load()
 
     def encode_attribute(self, value, timestamp=None):
         timestamp = {True: utc_now_milliseconds,
                      False: lambda: timestamp}.get(timestamp is None)()
-        return json.dumps({
-            'value': value,
-            'updated_timestamp': timestamp
-        })
+        return self.codec.encode(value, timestamp)
 
-    def save_attribute(self, attribute_name, value):
-        return self.set_value(attribute_name, json.dumps(self.encode_attribute(value)))
+    def save_attribute(self, attribute_name, value, timestamp=None):
+        """
+        :param timestamp: milliseconds timestamp of the value, now if None.
+        :return: False if a newer value of the attribute is stored, it is kept. True with
+        write_behind, the value is only buffered.
+        """
+        if self.write_behind is not None:
+            timestamp = utc_now_milliseconds() if timestamp is None else timestamp
+            encoded_value = self.encode_attribute(value, timestamp)
+            self.write_behind.add(self, [(attribute_name, encoded_value, timestamp)])
+            return True
+        self.invalidate()
+        # indexed attributes are saved with their secondary indexes, see save_call
+        script, keys, args = self.save_call(
+            arguments=([self.hash_key, attribute_name], [self.encode_attribute(value, timestamp)]))
+        applied = script(self.connection, keys=keys, args=args)
+        self.invalidate()
+        applied = {True: lambda: applied[0], False: lambda: applied}.get(is_combined_result(applied))()
+        return bool(applied[0])
 
     def get_value(self, attribute_name):
-        return self.connection.hget(self.hash_key, attribute_name)
+        self.extend_ttl()
+        if self.local_cache is None:
+            return self.read_connection()[0].hget(self.hash_key, attribute_name)
+        hash_key = self.hash_key
+        version = self.local_cache.version
+        value = self.local_cache.get(hash_key, attribute_name)
+        if value is missing:
+            value = self.read_connection()[0].hget(hash_key, attribute_name)
+            self.local_cache.set(hash_key, attribute_name, value, self.entity, version)
+        return value
+
+    def get_values(self, attribute_names):
+        attribute_names = list(attribute_names)
+        if not attribute_names:
+            return []
+        self.extend_ttl()
+        if self.local_cache is None:
+            return self.read_connection()[0].hmget(self.hash_key, attribute_names)
+        hash_key = self.hash_key
+        version = self.local_cache.version
+        values = [self.local_cache.get(hash_key, attribute_name) for attribute_name in attribute_names]
+        misses = [attribute_name for attribute_name, value in zip(attribute_names, values)
+                  if value is missing]
+        if misses:
+            fetched = dict(zip(misses, self.read_connection()[0].hmget(hash_key, misses)))
+            for attribute_name in misses:
+                self.local_cache.set(hash_key, attribute_name, fetched.get(attribute_name),
+                                     self.entity, version)
+            values = [fetched.get(attribute_name) if value is missing else value
+                      for attribute_name, value in zip(attribute_names, values)]
+        return values
+
+    def invalidate(self):
+        """
+        Drops the values of this entity kept in memory (snapshot and local cache),
+        called after every write done through the entity, its reads go to the primary
+        for the read your writes window of its replicas.
+        """
+        self.record = None
+        if self.local_cache is not None:
+            self.local_cache.invalidate(self.hash_key)
+        if self.replicas is not None:
+            self.replicas.written(self.hash_key)
 
     def set_value(self, attribute_name, value):
+        self.invalidate()
         return self.connection.hset(self.hash_key, attribute_name, value)
 
     def delete_value(self, attribute_name):
+        self.invalidate()
         return self.connection.hdel(self.hash_key, attribute_name)
 
     def get_all_attributes(self):
-        result = self.connection.hgetall(self.hash_key)
-        new_result = {}
-        for key in result:
-            try:
-                new_result[decode_binary_string(key)] = json.loads(decode_binary_string(result.get(key)))
-            except (ValueError, TypeError, AttributeError):
-                pass
-        return new_result
+        self.extend_ttl()
+        return decode_attributes(self.read_connection()[0].hgetall(self.hash_key))
+
+    @classmethod
+    def get_many(cls, primary_keys, attributes=None, connection=None,
+                 deployment=default_deployment, chunk_size=default_chunk_size):
+        """
+        Reads many entities by primary key using one pipelined round trip per chunk.
+        :param primary_keys: primary keys of the entities to read.
+        :param attributes: names of the attributes to read (HMGET), all of them if None (HGETALL).
+        :return: dict primary key -> decoded attributes, same format as get_all_attributes.
+        Entities that are not cached are reported with a None value. Without connection the
+        entities are read from the replicas of the class, see route_read.
+        """
+        replicas = {True: cls.replicas, False: None}.get(connection is None)
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        attributes = None if attributes is None else list(attributes)
+        result = {}
+        for chunk in iterate_chunks(primary_keys, chunk_size):
+            hash_keys = [cls(primary_key=primary_key, deployment=deployment, batched=False).hash_key
+                         for primary_key in chunk]
+            pipeline = route_read(replicas, connection, hash_keys)[0].pipeline(transaction=False)
+            for hash_key in hash_keys:
+                if attributes is None:
+                    pipeline.hgetall(hash_key)
+                else:
+                    pipeline.exists(hash_key)
+                    pipeline.hmget(hash_key, attributes)
+            values = pipeline.execute()
+            if attributes is not None:
+                values = [dict(zip(attributes, fields)) if exists else {}
+                          for exists, fields in zip(values[::2], values[1::2])]
+            for primary_key, data in zip(chunk, values):
+                result[primary_key] = decode_attributes(data) if data else None
+        return result
+
+    @classmethod
+    def find_by_index(cls, attribute_name, all_of=None, any_of=None, connection=None,
+                      deployment=default_deployment, hydrate=False):
+        """
+        Queries a secondary index (see indexes) with one pipelined round trip.
+        :param all_of: values the attribute must all hold (SINTER).
+        :param any_of: values the attribute must hold at least one of (SUNION).
+        :return: set of the primary keys of the matching entities, list of entities if
+        hydrate, see hydrate.
+        """
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        queries = [(pipeline_command, [index_key(deployment, cls.entity, attribute_name, value)
+                                       for value in values])
+                   for pipeline_command, values in (('sinter', all_of), ('sunion', any_of)) if values]
+        primary_keys = set()
+        if queries:
+            pipeline = connection.pipeline(transaction=False)
+            for pipeline_command, keys in queries:
+                getattr(pipeline, pipeline_command)(keys)
+            primary_keys = set.intersection(*[{decode_binary_string(member) for member in members}
+                                              for members in pipeline.execute()])
+            queried_keys = [key for pipeline_command, keys in queries for key in keys]
+            primary_keys = cls.live_index_members(queried_keys, primary_keys, connection, deployment)
+        if hydrate:
+            return cls.hydrate(sorted(primary_keys), connection=connection, deployment=deployment)
+        return primary_keys
+
+    @classmethod
+    def live_index_members(cls, keys, primary_keys, connection=None, deployment=default_deployment,
+                           chunk_size=default_chunk_size):
+        """
+        Prunes on read the members of the index sets keys whose entity hash expired, see
+        prune_index_script. With hash_tags the hashes are in other cluster slots, they are
+        checked and then removed (not atomic).
+        :return: set of the primary_keys whose entity is cached.
+        """
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        primary_keys = sorted(primary_keys)
+        hash_keys = [cls(primary_key=primary_key, deployment=deployment, batched=False).hash_key
+                     for primary_key in primary_keys]
+        if not cls.hash_tags:
+            calls = [(prune_index, keys, [item for pair in chunk for item in pair])
+                     for chunk in iterate_chunks(zip(primary_keys, hash_keys), chunk_size)]
+            removed = [member for members in execute_scripts(connection, calls, chunk_size)
+                       for member in members]
+            return set(primary_keys) - {decode_binary_string(member) for member in removed}
+        removed = []
+        for chunk in iterate_chunks(zip(primary_keys, hash_keys), chunk_size):
+            pipeline = connection.pipeline(transaction=False)
+            for primary_key, hash_key in chunk:
+                pipeline.exists(hash_key)
+            removed += [primary_key for (primary_key, hash_key), exists in zip(chunk, pipeline.execute())
+                        if not exists]
+        if removed:
+            pipeline = connection.pipeline(transaction=False)
+            for key in keys:
+                pipeline.srem(key, *removed)
+            pipeline.execute()
+        return set(primary_keys) - set(removed)
+
+    @classmethod
+    def find_by_tags(cls, all_of=None, any_of=None, **kwargs):
+        """
+        find_by_index of the tags attribute, e.g. Variable.find_by_tags(all_of=['a'], any_of=['b', 'c']).
+        """
+        return cls.find_by_index('tags', all_of, any_of, **kwargs)
+
+    @classmethod
+    def hydrate(cls, primary_keys, attributes=None, connection=None, deployment=default_deployment,
+                chunk_size=default_chunk_size):
+        """
+        Builds the entities of primary_keys with their values in memory, read with get_many.
+        :return: list of entities, the entities that are not cached are skipped.
+        """
+        data = cls.get_many(primary_keys, attributes, connection, deployment, chunk_size)
+        entities = []
+        for primary_key in primary_keys:
+            values = data.get(primary_key)
+            if values is None:
+                continue
+            entity = cls(primary_key=primary_key, deployment=deployment, connection=connection,
+                         batched=False)
+            entity.record = EntityRecord.create(
+                {name: field.get('value') for name, field in values.items()},
+                complete=attributes is None)
+            entities.append(entity)
+        return entities
 
     def delete(self):
-        return self.connection.delete(self.hash_key)
+        """
+        Deletes the entity, its label index and the label keys still pointing to it (see
+        label_entities), and removes it from its secondary indexes.
+        :return: number of deleted keys of the entity.
+        """
+        self.invalidate()
+        if self.hash_tags:
+            # the label keys are in other cluster slots, they are deleted one by one
+            label_keys = [decode_binary_string(label_key)
+                          for label_key in self.connection.smembers(self.label_index_key)]
+            deleted = execute_scripts(self.connection, [
+                (delete_label, [label_key], [EntityByLabel.nested_key, self.hash_key])
+                for label_key in label_keys])
+            label_keys = [label_key for label_key, flag in zip(label_keys, deleted) if flag]
+            count = self.connection.delete(self.hash_key, self.fingerprint_key, self.label_index_key)
+        else:
+            count, label_keys = delete_entity(
+                self.connection,
+                keys=[self.hash_key, self.fingerprint_key, self.index_entries_key, self.label_index_key],
+                args=[self.primary_key, EntityByLabel.nested_key])
+        for label_key in label_keys:
+            getattr(self.local_cache, 'invalidate', lambda k: None)(decode_binary_string(label_key))
+        return count
 
     def get_all_attributes_nested(self, nested_key):
-        result = get_all_attributes_nested_script(self.connection, keys=[self.hash_key, nested_key])
-        new_result = {}
-        is_key = True
-        current_key = None
-
-        def process_key(k, v):
-            return not is_key, v
-
-        def process_value(k, v):
-            new_result[k] = v
-            return not is_key, k
-
-        decode_functions = {True: process_key, False: process_value}
-        for value in result:
-            value = decode_binary_string(value)
-            is_key, current_key = decode_functions.get(is_key)(current_key, value)
-        result = {}
-        for key in new_result:
-            try:
-                result[key] = json.loads(decode_binary_string(new_result.get(key)))
-            except (ValueError, TypeError, AttributeError):
-                pass
-        return result
+        self.extend_ttl()
+        connection, read_only = self.nested_read_connection()
+        if self.hash_tags:
+            target_key = connection.hget(self.hash_key, nested_key)
+            return decode_attributes(connection.hgetall(target_key) if target_key else {})
+        result = get_all_attributes_nested_script(
+            connection, keys=[self.hash_key, nested_key], read_only=read_only)
+        return decode_attributes(list_to_dict(result))
+
+    def get_id_and_value_nested(self, nested_key, attribute_name):
+        """
+        :return: (hash key the nested_key field points to, value of its attribute) with one
+        script call, or two reads with hash_tags as both keys are in different cluster slots.
+        """
+        self.extend_ttl()
+        connection, read_only = self.nested_read_connection()
+        if not self.hash_tags:
+            return get_id_and_attribute_nested_script(
+                connection, keys=[self.hash_key, nested_key, attribute_name], read_only=read_only)
+        target_key = connection.hget(self.hash_key, nested_key)
+        return target_key, target_key and connection.hget(target_key, attribute_name)
 
     def get_value_nested(self, nested_key, attribute_name):
-        result = get_attribute_nested_script(
-            self.connection, keys=[self.hash_key, nested_key, attribute_name])
-        return result
+        if self.local_cache is None and self.hash_tags:
+            return self.get_id_and_value_nested(nested_key, attribute_name)[1]
+        if self.local_cache is None:
+            self.extend_ttl()
+            connection, read_only = self.nested_read_connection()
+            return get_attribute_nested_script(
+                connection, keys=[self.hash_key, nested_key, attribute_name], read_only=read_only)
+        # the label -> id pointer and the value are cached under their own hash keys
+        # so writes to (or invalidations of) either of them are noticed
+        version = self.local_cache.version
+        target_key = self.local_cache.get(self.hash_key, nested_key)
+        value = missing
+        if target_key is not missing and target_key is not None:
+            value = self.local_cache.get(target_key, attribute_name)
+        if value is missing:
+            target_key, value = self.get_id_and_value_nested(nested_key, attribute_name)
+            target_key = target_key and decode_binary_string(target_key)
+            self.local_cache.set(self.hash_key, nested_key, target_key, self.entity, version)
+            if target_key is not None:
+                self.local_cache.set(target_key, attribute_name, value, self.entity, version)
+        return value
+
+    def get_values_nested(self, nested_key, attribute_names):
+        attribute_names = list(attribute_names)
+        if not attribute_names:
+            return []
+        self.extend_ttl()
+        connection, read_only = self.nested_read_connection()
+        if self.hash_tags:
+            target_key = connection.hget(self.hash_key, nested_key)
+            return connection.hmget(target_key, attribute_names) if target_key else [None] * len(
+                attribute_names)
+        result = get_attributes_nested_script(
+            connection, keys=[self.hash_key, nested_key], args=attribute_names, read_only=read_only)
+        return result or [None] * len(attribute_names)
+
+    def get_attributes_nested(self, nested_key, attribute_names):
+        """
+        Reads several attributes of the entity the nested_key field points to, the label
+        indirection and the HMGET run in one script call and only the requested fields
+        are returned by redis.
+        :return: dict mapping every requested name to its value (None if missing).
+        """
+        attribute_names = list(attribute_names)
+        values = self.get_values_nested(nested_key, attribute_names)
+        return {attribute_name: decode_attribute_value(value)
+                for attribute_name, value in zip(attribute_names, values)}
+
+    def get_attribute_nested_with_age(self, nested_key, attribute_name, max_age_ms=None,
+                                      stale_while_revalidate=True):
+        """
+        get_attribute_with_age of the entity the nested_key field points to, stale values
+        are refreshed with the loader of nested_entity.
+        """
+        target_key, value = self.get_id_and_value_nested(nested_key, attribute_name)
+        target = None
+        if target_key and self.nested_entity is not None:
+            target = self.nested_entity.from_hash_key(
+                target_key, connection=self.connection, codec=self.codec, local_cache=self.local_cache,
+                replicas=self.replicas, batched=False)
+        return fresh_value(target, decode_field(value), attribute_name, max_age_ms,
+                           stale_while_revalidate)
 
     def get_attribute_nested(self, nested_key, attribute_name):
-        result = self.get_value_nested(nested_key, attribute_name)
-        try:
-            result = json.loads(decode_binary_string(result))
-            value = result.get('value')
-        except (TypeError, ValueError, AttributeError):
-            value = None
-        return value
+        value = self.get_record_value(attribute_name)
+        if value is not missing:
+            return value
+        return decode_attribute_value(self.get_value_nested(nested_key, attribute_name))
 
-    def save(self):
-        return self.save_optimized()
+    def save(self, include_labels=True):
+        return self.save_optimized(include_labels)
 
     def simple_save(self):
         def default_map(variable, v):
@@ -188,516 +1440,850 @@ class Entity(object):
             self.save_attribute(attribute_name, value)
         return True
 
-    def save_optimized(self):
-        def default_map(variable, v):
-            return v
-
+    def save_arguments(self, timestamp=None):
+        """
+        Encodes the attributes of the stored object as expected by the save script.
+        :return: keys (hash key followed by the attribute names) and args (encoded values).
+        """
         keys = [self.hash_key]
         values = []
-        utc_now = utc_now_milliseconds()
-        for attribute_name in self.attributes:
-            value = getattr(self.stored_object, attribute_name, None)
-            value = self.attributes_mapper.get(attribute_name, default_map)(
-                self.stored_object, value)
+        utc_now = {True: utc_now_milliseconds, False: lambda: timestamp}.get(timestamp is None)()
+        for attribute_name, value in self.attribute_values():
             keys.append(attribute_name)
-            encoded_value = self.encode_attribute(value, utc_now)
-            values.append(encoded_value)
+            attribute_timestamp = self.attribute_timestamp(attribute_name, utc_now)
+            values.append(self.encode_attribute(value, attribute_timestamp))
+        return keys, values
+
+    def attribute_timestamp(self, attribute_name, timestamp):
+        """
+        :return: timestamp the attribute is saved with: timestamp (time of the save), or for the
+        timestamp_attributes the datapoint timestamp of the stored object, 0 if it has none, so
+        a save never hides a newer touch and a touch always wins over an older save.
+        """
+        source = self.timestamp_attributes.get(attribute_name)
+        if source is None:
+            return timestamp
+        value = getattr(self.stored_object, source, None)
+        return value if isinstance(value, int) and not isinstance(value, bool) else 0
+
+    def attribute_values(self):
+        """
+        :return: list of (attribute name, value to save) of the stored object.
+        """
+        defaults = self.defaults
+        mappers = self.mappers
+        if self.attributes is not defaults['attributes'] or self.attributes_mapper is not defaults[
+                'attributes_mapper']:
+            mappers = attribute_mappers(self.attributes, self.attributes_mapper)
+        stored_object = self.stored_object
+        return [(attribute_name, mapper(stored_object, getattr(stored_object, attribute_name, None)))
+                for attribute_name, mapper in mappers]
+
+    def save_call(self, timestamp=None, labels=None, arguments=None):
+        """
+        :param labels: label entities saved along with this entity, see label_entities.
+        :param arguments: (keys, values) to save instead of save_arguments.
+        :return: (script, keys, args) saving the entity, and atomically its labels if any,
+        with a single script call, as expected by execute_scripts.
+        """
+        keys, values = self.save_arguments(timestamp) if arguments is None else arguments
+        index_keys, index_args = self.index_arguments(keys[1:], values)
+        if not labels and not index_args[1]:
+            return save_json_document_to_hash_set, keys, values + [self.ttl_argument()]
+        script_keys = [keys[0], self.label_index_key, self.index_entries_key] + index_keys
+        args = [labels[0].nested_key if labels else ''] + index_args + field_arguments(keys[1:], values)
+        for label in labels or []:
+            label_keys, label_values = label.save_arguments(timestamp)
+            script_keys.append(label_keys[0])
+            args += field_arguments(label_keys[1:], label_values)
+        return save_entity_with_labels, script_keys, args + [self.ttl_argument()]
+
+    def save_calls(self, timestamp=None, labels=None, arguments=None):
+        """
+        :return: list of (script, keys, args) saving the entity and its labels: the single
+        save_call, or with hash_tags, as the keys are in different cluster slots, one call
+        per hash followed by the update of the label index (not atomic), see run_saves.
+        """
+        if not self.hash_tags:
+            return [self.save_call(timestamp, labels, arguments)]
+        keys, values = self.save_arguments(timestamp) if arguments is None else arguments
+        fields = field_arguments(keys[1:], values)[1:]
+        return [(save_fields, keys[:1], ['0', self.ttl_argument()] + fields)] + self.label_calls(
+            labels, timestamp)
+
+    def label_calls(self, labels, timestamp=None):
+        """
+        :return: calls writing the labels of an entity with hash_tags and replacing its label
+        index, the last one returns the label keys that are not saved anymore.
+        """
+        calls = []
+        ttl = self.ttl_argument()
+        for label in labels or []:
+            label_keys, label_values = label.save_arguments(timestamp)
+            calls.append((save_fields, label_keys[:1], ['0', ttl] + field_arguments(
+                label_keys[1:], label_values)[1:]))
+        if labels:
+            calls.append((update_label_index, [self.label_index_key], [ttl] + [
+                label.hash_key for label in labels]))
+        return calls
+
+    def save_result(self, labels, results):
+        """
+        :param results: results of the save_calls.
+        :return: the result in the format of the save_call script and the label keys to
+        delete (renamed labels of entities with hash_tags, see delete_renamed_labels).
+        """
+        if not self.hash_tags or not labels:
+            return results[0], []
+        return [results[0], []], results[-1]
+
+    def saved(self, labels, result=None):
+        """
+        Invalidates the local copies of the saved hashes and of the label keys
+        deleted by a rename, called before the save (without result), when the labels are
+        added to their label_filter, and after it.
+        :param result: result of the save_call script.
+        :return: dict attribute name -> False if a newer value of the attribute was kept.
+        """
+        for item in [self] + labels:
+            item.invalidate()
+        if result is None:
+            filter_labels(labels)
+            return None
+        applied, moved_labels = {True: lambda: result, False: lambda: (result, [])}.get(
+            is_combined_result(result))()
+        for label_key in moved_labels:
+            getattr(self.local_cache, 'invalidate', lambda k: None)(decode_binary_string(label_key))
+        return {attribute_name: bool(flag) for attribute_name, flag in zip(self.attributes, applied)}
+
+    def save_optimized(self, include_labels=True):
+        """
+        Saves the entity and its label index entries (see label_entities) with one script call,
+        the label keys of a previous label of the entity are deleted.
+        Attributes whose stored value is newer than the saved one are not overwritten.
+        :return: dict attribute name -> True if the attribute was written, always True with
+        write_behind, the attributes are only buffered.
+        """
+        labels = {True: self.label_entities, False: lambda: []}.get(include_labels)()
+        if self.write_behind is not None:
+            utc_now = utc_now_milliseconds()
+            keys, values = self.save_arguments(utc_now)
+            self.write_behind.add(self, [
+                (attribute_name, value, self.attribute_timestamp(attribute_name, utc_now))
+                for attribute_name, value in zip(keys[1:], values)], labels or None)
+            return {attribute_name: True for attribute_name in keys[1:]}
+        calls = self.save_calls(labels=labels)
+        self.saved(labels)
+        if len(calls) == 1:
+            script, keys, args = calls[0]
+            return self.saved(labels, script(self.connection, keys=keys, args=args))
+        return self.saved(labels, run_saves(self.connection, [(self, labels, calls)])[0])
+
+    def label_entities(self):
+        """
+        :return: the label index entities that must be saved along with this entity.
+        """
+        return []
+
+    def changed_call(self, labels):
+        """
+        First step of save_delta.
+        :return: (script, keys, args) finding the attributes of the stored object whose
+        fingerprint differs from the stored one, and the list of (name, value, fingerprint, size).
+        """
+        values = []
+        for attribute_name, value in self.attribute_values():
+            # the fingerprint doesn't depend on the timestamp of the value
+            encoded_value = encode_binary_string(self.codec.encode(value, None))
+            fingerprint = hashlib.blake2b(encoded_value, digest_size=8).hexdigest()
+            values.append((attribute_name, value, fingerprint,
+                           len(encode_binary_string(attribute_name)) + len(encoded_value)))
+        # the labels of entities with hash_tags are in other cluster slots, they are always saved
+        keys = [self.hash_key, self.fingerprint_key, self.label_index_key] + [
+            label.hash_key for label in labels if not self.hash_tags]
+        args = []
+        for attribute_name, value, fingerprint, size in values:
+            args += [attribute_name, fingerprint]
+        return (changed_attributes, keys, args), values
+
+    def save_changed_call(self, labels, values, changed, timestamp=None):
+        """
+        Second step of save_delta.
+        :param values: values returned by changed_call.
+        :param changed: result of the changed_call script.
+        :return: list of (script, keys, args) writing the changed attributes (and the labels if
+        they changed), empty if nothing changed, and the report of the save.
+        """
+        changed_flags, labels_changed = changed
+        cluster_labels = labels if self.hash_tags else []
+        labels = labels if labels_changed else []
+        utc_now = {True: utc_now_milliseconds, False: lambda: timestamp}.get(timestamp is None)()
+        written = [item for item, flag in zip(values, changed_flags) if flag]
+        skipped = [item for item, flag in zip(values, changed_flags) if not flag]
+        encoded_values = [self.encode_attribute(item[1], self.attribute_timestamp(item[0], utc_now))
+                          for item in written]
+        index_keys, index_args = self.index_arguments([item[0] for item in written], encoded_values)
+        args = [labels[0].nested_key if labels else ''] + index_args + [len(written)]
+        for (attribute_name, value, fingerprint, size), encoded_value in zip(written, encoded_values):
+            args += [attribute_name, encoded_value, fingerprint]
+        # bytes_saved doesn't count the timestamps of the skipped values
+        report = {'written': [item[0] for item in written], 'skipped': [item[0] for item in skipped],
+                  'bytes_saved': sum(item[3] for item in skipped)}
+        for label in labels:
+            label_keys, label_values = label.save_arguments(utc_now)
+            args += field_arguments(label_keys[1:], label_values)
+        args.append(self.ttl_argument())
+        calls = self.label_calls(cluster_labels, utc_now)
+        if not written and not labels:
+            return calls, report
+        keys = [self.hash_key, self.fingerprint_key, self.label_index_key, self.index_entries_key] + (
+            index_keys + [label.hash_key for label in labels])
+        return [(save_changed_attributes, keys, args)] + calls, report
+
+    def delta_saved(self, labels, report, results):
+        """
+        Completes the report of save_changed_call with the results of its calls.
+        """
+        applied, moved_labels = [], []
+        if report['written']:
+            applied, moved_labels = results[0][0], list(results[0][1])
+        result = [applied, moved_labels]
+        if self.hash_tags and labels:
+            delete_renamed_labels(self.connection, [(self, labels, result, results[-1])])
+        self.saved(labels, result if labels else applied)
+        report['applied'] = {attribute_name: bool(flag)
+                             for attribute_name, flag in zip(report['written'], applied)}
+        return report
+
+    def save_delta(self, include_labels=True):
+        """
+        Saves only the attributes of the stored object that changed since they were last
+        written by a delta save, comparing fingerprints stored server side (two script calls,
+        only fingerprints are sent by the first one). Attributes written by any other path
+        are always saved again.
+        :return: dict with the written and skipped attribute names, the bytes not sent
+        (bytes_saved) and the applied flag of the written attributes (see save_optimized).
+        """
+        labels = {True: self.label_entities, False: lambda: []}.get(include_labels)()
+        (script, keys, args), values = self.changed_call(labels)
+        changed = script(self.connection, keys=keys, args=args)
+        calls, report = self.save_changed_call(labels, values, changed)
+        self.saved(labels)
+        return self.delta_saved(labels, report, execute_scripts(self.connection, calls))
+
+    @classmethod
+    def save_many_delta(cls, entities, connection=None, deployment=default_deployment,
+                        chunk_size=default_chunk_size, include_labels=True):
+        """
+        save_delta of many entities, two pipelined round trips per chunk.
+        :param entities: Entity instances or stored objects, see save_many.
+        :return: dict with the number of entities, fields written and skipped and bytes_saved.
+        """
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        totals = {'entities': 0, 'written': 0, 'skipped': 0, 'bytes_saved': 0}
+        for chunk in iterate_chunks(entities, chunk_size):
+            utc_now = utc_now_milliseconds()
+            chunk = [entity if isinstance(entity, Entity) else cls(
+                entity, deployment=deployment, connection=connection) for entity in chunk]
+            labels = [{True: entity.label_entities, False: lambda: []}.get(include_labels)()
+                      for entity in chunk]
+            checks = [entity.changed_call(entity_labels) for entity, entity_labels in zip(chunk, labels)]
+            changes = execute_scripts(connection, [call for call, values in checks], chunk_size)
+            saves = [entity.save_changed_call(entity_labels, values, changed, utc_now)
+                     for entity, entity_labels, (call, values), changed in zip(
+                         chunk, labels, checks, changes)]
+            filter_labels([label for entity_labels in labels for label in entity_labels])
+            for entity, entity_labels in zip(chunk, labels):
+                entity.saved(entity_labels)
+            results = iter(execute_scripts(
+                connection, [call for calls, report in saves for call in calls], chunk_size))
+            for entity, entity_labels, (calls, report) in zip(chunk, labels, saves):
+                report = entity.delta_saved(entity_labels, report, [next(results) for _ in calls])
+                totals['entities'] += 1
+                totals['written'] += len(report['written'])
+                totals['skipped'] += len(report['skipped'])
+                totals['bytes_saved'] += report['bytes_saved']
+        return totals
+
+    @classmethod
+    def save_many(cls, entities, connection=None, deployment=default_deployment,
+                  chunk_size=default_chunk_size, include_labels=True):
+        """
+        Saves many entities using one pipelined round trip per chunk instead of one
+        script call per entity.
+        :param entities: Entity instances, or stored objects that are wrapped with this class,
+        e.g. Variable.save_many(variables, connection).
+        :param include_labels: also write the label index entries (VariableByLabel, DeviceByLabel)
+        of every entity in the same script call, see save_calls.
+        :return: number of hashes written.
+        """
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        written = 0
+        for chunk in iterate_chunks(entities, chunk_size):
+            utc_now = utc_now_milliseconds()
+            saves = []
+            for entity in chunk:
+                if not isinstance(entity, Entity):
+                    entity = cls(entity, deployment=deployment, connection=connection)
+                labels = {True: entity.label_entities, False: lambda: []}.get(include_labels)()
+                saves.append((entity, labels, entity.save_calls(utc_now, labels)))
+            # one label_filter write for the chunk, see saved
+            filter_labels([label for entity, labels, calls in saves for label in labels])
+            for entity, labels, calls in saves:
+                entity.saved(labels)
+            for (entity, labels, calls), result in zip(saves, run_saves(connection, saves, chunk_size)):
+                entity.saved(labels, result)
+                written += 1 + len(labels)
+        return written
+
+
+def filter_labels(labels):
+    """
+    Adds the keys of the labels about to be saved to the label_filter of their deployment,
+    with one write per filter, see EntityByLabel.known_absent.
+    """
+    filters = {}
+    for label in labels:
+        label_filter = label.label_filter
+        if label_filter is not None and label_filter.deployment == label.deployment:
+            filters.setdefault(id(label_filter), (label_filter, []))[1].append(label.hash_key)
+    for label_filter, keys in filters.values():
+        label_filter.add(*keys)
+
 
-        return save_json_document_to_hash_set(self.connection, keys=keys, args=values)
+def run_saves(connection, saves, chunk_size=default_chunk_size):
+    """
+    Executes the save_calls of many entities with one pipeline per chunk of calls, then
+    deletes the renamed labels of the entities with hash_tags.
+    :param saves: list of (entity, labels, calls).
+    :return: list with the result of every save in the format of the save_call script.
+    """
+    calls = [call for entity, labels, entity_calls in saves for call in entity_calls]
+    results = iter(execute_scripts(connection, calls, chunk_size))
+    saved = []
+    removals = []
+    for entity, labels, entity_calls in saves:
+        result, removed = entity.save_result(labels, [next(results) for _ in entity_calls])
+        saved.append(result)
+        if removed:
+            removals.append((entity, labels, result, removed))
+    delete_renamed_labels(connection, removals, chunk_size)
+    return saved
+
+
+def delete_renamed_labels(connection, removals, chunk_size=default_chunk_size):
+    """
+    Deletes the label keys removed from the label index of entities with hash_tags if they
+    still point to their entity, they are added to the moved labels of the save result.
+    :param removals: list of (entity, labels, save result, removed label keys).
+    """
+    calls = [(delete_label, [label_key], [labels[0].nested_key, entity.hash_key])
+             for entity, labels, result, removed in removals for label_key in removed]
+    deleted = iter(execute_scripts(connection, calls, chunk_size))
+    for entity, labels, result, removed in removals:
+        result[1].extend([label_key for label_key in removed if next(deleted)])
+
+
+def fresh_value(entity, field, attribute_name, max_age_ms, stale_while_revalidate):
+    """
+    :param field: decoded field, see utils_codec.decode_field.
+    :return: (value, age) of the field, reloading entity through its loader if the value
+    is older than max_age_ms, see Entity.get_attribute_with_age.
+    """
+    field = {} if field is None else field
+    value, timestamp = field.get('value'), field.get('updated_timestamp')
+    age = None if timestamp is None else max(utc_now_milliseconds() - timestamp, 0)
+    loader = getattr(entity, 'loader', None)
+    if max_age_ms is None or age is None or age <= max_age_ms or loader is None:
+        return value, age
+    if stale_while_revalidate:
+        loader.revalidate(entity)
+        return value, age
+    values = loader.reload(entity)
+    if values is None:
+        return value, age
+    return values.get(attribute_name), 0
 
 
 class Variable(Entity):
+    entity = 'variable'
+    primary_key_name = 'id'
     attributes = ['derived_expr', 'tags', 'device_id', 'type',
                   'created_at', 'properties', 'label', 'name',
                   'icon', 'description', 'state', 'unit', 'id',
                   'device_id', 'last_value', 'last_activity'
                   ]
+    indexes = ['device_id', 'tags']
+    timestamp_attributes = {'last_value': 'last_activity', 'last_activity': 'last_activity'}
 
     def __init__(self, variable=None,
                  deployment=default_deployment, attributes=None,
-                 primary_key=None, attributes_mapper=None, connection=None):
+                 primary_key=None, attributes_mapper=None, connection=None, **kwargs):
         primary_key = u'{0}'.format(getattr(variable, 'id', primary_key))
-        entity = 'variable'
-        primary_key_name = 'id'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
         super(Variable, self).__init__(deployment=deployment, stored_object=variable,
-                                       primary_key=primary_key, entity=entity,
-                                       primary_key_name=primary_key_name,
+                                       primary_key=primary_key,
                                        attributes=attributes,
                                        attributes_mapper=attributes_mapper,
-                                       connection=connection)
-
-    @property
-    def derived_expr(self):
-        return self.get_attribute('derived_expr')
-
-    @property
-    def tags(self):
-        return self.get_attribute('tags')
-
-    @property
-    def device_id(self):
-        return self.get_attribute('device_id')
-
-    @property
-    def type(self):
-        return self.get_attribute('type')
-
-    @property
-    def created_at(self):
-        return self.get_attribute('created_at')
-
-    @property
-    def properties(self):
-        return self.get_attribute('properties')
-
-    @property
-    def label(self):
-        return self.get_attribute('label')
-
-    @property
-    def name(self):
-        return self.get_attribute('name')
-
-    @property
-    def icon(self):
-        return self.get_attribute('icon')
-
-    @property
-    def description(self):
-        return self.get_attribute('description')
-
-    @property
-    def state(self):
-        return self.get_attribute('state')
+                                       connection=connection,
+                                       **kwargs)
 
-    @property
-    def unit(self):
-        return self.get_attribute('unit')
-
-    @property
-    def id(self):
-        return self.get_attribute('id')
-
-    @property
-    def last_value(self):
-        return self.get_attribute('last_value')
+    def touch_keys(self, device_id=None):
+        """
+        :param device_id: id of the device of the variable, read from the cached variable if None,
+        required if the codec is not script_readable (the script can't decode the field).
+        :return: (key, key type, device key, device key type) of touch_variable_script.
+        """
+        if device_id is None and not self.codec.script_readable:
+            raise ValueError('touch requires the device_id with the codec {0}'.format(
+                type(self.codec).__name__))
+        device_key = '' if device_id is None else Device(
+            primary_key=device_id, deployment=self.deployment, hash_tags=self.hash_tags,
+            batched=False).hash_key
+        return self.hash_key, 'id', device_key, 'id'
+
+    def touch_call(self, value, timestamp=None, device_id=None):
+        """
+        :return: (script, keys, args) updating last_value and last_activity, see touch.
+        """
+        return touch_arguments(self, value, timestamp, *self.touch_keys(device_id))
 
-    @property
-    def last_activity(self):
-        return self.get_attribute('last_activity')
+    def touch(self, value, timestamp=None, device_id=None):
+        """
+        Hot path of the datapoint ingestion: sets last_value and last_activity of the variable
+        and last_activity of its device with one script call, the other attributes are
+        neither read nor encoded again. Variables that are not cached are not created.
+        The stored hot fields are only overwritten by newer datapoints, save writes them with
+        the datapoint timestamp of the variable too (see timestamp_attributes).
+        :param timestamp: milliseconds timestamp of the value, now if None.
+        :return: applied flags of the writes, see touched.
+        """
+        if self.hash_tags:
+            results = touch_cluster(self.connection, [(self, value, timestamp, device_id)])
+            return touched(self, results[0])
+        script, keys, args = self.touch_call(value, timestamp, device_id)
+        return touched(self, script(self.connection, keys=keys, args=args))
+
+    @classmethod
+    def touch_many(cls, updates, connection=None, chunk_size=default_chunk_size):
+        """
+        Pipelined touch of many variables.
+        :param updates: iterable of (entity, value, timestamp) tuples, entity being a
+        Variable or a VariableByLabel.
+        :return: number of variables whose last_value or last_activity was updated.
+        """
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        updates = list(updates)
+        clustered = [(entity, value, timestamp, None)
+                     for entity, value, timestamp in updates if entity.hash_tags]
+        updates = [update for update in updates if not update[0].hash_tags]
+        results = execute_scripts(connection, [entity.touch_call(value, timestamp)
+                                               for entity, value, timestamp in updates], chunk_size)
+        results += touch_cluster(connection, clustered, chunk_size)
+        entities = [update[0] for update in updates + clustered]
+        flags = [touched(entity, result) for entity, result in zip(entities, results)]
+        return sum(bool(applied.get('last_value') or applied.get('last_activity')) for applied in flags)
+
+    def label_entities(self):
+        if getattr(self.stored_object, 'datasource', None) is None:
+            return []
+        return [VariableByLabel(variable=self.stored_object, deployment=self.deployment, batched=False,
+                                connection=self.connection, local_cache=self.local_cache,
+                                hash_tags=self.hash_tags, replicas=self.replicas)]
 
 
 class Device(Entity):
+    entity = 'device'
+    primary_key_name = 'id'
     attributes = ['owner_id', 'tags', 'organization_id',
                   'created_at', 'context', 'label', 'name',
                   'ubi_context', 'description', 'state', 'id',
                   'enabled', 'last_activity', 'variables'
                   ]
+    indexes = ['tags']
+    timestamp_attributes = {'last_activity': 'last_activity'}
 
     def __init__(self, device=None, deployment=default_deployment, attributes=None,
-                 primary_key=None, attributes_mapper=None, connection=None):
+                 primary_key=None, attributes_mapper=None, connection=None, **kwargs):
         primary_key = u'{0}'.format(getattr(device, 'id', primary_key))
-        entity = 'device'
-        primary_key_name = 'id'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
         super(Device, self).__init__(deployment=deployment, stored_object=device,
-                                     primary_key=primary_key, entity=entity,
-                                     primary_key_name=primary_key_name,
+                                     primary_key=primary_key,
                                      attributes=attributes,
                                      connection=connection,
-                                     attributes_mapper=attributes_mapper)
-
-    @property
-    def owner_id(self):
-        return self.get_attribute('owner_id')
-
-    @property
-    def name(self):
-        return self.get_attribute('name')
-
-    @property
-    def organization_id(self):
-        return self.get_attribute('organization_id')
-
-    @property
-    def state(self):
-        return self.get_attribute('state')
+                                     attributes_mapper=attributes_mapper,
+                                     **kwargs)
 
-    @property
-    def description(self):
-        return self.get_attribute('description')
+    def get_variables(self, attributes=None, hydrate=True):
+        """
+        Variables of the device, from the device_id index of the cached variables.
+        :param attributes: attributes of the hydrated variables, all of them if None.
+        :return: list of Variable (values in memory), their primary keys if not hydrate.
+        """
+        key = index_key(self.deployment, Variable.entity, 'device_id', self.primary_key)
+        primary_keys = sorted(Variable.live_index_members(
+            [key], [decode_binary_string(member) for member in self.connection.smembers(key)],
+            self.connection, self.deployment))
+        if not hydrate:
+            return primary_keys
+        return Variable.hydrate(primary_keys, attributes, connection=self.connection,
+                                deployment=self.deployment)
+
+    def label_entities(self):
+        if self.stored_object is None:
+            return []
+        return [DeviceByLabel(device=self.stored_object, deployment=self.deployment, batched=False,
+                              connection=self.connection, local_cache=self.local_cache,
+                              hash_tags=self.hash_tags, replicas=self.replicas)]
+
+
+class EntityByLabel(Entity):
+    """
+    Index entity stored at a label based key, its nested_key attribute holds the
+    hash key of the entity it points to.
+    """
+    primary_key_name = 'label'
+    attributes = ['id']
+    nested_key = 'id'
+    # optional utils_negative_cache.NegativeCache of the labels read as missing
+    negative_cache = None
+    # optional Bloom filter of the label keys of a deployment, see utils_negative_cache
+    label_filter = None
+
+    def __init__(self, *args, **kwargs):
+        super(EntityByLabel, self).__init__(*args, **kwargs)
+        # the labels expire with the entity they point to
+        if self.retention is None and self.nested_entity is not None:
+            self.retention = self.nested_entity.retention
 
-    @property
-    def label(self):
-        return self.get_attribute('label')
+    def encode_attribute(self, value, timestamp=None):
+        return '{0}'.format(value)
 
-    @property
-    def context(self):
-        return self.get_attribute('context')
+    def known_absent(self):
+        """
+        :return: True if the label is known not to exist without round trip: it was read as
+        missing recently (negative_cache) or the label_filter of its deployment rejects it.
+        """
+        hash_key = self.hash_key
+        if self.negative_cache is not None and self.negative_cache.contains(hash_key):
+            return True
+        label_filter = self.label_filter
+        return (label_filter is not None and label_filter.deployment == self.deployment and
+                not label_filter.might_contain(hash_key))
+
+    def absent(self):
+        """
+        Records that the label was read as missing.
+        """
+        if self.negative_cache is not None:
+            self.negative_cache.add(self.hash_key)
 
-    @property
-    def tags(self):
-        return self.get_attribute('tags')
+    def invalidate(self):
+        super(EntityByLabel, self).invalidate()
+        if self.negative_cache is not None:
+            self.negative_cache.discard(self.hash_key)
 
-    @property
-    def ubi_context(self):
-        return self.get_attribute('ubi_context')
+    def saved(self, labels, result=None):
+        # the labels saved directly are added to the label_filter like the label entities
+        if result is None:
+            filter_labels([self])
+        return super(EntityByLabel, self).saved(labels, result)
 
-    @property
-    def created_at(self):
-        return self.get_attribute('created_at')
+    def save_attribute(self, attribute_name, value, timestamp=None):
+        filter_labels([self])
+        return super(EntityByLabel, self).save_attribute(attribute_name, value, timestamp)
 
-    @property
-    def id(self):
-        return self.get_attribute('id')
+    def get_all_attributes_nested(self, nested_key):
+        if self.known_absent():
+            return {}
+        data = super(EntityByLabel, self).get_all_attributes_nested(nested_key)
+        if not data:
+            self.absent()
+        return data
+
+    def get_id_and_value_nested(self, nested_key, attribute_name):
+        if self.known_absent():
+            return None, None
+        target_key, value = super(EntityByLabel, self).get_id_and_value_nested(
+            nested_key, attribute_name)
+        if not target_key:
+            self.absent()
+        return target_key, value
 
-    @property
-    def enabled(self):
-        return self.get_attribute('enabled')
+    def get_value_nested(self, nested_key, attribute_name):
+        if self.known_absent():
+            return None
+        return super(EntityByLabel, self).get_value_nested(nested_key, attribute_name)
 
-    @property
-    def variables(self):
-        return self.get_attribute('variables')
+    def get_values_nested(self, nested_key, attribute_names):
+        if self.known_absent():
+            return [None] * len(list(attribute_names))
+        return super(EntityByLabel, self).get_values_nested(nested_key, attribute_names)
 
-    @property
-    def last_activity(self):
-        return self.get_attribute('last_activity')
+    def attribute_values(self):
+        """
+        The pointer is the hash key of nested_entity built from the stored object, in the
+        deployment and key layout of the label.
+        """
+        values = super(EntityByLabel, self).attribute_values()
+        if self.nested_entity is None or self.stored_object is None:
+            return values
+        target_key = self.nested_entity(self.stored_object, deployment=self.deployment,
+                                        hash_tags=self.hash_tags).hash_key
+        return [(attribute_name, target_key if attribute_name == self.nested_key else value)
+                for attribute_name, value in values]
+
+    @classmethod
+    def resolve_many(cls, label_keys, attributes=None, connection=None,
+                     deployment=default_deployment, chunk_size=default_chunk_size):
+        """
+        Follows the label -> entity indirection of many labels with one script call per chunk.
+        :param label_keys: primary keys of the labels, e.g. 'owner_id:device_label:variable_label'.
+        :param attributes: names of the attributes to read, all of them if None.
+        :return: dict label key -> decoded attributes of the entity it points to (same format as
+        get_all_attributes), None for unknown labels and labels pointing to missing entities.
+        Without connection the labels are read from the replicas of the class. The labels
+        known to be absent (see known_absent) are not read.
+        """
+        replicas = {True: cls.replicas, False: None}.get(connection is None)
+        connection = {True: cls.connection, False: connection}.get(connection is None)
+        attributes = [] if attributes is None else list(attributes)
+        result = {}
+        for chunk in iterate_chunks(label_keys, chunk_size):
+            labels = [cls(primary_key=label_key, deployment=deployment, batched=False)
+                      for label_key in chunk]
+            labels = [label for label in labels if not label.known_absent()]
+            result.update((label_key, None) for label_key in chunk)
+            if not labels:
+                continue
+            keys = [label.hash_key for label in labels]
+            read_connection, read_only = route_read(replicas, connection, keys, follows_pointers=True)
+            values = {True: resolve_labels_pipelined,
+                      False: lambda c, k, a: resolve_labels(c, keys=k, args=[cls.nested_key] + a,
+                                                            read_only=read_only)}.get(
+                cls.hash_tags)(read_connection, keys, attributes)
+            for label, data in zip(labels, values):
+                if data is None:
+                    label.absent()
+                else:
+                    data = decode_attributes(
+                        dict(zip(attributes, data)) if attributes else list_to_dict(data))
+                result[label.primary_key] = data
+        return result
 
 
-class VariableByLabel(Entity):
-    attributes = ['id']
+def resolve_labels_pipelined(connection, keys, attributes):
+    """
+    resolve_labels_script for labels with hash_tags, the labels and the entities they point
+    to being in different cluster slots: reads the pointers then the entities with two
+    pipelined round trips.
+    """
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hget(key, EntityByLabel.nested_key)
+    target_keys = pipeline.execute()
+    pipeline = connection.pipeline(transaction=False)
+    for target_key in [target_key for target_key in target_keys if target_key]:
+        pipeline.exists(target_key)
+        {True: lambda: pipeline.hmget(target_key, attributes),
+         False: lambda: pipeline.hgetall(target_key)}.get(bool(attributes))()
+    found = iter(pipeline.execute())
+    values = []
+    for target_key in target_keys:
+        exists, data = (next(found), next(found)) if target_key else (False, None)
+        if exists and not attributes:
+            data = [item for pair in data.items() for item in pair]
+        values.append(data if exists else None)
+    return values
+
+
+class VariableByLabel(EntityByLabel):
+    entity = 'variable'
+    nested_entity = Variable
     attributes_mapper = {
-        'id': lambda variable, value: Variable(primary_key=getattr(variable, 'id', value)).hash_key,
+        'id': lambda variable, value: Variable(primary_key=getattr(variable, 'id', value),
+                                               batched=False).hash_key,
     }
 
     def __init__(self, deployment=default_deployment, primary_key=None, variable=None,
-                 attributes=None, attributes_mapper=None, connection=None):
-        device = getattr(variable, 'datasource', None)
-        device_label = getattr(device, 'label', None)
-        user_id = getattr(device, 'owner_id', None)
-        variable_label = u'{0}'.format(getattr(variable, 'label', None))
-        local_primary_key = u'{0}:{1}:{2}'.format(user_id, device_label, variable_label)
-        primary_key = {True: primary_key, False: local_primary_key}.get(primary_key is not None)
-        entity = 'variable'
-        primary_key_name = 'label'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
+                 attributes=None, attributes_mapper=None, connection=None, **kwargs):
+        if primary_key is None:
+            device = getattr(variable, 'datasource', None)
+            primary_key = u'{0}:{1}:{2}'.format(getattr(device, 'owner_id', None),
+                                                getattr(device, 'label', None),
+                                                getattr(variable, 'label', None))
         super(VariableByLabel, self).__init__(deployment=deployment, stored_object=variable,
-                                              primary_key=primary_key, entity=entity,
-                                              primary_key_name=primary_key_name,
+                                              primary_key=primary_key,
                                               attributes=attributes,
                                               connection=connection,
-                                              attributes_mapper=attributes_mapper)
-
-    def encode_attribute(self, value, timestamp=None):
-        return '{0}'.format(value)
-
-    @property
-    def derived_expr(self):
-        return self.get_attribute_nested('id', 'derived_expr')
-
-    @property
-    def tags(self):
-        return self.get_attribute_nested('id', 'tags')
-
-    @property
-    def device_id(self):
-        return self.get_attribute_nested('id', 'device_id')
-
-    @property
-    def type(self):
-        return self.get_attribute_nested('id', 'type')
-
-    @property
-    def created_at(self):
-        return self.get_attribute_nested('id', 'created_at')
-
-    @property
-    def properties(self):
-        return self.get_attribute_nested('id', 'properties')
-
-    @property
-    def label(self):
-        return self.get_attribute_nested('id', 'label')
-
-    @property
-    def name(self):
-        return self.get_attribute_nested('id', 'name')
-
-    @property
-    def icon(self):
-        return self.get_attribute_nested('id', 'icon')
+                                              attributes_mapper=attributes_mapper,
+                                              **kwargs)
 
-    @property
-    def description(self):
-        return self.get_attribute_nested('id', 'description')
-
-    @property
-    def state(self):
-        return self.get_attribute_nested('id', 'state')
-
-    @property
-    def unit(self):
-        return self.get_attribute_nested('id', 'unit')
-
-    @property
-    def id(self):
-        return self.get_attribute_nested('id', 'id')
+    def touch_keys(self, device_id=None):
+        """
+        :return: keys of touch_variable_script, the device is found through its device label.
+        """
+        device_label = DeviceByLabel(primary_key=self.primary_key.rsplit(':', 1)[0],
+                                     deployment=self.deployment, hash_tags=self.hash_tags,
+                                     batched=False)
+        return self.hash_key, 'label', device_label.hash_key, 'label'
 
-    @property
-    def last_value(self):
-        return self.get_attribute_nested('id', 'last_value')
+    def touch_call(self, value, timestamp=None):
+        """
+        :return: (script, keys, args) updating the variable the label points to and the
+        device of its device label, see Variable.touch.
+        """
+        return touch_arguments(self, value, timestamp, *self.touch_keys())
 
-    @property
-    def last_activity(self):
-        return self.get_attribute_nested('id', 'last_activity')
+    def touch(self, value, timestamp=None):
+        """
+        Variable.touch going through the label index.
+        """
+        if self.hash_tags:
+            return touched(self, touch_cluster(self.connection, [(self, value, timestamp, None)])[0])
+        script, keys, args = self.touch_call(value, timestamp)
+        return touched(self, script(self.connection, keys=keys, args=args))
 
 
-class DeviceByLabel(Entity):
-    attributes = ['id']
+class DeviceByLabel(EntityByLabel):
+    entity = 'device'
+    nested_entity = Device
     attributes_mapper = {
-        'id': lambda device, value: Device(primary_key=getattr(device, 'id', value)).hash_key,
+        'id': lambda device, value: Device(primary_key=getattr(device, 'id', value),
+                                           batched=False).hash_key,
     }
 
     def __init__(self, deployment=default_deployment, primary_key=None, device=None,
-                 attributes=None, attributes_mapper=None, connection=None):
-        device_label = getattr(device, 'label', None)
-        user_id = getattr(device, 'owner_id', None)
-        local_primary_key = u'{0}:{1}'.format(user_id, device_label)
-        primary_key = {True: primary_key, False: local_primary_key}.get(primary_key is not None)
-        entity = 'device'
-        primary_key_name = 'label'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
+                 attributes=None, attributes_mapper=None, connection=None, **kwargs):
+        if primary_key is None:
+            primary_key = u'{0}:{1}'.format(getattr(device, 'owner_id', None),
+                                            getattr(device, 'label', None))
         super(DeviceByLabel, self).__init__(deployment=deployment, stored_object=device,
-                                            primary_key=primary_key, entity=entity,
-                                            primary_key_name=primary_key_name,
+                                            primary_key=primary_key,
                                             attributes=attributes,
                                             connection=connection,
-                                            attributes_mapper=attributes_mapper)
-
-    def encode_attribute(self, value, timestamp=None):
-        return '{0}'.format(value)
-
-    @property
-    def owner_id(self):
-        return self.get_attribute_nested('id', 'owner_id')
-
-    @property
-    def name(self):
-        return self.get_attribute_nested('id', 'name')
-
-    @property
-    def organization_id(self):
-        return self.get_attribute_nested('id', 'organization_id')
-
-    @property
-    def state(self):
-        return self.get_attribute_nested('id', 'state')
-
-    @property
-    def description(self):
-        return self.get_attribute_nested('id', 'description')
-
-    @property
-    def label(self):
-        return self.get_attribute_nested('id', 'label')
-
-    @property
-    def context(self):
-        return self.get_attribute_nested('id', 'context')
-
-    @property
-    def tags(self):
-        return self.get_attribute_nested('id', 'tags')
+                                            attributes_mapper=attributes_mapper,
+                                            **kwargs)
 
-    @property
-    def ubi_context(self):
-        return self.get_attribute_nested('id', 'ubi_context')
 
-    @property
-    def created_at(self):
-        return self.get_attribute_nested('id', 'created_at')
+# hot fields written by touch_variable_script, in the order of its applied flags
+touched_fields = ('last_value', 'last_activity', 'device_last_activity')
 
-    @property
-    def id(self):
-        return self.get_attribute_nested('id', 'id')
 
-    @property
-    def enabled(self):
-        return self.get_attribute_nested('id', 'enabled')
+def touch_arguments(entity, value, timestamp, key, key_type, device_key=None, device_key_type='defer'):
+    """
+    :param device_key: None to only return the device key without updating it ('defer'), or
+    to leave the device to the caller ('skip'), see touch_variable_script. The ttl of the
+    device keys is the one of the Device retention.
+    """
+    timestamp = utc_now_milliseconds() if timestamp is None else timestamp
+    keys = {True: lambda: [key], False: lambda: [key, device_key]}.get(device_key is None)()
+    return touch_variable, keys, [
+        key_type, device_key_type, entity.codec.encode(value, timestamp),
+        entity.codec.encode(timestamp, timestamp), key_prefix(entity.deployment, 'device', 'id'),
+        '1' if entity.hash_tags else '0', entity.ttl_argument(), retention_ttl(Device.retention)]
 
-    @property
-    def variables(self):
-        return self.get_attribute_nested('id', 'variables')
 
-    @property
-    def last_activity(self):
-        return self.get_attribute_nested('id', 'last_activity')
+def touch_cluster(connection, updates, chunk_size=default_chunk_size):
+    """
+    touch of variables with hash_tags, the variable, its labels and its device being in
+    different cluster slots: the labels are resolved first, then the variables are updated
+    and last their devices, one pipelined round trip each (not atomic).
+    :param updates: iterable of (entity, value, timestamp, device_id) tuples, entity being a
+    Variable or a VariableByLabel.
+    :return: list with the result of every touch, as touch_variable_script, see touched.
+    """
+    results = []
+    for chunk in iterate_chunks(updates, chunk_size):
+        targets = [entity.touch_keys(device_id) for entity, value, timestamp, device_id in chunk]
+        pipeline = connection.pipeline(transaction=False)
+        for key, key_type, device_key, device_key_type in targets:
+            for label_key in [key] * (key_type == 'label') + [device_key] * (device_key_type == 'label'):
+                pipeline.hget(label_key, EntityByLabel.nested_key)
+        pointers = iter(pipeline.execute())
+        touches = []
+        for (entity, value, timestamp, device_id), (key, key_type, device_key, device_key_type) in zip(
+                chunk, targets):
+            key = decode_binary_string(next(pointers)) if key_type == 'label' else key
+            if device_key_type == 'label':
+                device_key = decode_binary_string(next(pointers))
+            timestamp = utc_now_milliseconds() if timestamp is None else timestamp
+            # the script only resolves the devices unknown here
+            call = touch_arguments(entity, value, timestamp, key, 'id', None,
+                                   'skip' if device_key else 'defer') if key else None
+            touches.append((entity, device_key, call, timestamp))
+        variables = iter(execute_scripts(
+            connection, [call for _, _, call, _ in touches if call], chunk_size))
+        updated = []
+        for entity, device_key, call, timestamp in touches:
+            result = list(next(variables)) if call else []
+            if result:
+                device_key = device_key or (decode_binary_string(result[1]) if result[1] else None)
+                result = [decode_binary_string(result[0]), device_key, list(result[2][:2])]
+            updated.append((entity, result, timestamp))
+        devices = iter(execute_scripts(connection, [
+            (save_fields, [result[1]], ['1', retention_ttl(Device.retention), 'last_activity',
+                                        entity.codec.encode(timestamp, timestamp)])
+            for entity, result, timestamp in updated if result and result[1]], chunk_size))
+        for entity, result, timestamp in updated:
+            # save_fields returns no flag for a device that is not cached
+            applied = next(devices) if result and result[1] else []
+            if result:
+                result[1] = result[1] if applied else None
+                result[2].append(applied[0] if applied else 0)
+            results.append(result)
+    return results
+
+
+def touched(entity, result):
+    """
+    Drops the local copies of the hashes updated by a touch.
+    :param result: result of touch_variable_script (or of touch_cluster).
+    :return: dict 'last_value', 'last_activity', 'device_last_activity' -> True if the write
+    was applied, False if a newer value was stored (or the device is not cached), empty if
+    the variable is not cached.
+    """
+    entity.record = None
+    if not result:
+        return {}
+    keys = [decode_binary_string(key) for key in result[:2] if key]
+    for key in keys:
+        getattr(entity.local_cache, 'invalidate', lambda k: None)(key)
+    getattr(entity.replicas, 'written', lambda *k: None)(entity.hash_key, *keys)
+    return {name: bool(flag) for name, flag in zip(touched_fields, result[2])}
 
 
 class User(Entity):
+    entity = 'user'
+    primary_key_name = 'id'
     attributes = ['id', 'username', 'first_name', 'last_name', 'email',
                   'custom_username', 'current_credits',
                   'default_dashboard', 'language', 'website',
                   'timezone', 'properties']
 
     def __init__(self, user=None, deployment=default_deployment, attributes=None,
-                 attributes_mapper=None, primary_key=None, connection=None):
+                 attributes_mapper=None, primary_key=None, connection=None, **kwargs):
         primary_key = u'{0}'.format(getattr(user, 'id', primary_key))
-        entity = 'user'
-        primary_key_name = 'id'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
         super(User, self).__init__(deployment=deployment, stored_object=user,
-                                   primary_key=primary_key, entity=entity,
-                                   primary_key_name=primary_key_name,
+                                   primary_key=primary_key,
                                    attributes=attributes,
                                    connection=connection,
-                                   attributes_mapper=attributes_mapper)
-
-    @property
-    def id(self):
-        return self.get_attribute('id')
-
-    @property
-    def username(self):
-        return self.get_attribute('username')
-
-    @property
-    def first_name(self):
-        return self.get_attribute('first_name')
-
-    @property
-    def last_name(self):
-        return self.get_attribute('last_name')
-
-    @property
-    def email(self):
-        return self.get_attribute('email')
-
-    @property
-    def custom_username(self):
-        return self.get_attribute('custom_username')
-
-    @property
-    def default_dashboard(self):
-        return self.get_attribute('default_dashboard')
-
-    @property
-    def current_credits(self):
-        return self.get_attribute('current_credits')
-
-    @property
-    def language(self):
-        return self.get_attribute('language')
-
-    @property
-    def timezone(self):
-        return self.get_attribute('timezone')
-
-    @property
-    def properties(self):
-        return self.get_attribute('properties')
-
-    @property
-    def website(self):
-        return self.get_attribute('website')
+                                   attributes_mapper=attributes_mapper,
+                                   **kwargs)
 
 
 class BusinessAccount(Entity):
+    entity = 'business_account'
+    primary_key_name = 'id'
     attributes = ['id', 'owner_id', 'is_active', 'date_created', 'balance',
                   'extra_costs', 'prices', 'initial_free_items', 'limits', 'one_time_costs',
                   'business_type', 'last_activity', 'trial_end_timestamp_utc', 'invoice_to',
                   'custom_note', 'plan', 'from_email']
 
     def __init__(self, business_account=None, deployment=default_deployment, attributes=None,
-                 primary_key=None, attributes_mapper=None, connection=None):
+                 primary_key=None, attributes_mapper=None, connection=None, **kwargs):
         primary_key = u'{0}'.format(getattr(business_account, 'id', primary_key))
-        entity = 'business_account'
-        primary_key_name = 'id'
-        attributes = {True: attributes, False: self.attributes}.get(attributes is not None)
-        attributes_mapper = {True: attributes_mapper,
-                             False: self.attributes_mapper}.get(attributes_mapper is not None)
         super(BusinessAccount, self).__init__(deployment=deployment, stored_object=business_account,
-                                              primary_key=primary_key, entity=entity,
-                                              primary_key_name=primary_key_name,
+                                              primary_key=primary_key,
                                               attributes=attributes,
                                               connection=connection,
-                                              attributes_mapper=attributes_mapper)
-
-    @property
-    def id(self):
-        return self.get_attribute('id')
-
-    @property
-    def owner_id(self):
-        return self.get_attribute('owner_id')
-
-    @property
-    def date_created(self):
-        return self.get_attribute('date_created')
-
-    @property
-    def balance(self):
-        return self.get_attribute('balance')
-
-    @property
-    def extra_costs(self):
-        return self.get_attribute('extra_costs')
-
-    @property
-    def prices(self):
-        return self.get_attribute('prices')
-
-    @property
-    def initial_free_items(self):
-        return self.get_attribute('initial_free_items')
-
-    @property
-    def limits(self):
-        return self.get_attribute('limits')
-
-    @property
-    def one_time_costs(self):
-        return self.get_attribute('one_time_costs')
-
-    @property
-    def business_type(self):
-        return self.get_attribute('business_type')
-
-    @property
-    def last_activity(self):
-        return self.get_attribute('last_activity')
-
-    @property
-    def trial_end_timestamp_utc(self):
-        return self.get_attribute('trial_end_timestamp_utc')
-
-    @property
-    def invoice_to(self):
-        return self.get_attribute('invoice_to')
-
-    @property
-    def custom_note(self):
-        return self.get_attribute('custom_note')
-
-    @property
-    def plan(self):
-        return self.get_attribute('plan')
-
-    @property
-    def from_email(self):
-        return self.get_attribute('from_email')
-
-    @property
-    def is_active(self):
-        return self.get_attribute('is_active')
+                                              attributes_mapper=attributes_mapper,
+                                              **kwargs)
@@ -0,0 +1,148 @@
+"""
+Invalidation of a utils_local_cache.LocalCache driven by redis server assisted client
+side caching (CLIENT TRACKING, redis >= 6.2).
+
+Tracking runs in broadcast mode for the key prefixes of the cached entities, e.g.
+'INDUSTRIAL:variable:', and its invalidation messages are redirected to a subscribed
+connection, which works for RESP2 and RESP3 clients. The local cache is disabled
+(and emptied) whenever the tracking or the subscribed connection is lost, so it never
+serves values whose invalidation could have been missed.
+"""
+import threading
+import uuid
+from time import monotonic
+
+import redis
+
+from global_cache.utils_global_cache import decode_binary_string, default_deployment
+
+invalidation_channel = '__redis__:invalidate'
+
+
+def entity_prefixes(entities, deployment=default_deployment):
+    """
+    :return: tracking prefixes covering every key of the given entity names,
+    including their label index keys.
+    """
+    return [u'{0}:{1}:'.format(deployment, entity) for entity in entities]
+
+
+class TrackingInvalidator(object):
+    """
+    Background thread evicting from local_cache the hash keys written by any redis client.
+
+    :param local_cache: utils_local_cache.LocalCache shared by the entities.
+    :param prefixes: key prefixes to track, see entity_prefixes.
+    :param connection_kwargs: arguments of the redis.Redis clients opened by the invalidator
+    (host, port, db, password...), two dedicated connections are used.
+    :param health_check_interval: seconds between checks of the tracking connection.
+    :param reconnect_interval: seconds to wait before reconnecting after a failure.
+    """
+
+    def __init__(self, local_cache, prefixes, health_check_interval=1.0,
+                 reconnect_interval=1.0, **connection_kwargs):
+        self.local_cache = local_cache
+        self.prefixes = list(prefixes)
+        self.health_check_interval = health_check_interval
+        self.reconnect_interval = reconnect_interval
+        self.connection_kwargs = connection_kwargs
+        self.stopped = threading.Event()
+        self.connected = threading.Event()
+        self.thread = None
+        self.invalidations = 0
+        self.reconnections = 0
+        self.last_error = None
+
+    def create_client(self, client_name=None, single_connection_client=True):
+        return redis.Redis(single_connection_client=single_connection_client,
+                           client_name=client_name, **self.connection_kwargs)
+
+    def start(self):
+        self.stopped.clear()
+        # nothing is cached until tracking is active
+        self.local_cache.set_enabled(False)
+        self.thread = threading.Thread(target=self.run, name='global-cache-invalidation')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.disconnected()
+
+    def wait_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except (redis.exceptions.RedisError, OSError) as error:
+                self.last_error = error
+            self.disconnected()
+            if not self.stopped.is_set():
+                self.reconnections += 1
+                self.stopped.wait(self.reconnect_interval)
+
+    def disconnected(self):
+        self.connected.clear()
+        self.local_cache.set_enabled(False)
+
+    def listen(self):
+        name = u'global-cache-invalidation-{0}'.format(uuid.uuid4().hex)
+        subscriber = self.create_client(client_name=name, single_connection_client=False)
+        tracker = self.create_client()
+        pubsub = subscriber.pubsub()
+        try:
+            pubsub.subscribe(invalidation_channel)
+            # invalidations are only delivered once the subscription is active
+            message = pubsub.get_message(timeout=self.health_check_interval * 10)
+            if message is None or message.get('type') != 'subscribe':
+                raise redis.exceptions.ConnectionError('Could not subscribe to the invalidation channel')
+            client_ids = [client.get('id') for client in tracker.client_list(_type='pubsub')
+                          if client.get('name') == name]
+            if not client_ids:
+                raise redis.exceptions.ConnectionError('The invalidation connection is not available')
+            tracker.client_tracking_on(clientid=client_ids[0], bcast=True, prefix=self.prefixes)
+            # values cached before tracking started may have been missed invalidations
+            self.local_cache.set_enabled(True)
+            self.connected.set()
+            next_check = monotonic() + self.health_check_interval
+            while not self.stopped.is_set():
+                message = pubsub.get_message(timeout=self.health_check_interval)
+                if message is not None and message.get('type') == 'message':
+                    self.handle_invalidation(message.get('data'))
+                if monotonic() >= next_check:
+                    self.check_tracking(tracker)
+                    next_check = monotonic() + self.health_check_interval
+        finally:
+            self.connected.clear()
+            pubsub.close()
+            subscriber.close()
+            tracker.close()
+
+    def check_tracking(self, tracker):
+        """
+        Tracking is bound to the tracker connection and redirected to the subscriber one,
+        if either of them was reconnected behind our back invalidations may have been lost.
+        """
+        info = tracker.execute_command('CLIENT', 'TRACKINGINFO')
+        info = {decode_binary_string(key): value for key, value in
+                (info.items() if isinstance(info, dict) else zip(info[::2], info[1::2]))}
+        flags = [decode_binary_string(flag) for flag in info.get('flags') or []]
+        if 'on' not in flags or 'broken_redirect' in flags:
+            raise redis.exceptions.ConnectionError('Client tracking was lost')
+
+    def handle_invalidation(self, keys):
+        """
+        :param keys: invalidated keys, None when the whole database was flushed.
+        """
+        self.invalidations += 1
+        if keys is None:
+            self.local_cache.clear()
+            return
+        keys = {True: lambda: [keys], False: lambda: keys}.get(isinstance(keys, (bytes, str)))()
+        for key in keys:
+            self.local_cache.invalidate(decode_binary_string(key))
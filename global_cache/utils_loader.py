@@ -0,0 +1,169 @@
+"""
+Read-through loading of the entities missing from the global cache.
+
+A loader is set per entity class, e.g.:
+
+    Variable.loader = ReadThroughLoader(lambda primary_key: Variable.objects.get(...), lock_timeout=2000)
+
+and is called by the entity reads when the hash of the entity doesn't exist. Concurrent
+misses of the same key in a process wait for a single load (single flight), with
+lock_timeout a short redis lock also makes a single process load the key.
+
+The loader also refreshes the stale values read by Entity.get_attribute_with_age,
+in background (stale-while-revalidate) or before returning them.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from global_cache.utils_global_cache import script_load
+
+release_lock_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1]);
+end
+return 0;
+"""
+release_lock = script_load(release_lock_script)
+
+
+class Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs a single call per key at a time, the callers arriving while it runs wait for
+    its result (or its exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, function):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+        else:
+            try:
+                flight.result = function()
+            except Exception as error:
+                flight.error = error
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+class ReadThroughLoader(object):
+    """
+    :param function: callable primary key -> stored object of the entity (the object passed
+    to the entity constructor to save it), None if it doesn't exist.
+    :param lock_timeout: milliseconds the redis lock of a key is held at most, None to only
+    deduplicate the loads of this process.
+    :param poll_interval: seconds between the checks of a key loaded by another process.
+    :param workers: threads refreshing the stale entities in background, see revalidate.
+    """
+
+    def __init__(self, function, lock_timeout=None, poll_interval=0.05, workers=2):
+        self.function = function
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.flights = SingleFlight()
+        self.loads = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        # hash keys being refreshed in background
+        self.revalidating = set()
+        self.last_error = None
+
+    def load(self, entity):
+        """
+        Loads the entity, saves it with save_optimized and returns its attribute values.
+        :return: dict attribute name -> value, None if the entity doesn't exist or it was
+        loaded by another process (then it can be read from redis).
+        """
+        return self.flights.do(entity.hash_key, lambda: self.load_entity(entity))
+
+    def reload(self, entity):
+        """
+        Loads and saves the entity again even if it is cached.
+        :return: same as load, None if another process is reloading it.
+        """
+        return self.flights.do(entity.hash_key, lambda: self.load_entity(entity, reload=True))
+
+    def revalidate(self, entity):
+        """
+        Reloads the entity in background, once at a time per key.
+        :return: future of the reload, None if the key is already being reloaded.
+        """
+        hash_key = entity.hash_key
+        with self.lock:
+            if hash_key in self.revalidating:
+                return None
+            self.revalidating.add(hash_key)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='global-cache-revalidation')
+        future = self.executor.submit(self.reload, entity)
+        future.add_done_callback(lambda done: self.revalidated(hash_key, done))
+        return future
+
+    def revalidated(self, hash_key, future):
+        with self.lock:
+            self.revalidating.discard(hash_key)
+        if future.exception() is not None:
+            self.last_error = future.exception()
+
+    def lock_key(self, entity):
+        return entity.entity_key('loading')
+
+    def load_entity(self, entity, reload=False):
+        if self.lock_timeout is None:
+            return self.load_and_save(entity)
+        connection = entity.connection
+        lock_key = self.lock_key(entity)
+        token = uuid.uuid4().hex
+        if connection.set(lock_key, token, nx=True, px=self.lock_timeout):
+            try:
+                return self.load_and_save(entity)
+            finally:
+                release_lock(connection, keys=[lock_key], args=[token])
+        deadline = monotonic() + self.lock_timeout / 1000.0
+        while (monotonic() < deadline and connection.exists(lock_key) and
+               (reload or not connection.exists(entity.hash_key))):
+            time.sleep(self.poll_interval)
+        if connection.exists(entity.hash_key):
+            return None
+        # the other process failed or timed out
+        return self.load_and_save(entity)
+
+    def load_and_save(self, entity):
+        stored_object = self.function(entity.primary_key)
+        self.loads += 1
+        if stored_object is None:
+            return None
+        loaded = type(entity)(stored_object, deployment=entity.deployment,
+                              primary_key=entity.primary_key, entity=entity.entity,
+                              primary_key_name=entity.primary_key_name,
+                              connection=entity.connection, codec=entity.codec,
+                              local_cache=entity.local_cache, hash_tags=entity.hash_tags,
+                              retention=entity.retention, replicas=entity.replicas, batched=False)
+        loaded.save_optimized()
+        return dict(loaded.attribute_values())
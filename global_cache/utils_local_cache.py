@@ -0,0 +1,125 @@
+"""
+Process local (L1) cache of the raw field values read from the global cache.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+missing = object()
+
+
+def value_size(value):
+    return len(value) if isinstance(value, (bytes, str)) else 0
+
+
+class LocalCache(object):
+    """
+    Bounded, thread safe LRU cache of hash fields. Entries are grouped by hash key so
+    every field of an entity can be invalidated at once.
+
+    :param max_entries: maximum number of cached fields, None for no limit.
+    :param max_bytes: maximum size of the cached keys and values, None for no limit.
+    :param default_ttl: seconds an entry lives, None to keep it until it is evicted.
+    :param ttls: dict entity name -> ttl overriding default_ttl for that entity type,
+    e.g. {'variable': 5, 'device': 30}.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, default_ttl=None, ttls=None,
+                 clock=monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = {} if ttls is None else ttls
+        self.clock = clock
+        self.lock = threading.RLock()
+        # (hash_key, field) -> (value, expiration time, size)
+        self.entries = OrderedDict()
+        # hash_key -> fields cached for it
+        self.fields = {}
+        self.size = 0
+        # a disabled cache misses every read and stores nothing, see utils_invalidation
+        self.enabled = True
+        # incremented by every invalidation, see set
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, entity):
+        return self.ttls.get(entity, self.default_ttl)
+
+    def get(self, hash_key, field, default=missing):
+        """
+        :return: the cached value (None is a valid cached value), default on a miss.
+        """
+        key = (hash_key, field)
+        with self.lock:
+            entry = self.entries.get(key) if self.enabled else None
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, hash_key, field, value, entity=None, version=None):
+        """
+        :param version: value of self.version read before the value was fetched from redis,
+        the value is not stored if an invalidation happened in between since it may be stale.
+        """
+        ttl = self.ttl_for(entity)
+        key = (hash_key, field)
+        size = value_size(hash_key) + value_size(field) + value_size(value)
+        with self.lock:
+            if not self.enabled or (version is not None and version != self.version):
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, None if ttl is None else self.clock() + ttl, size)
+            self.fields.setdefault(hash_key, set()).add(field)
+            self.size += size
+            while self.entries and (
+                    (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                    (self.max_bytes is not None and self.size > self.max_bytes)):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        value, expiration, size = self.entries.pop(key)
+        self.size -= size
+        fields = self.fields.get(key[0])
+        fields.discard(key[1])
+        if not fields:
+            del self.fields[key[0]]
+
+    def invalidate(self, hash_key):
+        """
+        Removes every cached field of hash_key.
+        """
+        with self.lock:
+            self.version += 1
+            for field in list(self.fields.get(hash_key, ())):
+                self.remove((hash_key, field))
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.fields.clear()
+            self.size = 0
+
+    def set_enabled(self, enabled):
+        """
+        Enables or disables the cache, the cached entries are dropped in both cases.
+        """
+        with self.lock:
+            self.clear()
+            self.enabled = enabled
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,95 @@
+"""
+Migration of the keys of a deployment to the redis cluster key layout of the entities
+with hash_tags: {deployment}:{entity}:{key type}:{{primary_key}}, the primary key being
+a hash tag every key of an entity (hash, label index, fingerprints) is in the same slot.
+
+The label hashes (pointer fields) and the label index sets (members) hold keys too, they
+are rewritten to the new layout. Run it before setting Entity.hash_tags = True, e.g. from
+a standalone redis to an empty cluster, then delete the source keys.
+
+The secondary index sets ({deployment}:{entity}:index:{attribute}:{value}) are shared by
+many entities, they keep their key and their members (primary keys) and are only copied
+to another target. Entities with hash_tags are not indexed by their saves (the index sets
+are in other cluster slots, see Entity.index_arguments): once migrated, find_by_index
+only finds the entities indexed before the migration.
+"""
+from global_cache.utils_dump import hash_type, read_records, unpack_records
+from global_cache.utils_global_cache import (
+    decode_binary_string, default_chunk_size, default_deployment, escape_pattern, hash_tag,
+    iterate_chunks, untag)
+
+
+def is_index_key(key):
+    """
+    :return: True for the keys of the secondary index sets, see index_key.
+    """
+    parts = decode_binary_string(key).split(':', 3)
+    return len(parts) == 4 and parts[2] == 'index'
+
+
+def tagged_key(key):
+    """
+    :return: the key with its primary key as hash tag, None if it is not an entity key, it
+    is already tagged or it is an index set (not tagged, see is_index_key).
+    """
+    parts = decode_binary_string(key).split(':', 3)
+    if len(parts) < 4 or untag(parts[3]) != parts[3] or is_index_key(key):
+        return None
+    return u'{0}:{1}:{2}:{3}'.format(parts[0], parts[1], parts[2], hash_tag(parts[3]))
+
+
+def migrated_items(key_type, key, items, pointer_fields):
+    """
+    :return: the items of a record with the keys they hold rewritten, see tagged_key.
+    """
+    key_type_name = decode_binary_string(key).split(':', 3)[2]
+    if key_type == hash_type and key_type_name == 'label':
+        fields = [decode_binary_string(field) for field in items[::2]]
+        values = [tagged_key(value) or value if field in pointer_fields else value
+                  for field, value in zip(fields, items[1::2])]
+        return [item for pair in zip(items[::2], values) for item in pair]
+    if key_type != hash_type and key_type_name == 'label_index':
+        return [tagged_key(member) or member for member in items]
+    return items
+
+
+def migrate_keys(source, target=None, deployment=default_deployment, delete=False,
+                 chunk_size=default_chunk_size, scan_count=None, pointer_fields=('id',)):
+    """
+    Copies every hash and set of the deployment to the hash tagged key layout, keeping
+    their ttl, with two pipelined reads and one pipelined write per chunk of keys. The
+    index sets are copied as they are to another target.
+    :param target: connection of the migrated keys (e.g. a cluster), source if None.
+    :param delete: delete the source keys once copied.
+    :param pointer_fields: fields of the label hashes holding the key of their entity.
+    :return: dict with the number of keys migrated and skipped (already tagged, not
+    entity keys or index sets kept in source).
+    """
+    copy_indexes = target is not None and target is not source
+    target = source if target is None else target
+    stats = {'keys': 0, 'skipped': 0}
+    keys = source.scan_iter(match=u'{0}:*'.format(escape_pattern(deployment)), count=scan_count)
+    for chunk in iterate_chunks(keys, chunk_size):
+        pending = [key for key in chunk
+                   if tagged_key(key) is not None or (copy_indexes and is_index_key(key))]
+        stats['skipped'] += len(chunk) - len(pending)
+        if not pending:
+            continue
+        pipeline = target.pipeline(transaction=False)
+        migrated = []
+        for key_type, key, pttl, items in unpack_records(b''.join(read_records(source, pending))):
+            new_key = tagged_key(key) or key
+            items = migrated_items(key_type, key, items, pointer_fields)
+            pipeline.delete(new_key)
+            if key_type == hash_type:
+                pipeline.hset(new_key, mapping=dict(zip(items[::2], items[1::2])))
+            else:
+                pipeline.sadd(new_key, *items)
+            if pttl > 0:
+                pipeline.pexpire(new_key, pttl)
+            migrated.append(key)
+        pipeline.execute()
+        if delete and migrated:
+            source.delete(*migrated)
+        stats['keys'] += len(migrated)
+    return stats
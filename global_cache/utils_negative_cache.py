@@ -0,0 +1,228 @@
+"""
+Negative caching of the label lookups, for devices sending data to labels that don't
+exist (yet).
+
+A label read as missing (VariableByLabel, DeviceByLabel) is remembered by the
+NegativeCache of EntityByLabel.negative_cache for a few seconds, the reads of that label
+return nothing without round trip until it expires or the label is saved by this
+process. Labels created by other processes are seen once the entry expires.
+
+EntityByLabel.label_filter holds an optional Bloom filter of the label keys of a
+deployment, labels it rejects are known to be absent without round trip either. Every
+label saved is added to the filter before it is written, the labels stored before the
+filter was set are added with fill_label_filter. BloomFilter only knows the labels of
+its process, with several processes writing labels use RedisBloomFilter:
+
+    EntityByLabel.negative_cache = NegativeCache(ttl=5)
+    EntityByLabel.label_filter = RedisBloomFilter(connection, deployment='INDUSTRIAL')
+    fill_label_filter(EntityByLabel.label_filter, connection)
+"""
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from global_cache.utils_global_cache import (
+    default_chunk_size, default_deployment, escape_pattern, iterate_chunks, key_prefix)
+
+
+class NegativeCache(object):
+    """
+    Bounded, thread safe set of the missing keys, every key is forgotten ttl seconds after
+    it was added.
+
+    :param ttl: seconds a key is known to be missing.
+    :param max_entries: maximum number of keys, the oldest are forgotten first.
+    """
+
+    def __init__(self, ttl=5.0, max_entries=100000, clock=monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> expiration time, in expiration order
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = self.clock() + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def contains(self, key):
+        with self.lock:
+            now = self.clock()
+            while self.entries and next(iter(self.entries.values())) <= now:
+                self.entries.popitem(last=False)
+            found = key in self.entries
+            self.hits += found
+            self.misses += not found
+            return found
+
+    def discard(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def filter_size(capacity, error_rate):
+    """
+    :return: (number of bits, number of hash functions) of a Bloom filter holding capacity
+    keys with a false positive rate of error_rate.
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return bits, max(1, int(round(bits / float(capacity) * math.log(2))))
+
+
+class BloomFilter(object):
+    """
+    Process local Bloom filter of keys: might_contain is False only for keys never added,
+    True for the added keys and for error_rate of the others.
+
+    The filter is never reloaded, it only knows the labels saved by this process (and the
+    ones added by fill_label_filter): use it only when every label of the deployment is
+    written by this process (single writer), labels saved by other processes would be
+    rejected forever. With several writers use RedisBloomFilter.
+
+    :param capacity: number of keys expected.
+    :param error_rate: false positive rate at capacity keys.
+    :param deployment: deployment of the label keys filtered, see EntityByLabel.known_absent.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001, deployment=default_deployment):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.deployment = deployment
+        self.size, self.hash_count = filter_size(capacity, error_rate)
+        self.lock = threading.Lock()
+        # bit n is the bit 7 - n % 8 of byte n // 8, as the redis bitmaps (SETBIT, GET)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.rejected = 0
+
+    def offsets(self, key):
+        """
+        :return: bits of key, the same in every process (double hashing of its blake2b digest).
+        """
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def has_bits(self, offsets):
+        return all(self.bits[offset >> 3] & (0x80 >> (offset & 7)) for offset in offsets)
+
+    def set_bits(self, offsets):
+        with self.lock:
+            for offset in offsets:
+                self.bits[offset >> 3] |= 0x80 >> (offset & 7)
+
+    def add(self, *keys):
+        for key in keys:
+            self.set_bits(self.offsets(key))
+
+    def might_contain(self, key):
+        found = self.has_bits(self.offsets(key))
+        self.rejected += not found
+        return found
+
+    def stats(self):
+        with self.lock:
+            filled = sum(bin(byte).count('1') for byte in self.bits)
+        return {'bits': self.size, 'hash_count': self.hash_count, 'filled_bits': filled,
+                'rejected': self.rejected}
+
+
+class RedisBloomFilter(BloomFilter):
+    """
+    Bloom filter shared by every process through a redis bitmap. The keys are added to the
+    bitmap (SETBIT, one pipelined round trip) and the lookups read a local copy of it,
+    reloaded (GET) every refresh_interval seconds: a key added by another process may be
+    rejected until the next reload, as long as a NegativeCache entry lives.
+
+    :param key: key of the bitmap, {deployment}:label_filter by default.
+    :param refresh_interval: seconds between the reloads of the local copy, 0 to read the
+    bits from redis on every lookup.
+    """
+
+    def __init__(self, connection, capacity=1000000, error_rate=0.001, deployment=default_deployment,
+                 key=None, refresh_interval=1.0, clock=monotonic):
+        super(RedisBloomFilter, self).__init__(capacity, error_rate, deployment)
+        self.connection = connection
+        self.key = u'{0}:label_filter'.format(deployment) if key is None else key
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.refreshed_at = None
+        self.refreshes = 0
+
+    def add(self, *keys):
+        # the bits are written to redis first, the local copy is always a subset of them
+        # and the keys whose bits are already set locally don't need a write
+        offsets = [offsets for offsets in map(self.offsets, keys) if not self.has_bits(offsets)]
+        if not offsets:
+            return
+        pipeline = self.connection.pipeline(transaction=False)
+        for offset in sorted(set(offset for key_offsets in offsets for offset in key_offsets)):
+            pipeline.setbit(self.key, offset, 1)
+        pipeline.execute()
+        for key_offsets in offsets:
+            self.set_bits(key_offsets)
+
+    def might_contain(self, key):
+        offsets = self.offsets(key)
+        if not self.refresh_interval:
+            pipeline = self.connection.pipeline(transaction=False)
+            for offset in offsets:
+                pipeline.getbit(self.key, offset)
+            found = all(pipeline.execute())
+            self.rejected += not found
+            return found
+        if not self.has_bits(offsets) and (
+                self.refreshed_at is None or self.clock() - self.refreshed_at >= self.refresh_interval):
+            self.refresh()
+        return super(RedisBloomFilter, self).might_contain(key)
+
+    def refresh(self):
+        """
+        Reloads the local copy of the bitmap.
+        """
+        bits = bytearray(self.connection.get(self.key) or b'')[:len(self.bits)]
+        bits += bytearray(len(self.bits) - len(bits))
+        with self.lock:
+            self.bits = bits
+            self.refreshed_at = self.clock()
+            self.refreshes += 1
+
+    def stats(self):
+        stats = super(RedisBloomFilter, self).stats()
+        stats['refreshes'] = self.refreshes
+        return stats
+
+
+def fill_label_filter(label_filter, connection, entities=('variable', 'device'),
+                      chunk_size=default_chunk_size, scan_count=None):
+    """
+    Adds the label keys stored in the deployment of label_filter, run it before setting
+    EntityByLabel.label_filter.
+    :param entities: entity names of the labels.
+    :return: number of label keys added.
+    """
+    added = 0
+    for entity in entities:
+        prefix = key_prefix(label_filter.deployment, entity, 'label')
+        keys = connection.scan_iter(match=escape_pattern(prefix) + '*', count=scan_count)
+        for chunk in iterate_chunks(keys, chunk_size):
+            label_filter.add(*chunk)
+            added += len(chunk)
+    return added
@@ -0,0 +1,79 @@
+"""
+Routing of the global cache reads to the replicas of the replicated redis topology.
+
+An entity with replicas (Entity.replicas, or the replicas argument of its constructor)
+keeps writing to its connection (the primary) and sends its reads to the replicas,
+round robin. The keys written by this process are read from the primary for
+read_your_writes seconds, covering the replication lag, so a process always reads
+its own writes. The reads following the label -> entity pointers go to the primary
+while any key is pinned, the key of the entity is only known after the read.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class ReplicaSet(object):
+    """
+    :param replicas: redis connections (or pools based clients) of the replicas.
+    :param read_your_writes: seconds the reads of a key written by this process are sent
+    to the primary, 0 to always read from the replicas.
+    :param read_only_scripts: run the read scripts with EVALSHA_RO on the replicas
+    (redis >= 7), False to use EVALSHA.
+    :param max_pinned_keys: maximum number of written keys remembered, the oldest are
+    forgotten first.
+    """
+
+    def __init__(self, replicas, read_your_writes=1.0, read_only_scripts=True,
+                 max_pinned_keys=100000, clock=monotonic):
+        self.replicas = list(replicas)
+        self.read_your_writes = read_your_writes
+        self.read_only_scripts = read_only_scripts
+        self.max_pinned_keys = max_pinned_keys
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.next_replica = itertools.cycle(self.replicas)
+        # key -> time until which its reads go to the primary, in expiration order
+        self.pinned_keys = OrderedDict()
+        self.primary_reads = 0
+        self.replica_reads = 0
+
+    def written(self, *keys):
+        """
+        Pins the reads of keys to the primary for read_your_writes seconds.
+        """
+        if not self.read_your_writes or not self.replicas:
+            return
+        with self.lock:
+            expiration = self.clock() + self.read_your_writes
+            for key in keys:
+                self.pinned_keys.pop(key, None)
+                self.pinned_keys[key] = expiration
+            while len(self.pinned_keys) > self.max_pinned_keys:
+                self.pinned_keys.popitem(last=False)
+
+    def connection_for(self, primary, keys=(), follows_pointers=False):
+        """
+        :param primary: connection of the writes.
+        :param keys: keys read, the read goes to the primary if any of them is pinned.
+        :param follows_pointers: the read also reads the keys stored in keys (label -> entity),
+        unknown before the read, it goes to the primary while any key is pinned.
+        :return: (connection, True if it is a replica).
+        """
+        with self.lock:
+            now = self.clock()
+            while self.pinned_keys and next(iter(self.pinned_keys.values())) <= now:
+                self.pinned_keys.popitem(last=False)
+            pinned = self.pinned_keys and (
+                follows_pointers or any(key in self.pinned_keys for key in keys))
+            if not self.replicas or pinned:
+                self.primary_reads += 1
+                return primary, False
+            self.replica_reads += 1
+            return next(self.next_replica), True
+
+    def stats(self):
+        with self.lock:
+            return {'primary_reads': self.primary_reads, 'replica_reads': self.replica_reads,
+                    'pinned_keys': len(self.pinned_keys)}
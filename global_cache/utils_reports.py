@@ -0,0 +1,123 @@
+"""
+Estimation of the memory used by the global cache per entity type, to size the retention
+of the entities (see utils_retention).
+
+The keys of a deployment are counted with SCAN and a uniform sample of every entity and
+key type is measured with MEMORY USAGE, the totals are extrapolated from the sample:
+
+    python -m global_cache.utils_reports --host 127.0.0.1 --deployment INDUSTRIAL
+"""
+import argparse
+import random
+
+from redis import Redis
+
+from global_cache.utils_global_cache import (
+    decode_binary_string, default_chunk_size, default_deployment, escape_pattern, iterate_chunks)
+
+
+def key_group(key):
+    """
+    :return: (entity, key type) of a key, e.g. ('variable', 'label') for
+    INDUSTRIAL:variable:label:owner:device:temperature, key type 'other' for the keys out
+    of the entity layout.
+    """
+    parts = decode_binary_string(key).split(':', 3)
+    if len(parts) < 4:
+        return parts[-1] if len(parts) > 1 else '', 'other'
+    return parts[1], parts[2]
+
+
+def sample_keys(connection, deployment=default_deployment, sample_size=1000, scan_count=None,
+                generator=None):
+    """
+    Counts the keys of every group (see key_group) and keeps a uniform sample of at most
+    sample_size keys per group (reservoir sampling), in one SCAN pass.
+    :return: dict group -> (number of keys, sampled keys).
+    """
+    generator = random.Random() if generator is None else generator
+    groups = {}
+    for key in connection.scan_iter(match=u'{0}:*'.format(escape_pattern(deployment)), count=scan_count):
+        count, sample = groups.get(key_group(key), (0, []))
+        count += 1
+        if len(sample) < sample_size:
+            sample.append(key)
+        else:
+            position = generator.randrange(count)
+            if position < sample_size:
+                sample[position] = key
+        groups[key_group(key)] = (count, sample)
+    return groups
+
+
+def memory_report(connection, deployment=default_deployment, sample_size=1000, memory_samples=None,
+                  chunk_size=default_chunk_size, scan_count=None, generator=None):
+    """
+    Estimates the memory used by the keys of a deployment per entity and key type, the
+    sampled keys are measured with pipelined MEMORY USAGE and PTTL calls.
+    :param memory_samples: SAMPLES option of MEMORY USAGE (nested values measured per key),
+    the server default if None.
+    :return: dict (entity, key type) -> dict with the number of keys, of sampled keys, the
+    mean and estimated total bytes and the estimated number of keys without expiration.
+    """
+    report = {}
+    for group, (count, sample) in sorted(sample_keys(connection, deployment, sample_size, scan_count,
+                                                     generator).items()):
+        sizes, persistent = [], 0
+        for chunk in iterate_chunks(sample, chunk_size):
+            pipeline = connection.pipeline(transaction=False)
+            for key in chunk:
+                pipeline.memory_usage(key, samples=memory_samples)
+                pipeline.pttl(key)
+            results = pipeline.execute()
+            # keys expired or deleted since the scan are not measured
+            for size, pttl in zip(results[::2], results[1::2]):
+                if size is not None and pttl != -2:
+                    sizes.append(size)
+                    persistent += pttl == -1
+        mean = float(sum(sizes)) / len(sizes) if sizes else 0.0
+        without_ttl = int(round(float(persistent) / len(sizes) * count)) if sizes else 0
+        report[group] = {'keys': count, 'sampled': len(sizes), 'mean_bytes': mean,
+                         'estimated_bytes': int(mean * count), 'without_ttl': without_ttl}
+    return report
+
+
+def entity_totals(report):
+    """
+    :return: dict entity -> estimated bytes of all its keys, from a memory_report.
+    """
+    totals = {}
+    for (entity, key_type), row in report.items():
+        totals[entity] = totals.get(entity, 0) + row['estimated_bytes']
+    return totals
+
+
+def format_report(report):
+    """
+    :return: text table of a memory_report, biggest groups first.
+    """
+    lines = [u'{0:<20} {1:<14} {2:>10} {3:>8} {4:>10} {5:>14} {6:>12}'.format(
+        'entity', 'key type', 'keys', 'sampled', 'mean', 'estimated', 'without ttl')]
+    for (entity, key_type), row in sorted(report.items(), key=lambda item: -item[1]['estimated_bytes']):
+        lines.append(u'{0:<20} {1:<14} {2:>10} {3:>8} {4:>10.1f} {5:>14} {6:>12}'.format(
+            entity, key_type, row['keys'], row['sampled'], row['mean_bytes'], row['estimated_bytes'],
+            row['without_ttl']))
+    for entity, total in sorted(entity_totals(report).items(), key=lambda item: -item[1]):
+        lines.append(u'total {0:<14} {1:>14}'.format(entity, total))
+    return u'\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--deployment', default=default_deployment)
+    parser.add_argument('--sample-size', type=int, default=1000)
+    arguments = parser.parse_args()
+    connection = Redis(host=arguments.host, port=arguments.port, db=arguments.db)
+    print(format_report(memory_report(connection, arguments.deployment, arguments.sample_size)))
+
+
+if __name__ == '__main__':
+    main()
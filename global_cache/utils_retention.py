@@ -0,0 +1,73 @@
+"""
+Retention of the cached entities: the keys of an entity type expire ttl seconds after
+the entity was last saved, so the hashes of deleted or dormant devices don't stay in
+redis forever.
+
+An entity with retention (Entity.retention, or the retention argument of its
+constructor) sends the ttl to the save scripts, they expire, atomically with the write,
+the hash of the entity, its fingerprints, label index, index entries and label keys (the
+labels expire with the entity they point to). The secondary index sets are shared by the
+entities of a type, their ttl is only extended, so they expire with their last member,
+and the members whose entity expired are removed when the index is read
+(Entity.live_index_members).
+Variable.touch extends the ttl of the variable and of its device.
+
+With sliding expiration the reads through an entity extend its ttl too, at most once per
+refresh_interval per key:
+
+    Variable.retention = RetentionPolicy(ttl=30 * 86400, sliding=True)
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class RetentionPolicy(object):
+    """
+    :param ttl: seconds the keys of an entity live after its last save (or read, if sliding).
+    :param sliding: the reads extend the ttl (sliding expiration).
+    :param refresh_interval: seconds between two extensions of the ttl of a key by the reads
+    of this process, a tenth of ttl by default.
+    :param max_tracked_keys: maximum number of keys whose last extension is remembered, the
+    oldest are forgotten first.
+    """
+
+    def __init__(self, ttl, sliding=False, refresh_interval=None, max_tracked_keys=100000,
+                 clock=monotonic):
+        self.ttl = ttl
+        self.sliding = sliding
+        self.refresh_interval = ttl / 10.0 if refresh_interval is None else refresh_interval
+        self.max_tracked_keys = max_tracked_keys
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> time of its next extension, in extension order
+        self.next_refresh = OrderedDict()
+        self.refreshes = 0
+
+    @property
+    def ttl_ms(self):
+        return int(self.ttl * 1000)
+
+    def due(self, key):
+        """
+        :return: True if the ttl of key must be extended by a read, the extension is
+        recorded.
+        """
+        if not self.sliding:
+            return False
+        with self.lock:
+            now = self.clock()
+            while self.next_refresh and next(iter(self.next_refresh.values())) <= now:
+                self.next_refresh.popitem(last=False)
+            if key in self.next_refresh:
+                return False
+            self.next_refresh[key] = now + self.refresh_interval
+            while len(self.next_refresh) > self.max_tracked_keys:
+                self.next_refresh.popitem(last=False)
+            self.refreshes += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'ttl': self.ttl, 'sliding': self.sliding, 'refreshes': self.refreshes,
+                    'tracked_keys': len(self.next_refresh)}
@@ -0,0 +1,207 @@
+"""
+Write-behind buffer of the entity saves, for entities updated in bursts where only the
+last value of every attribute matters.
+
+An entity with write_behind (Entity.write_behind, or the write_behind argument of its
+constructor) buffers its save and save_attribute calls instead of writing them. The
+buffer keeps, per hash key and field, the value with the newest updated_timestamp and
+writes the pending hashes in pipelined batches, with the usual save scripts (last
+writer wins), when max_pending fields are buffered or every flush_interval seconds.
+Reads don't see the buffered values until they are flushed.
+"""
+import atexit
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from global_cache.utils_global_cache import default_chunk_size, filter_labels, run_saves
+
+
+class PendingWrite(object):
+    __slots__ = ('entity', 'fields', 'labels')
+
+    def __init__(self, entity):
+        self.entity = entity
+        # field -> (timestamp, encoded value)
+        self.fields = OrderedDict()
+        self.labels = None
+
+
+class WriteBehindBuffer(object):
+    """
+    :param max_pending: number of buffered fields triggering a flush.
+    :param flush_interval: seconds between the flushes of the background thread, see start.
+    Without background thread the buffer is flushed by the save reaching max_pending or
+    by flush().
+    :param chunk_size: script calls sent per pipeline.
+    """
+
+    def __init__(self, max_pending=1000, flush_interval=0.05, chunk_size=default_chunk_size,
+                 clock=monotonic):
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.clock = clock
+        self.lock = threading.Condition()
+        # a single flush writes at a time, so an older batch never overtakes a newer one
+        self.flush_lock = threading.Lock()
+        # hash key -> PendingWrite
+        self.pending = OrderedDict()
+        self.pending_fields = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.added = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_fields = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0.0
+        self.errors = 0
+        self.last_error = None
+
+    def add(self, entity, fields, labels=None):
+        """
+        Buffers a save of entity.
+        :param fields: list of (attribute name, encoded value, timestamp).
+        :param labels: label entities saved with the entity, None to keep those of the
+        pending save.
+        """
+        with self.lock:
+            self.added += len(fields)
+            self.merge(entity, fields, labels)
+            full = self.pending_fields >= self.max_pending
+            if full:
+                self.lock.notify()
+        entity.record = None
+        if full and self.thread is None:
+            self.flush()
+
+    def merge(self, entity, fields, labels):
+        write = self.pending.get(entity.hash_key)
+        if write is None:
+            write = self.pending[entity.hash_key] = PendingWrite(entity)
+        write.entity = entity
+        for attribute_name, value, timestamp in fields:
+            current = write.fields.get(attribute_name)
+            if current is None:
+                self.pending_fields += 1
+            else:
+                self.coalesced += 1
+                if timestamp is not None and current[0] is not None and timestamp < current[0]:
+                    continue
+            write.fields[attribute_name] = (timestamp, value)
+        if labels is not None:
+            write.labels = labels
+
+    def requeue(self, failed):
+        """
+        Buffers again a failed write: only its fields absent from the pending saves or strictly
+        older there, the values buffered meanwhile (equal timestamps included) are kept. The
+        fields are not counted as coalesced again.
+        """
+        write = self.pending.get(failed.entity.hash_key)
+        if write is None:
+            write = self.pending[failed.entity.hash_key] = PendingWrite(failed.entity)
+            write.labels = failed.labels
+        for attribute_name, (timestamp, value) in failed.fields.items():
+            current = write.fields.get(attribute_name)
+            if current is None:
+                self.pending_fields += 1
+            elif timestamp is None or current[0] is None or current[0] >= timestamp:
+                continue
+            write.fields[attribute_name] = (timestamp, value)
+        if write.labels is None:
+            write.labels = failed.labels
+
+    def flush(self):
+        """
+        Writes every buffered field, the batch is buffered again if the write fails.
+        :return: number of fields written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                count, self.pending_fields = self.pending_fields, 0
+            if not pending:
+                return 0
+            started = self.clock()
+            try:
+                self.write(list(pending.values()))
+            except Exception as error:
+                with self.lock:
+                    self.errors += 1
+                    self.last_error = error
+                    for write in pending.values():
+                        self.requeue(write)
+                raise
+            latency = self.clock() - started
+            with self.lock:
+                self.flushes += 1
+                self.flushed_fields += count
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+            return count
+
+    def write(self, writes):
+        by_connection = OrderedDict()
+        for write in writes:
+            by_connection.setdefault(id(write.entity.connection), []).append(write)
+        for writes in by_connection.values():
+            saves = []
+            for write in writes:
+                entity, labels = write.entity, write.labels or []
+                names = list(write.fields)
+                arguments = ([entity.hash_key] + names, [write.fields[name][1] for name in names])
+                saves.append((entity, labels, entity.save_calls(labels=labels, arguments=arguments)))
+            filter_labels([label for entity, labels, calls in saves for label in labels])
+            for entity, labels, calls in saves:
+                entity.saved(labels)
+            results = run_saves(writes[0].entity.connection, saves, self.chunk_size)
+            for (entity, labels, calls), result in zip(saves, results):
+                entity.saved(labels, result)
+
+    def start(self):
+        """
+        Starts the background flushes, the buffer is flushed at exit. Does nothing if they
+        are already running.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return self
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='global-cache-write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.pending_fields >= self.max_pending or self.stopped.is_set(),
+                    timeout=self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # recorded by flush, the batch is retried by the next flush
+                self.stopped.wait(self.flush_interval)
+
+    def stop(self, timeout=None):
+        """
+        Stops the background flushes and writes the buffered fields.
+        """
+        self.stopped.set()
+        with self.lock:
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+            atexit.unregister(self.stop)
+        return self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'pending_fields': self.pending_fields, 'pending_keys': len(self.pending),
+                    'added': self.added, 'coalesced': self.coalesced, 'flushes': self.flushes,
+                    'flushed_fields': self.flushed_fields, 'last_flush_latency': self.last_flush_latency,
+                    'max_flush_latency': self.max_flush_latency, 'errors': self.errors}
@@ -8,4 +8,5 @@ setup(name='ubidots_global_cache',
       author_email='jdaaa2009@gmail.com',
       license='MIT',
       packages=['global_cache', 'global_messaging'],
-      zip_safe=False, install_requires=['redis', 'stomp.py', 'aerospike'])
+      zip_safe=False, python_requires='>=3', install_requires=['redis', 'stomp.py', 'aerospike'],
+      extras_require={'msgpack': ['msgpack']})
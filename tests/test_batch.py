@@ -0,0 +1,70 @@
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from tests import utils_redis
+from global_cache import utils_batch
+from global_cache import utils_global_cache
+
+redis_connection = get_redis_connection()
+
+
+class TestEntityBatch(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.device = factories.create_device()
+        self.variables = []
+        for index in range(10):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.device
+            self.variables.append(variable)
+        utils_global_cache.Variable.save_many(self.variables, connection=redis_connection)
+        utils_global_cache.Device(self.device, connection=redis_connection).save()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def test_entity_batch(self):
+        connection = utils_redis.ReplicaConnection(redis_connection)
+        with utils_batch.entity_batch() as batch:
+            variables = [utils_global_cache.Variable(primary_key=variable.id, connection=connection)
+                         for variable in self.variables]
+            labels = [utils_global_cache.VariableByLabel(variable=variable, connection=connection)
+                      for variable in self.variables]
+            missing = utils_global_cache.Variable(primary_key='missing', connection=connection)
+            device = utils_global_cache.Device(primary_key=self.device.id, connection=connection)
+            self.assertEqual(batch.stats()['pending'], 22)
+            self.assertEqual([variable.name for variable in variables], [v.name for v in self.variables])
+            self.assertEqual([label.label for label in labels], [v.label for v in self.variables])
+            self.assertEqual(device.name, self.device.name)
+            self.assertIsNone(missing.name)
+            self.assertEqual(batch.stats(), {'pending': 0, 'round_trips': 2, 'loaded': 21})
+            # one pipeline of HGETALL and one label script, then the read of the missing entity
+            self.assertEqual([command for command in connection.commands if command != 'SCRIPT'],
+                             ['HGETALL'] * 12 + ['EVALSHA', 'HGET'])
+            # entities created later are collected by the next round trip
+            other = utils_global_cache.Variable(primary_key=self.variables[0].id, connection=connection)
+            self.assertEqual(other.unit, self.variables[0].unit)
+            self.assertEqual(batch.stats()['round_trips'], 3)
+        self.assertIsNone(utils_global_cache.Variable(primary_key='x', connection=connection).batch)
+
+    def test_internal_entities(self):
+        # only the entities read by the caller are collected, not the ones built internally
+        with utils_batch.entity_batch() as batch:
+            variable = utils_global_cache.Variable(primary_key=self.variables[0].id,
+                                                   connection=redis_connection)
+            device = utils_global_cache.Device(primary_key=self.device.id, connection=redis_connection)
+            data = utils_global_cache.Variable.get_many([self.variables[1].id],
+                                                        connection=redis_connection)
+            self.assertEqual(data[self.variables[1].id]['name']['value'], self.variables[1].name)
+            utils_global_cache.Variable.find_by_tags(all_of=['a'], connection=redis_connection)
+            self.assertEqual(len(device.get_variables()), 10)
+            label_key = '{0}:{1}:{2}'.format(self.device.owner_id, self.device.label,
+                                             self.variables[2].label)
+            self.assertIsNotNone(utils_global_cache.VariableByLabel.resolve_many(
+                [label_key], connection=redis_connection)[label_key])
+            utils_global_cache.Variable(self.variables[3], connection=redis_connection).label_entities()
+            self.assertEqual(batch.stats()['pending'], 2)
+            self.assertEqual(variable.name, self.variables[0].name)
+            self.assertEqual(batch.stats(), {'pending': 0, 'round_trips': 1, 'loaded': 2})
@@ -0,0 +1,57 @@
+import json
+import unittest
+from global_cache import utils_codec
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.values = [None, 12, 1.5, 'ñandú', ['a', 'b'], {'lat': 12.98, 'lng': -199.029},
+                       {'value': 21.12, 'context': {'nested': [1, 2, {'a': True}]}}]
+        self.timestamp = 1700000000123
+
+    def assert_round_trip(self, codec):
+        for value in self.values:
+            encoded = codec.encode(value, self.timestamp)
+            self.assertEqual(utils_codec.decode_field(encoded),
+                             {'value': value, 'updated_timestamp': self.timestamp})
+        self.assertEqual(utils_codec.decode_field(codec.encode(1, None)),
+                         {'value': 1, 'updated_timestamp': None})
+
+    def test_json_codec(self):
+        codec = utils_codec.JsonCodec()
+        self.assert_round_trip(codec)
+        self.assertEqual(json.loads(codec.encode('a', self.timestamp)),
+                         {'value': 'a', 'updated_timestamp': self.timestamp})
+
+    def test_msgpack_codec(self):
+        if utils_codec.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        codec = utils_codec.MsgpackCodec()
+        self.assert_round_trip(codec)
+        value = self.values[-1]
+        self.assertLess(len(codec.encode(value, self.timestamp)),
+                        len(utils_codec.JsonCodec().encode(value, self.timestamp)))
+
+    def test_compressed_codec(self):
+        codec = utils_codec.CompressedCodec(threshold=64)
+        self.assert_round_trip(codec)
+        value = {'properties': ['x' * 10] * 100}
+        encoded = codec.encode(value, self.timestamp)
+        self.assertEqual(bytearray(encoded[:1])[0],
+                         utils_codec.JsonCodec.marker | utils_codec.compressed_flag)
+        self.assertLess(len(encoded), len(json.dumps(value)))
+        self.assertEqual(utils_codec.decode_field(encoded)['value'], value)
+        if utils_codec.msgpack is not None:
+            self.assert_round_trip(utils_codec.CompressedCodec(utils_codec.MsgpackCodec(), threshold=16))
+        # the compressed codecs wrap like any other codec
+        self.assertEqual(codec.decode_value(codec.encode_value(value)), value)
+        self.assert_round_trip(utils_codec.CompressedCodec(codec, threshold=32))
+
+    def test_decode_legacy_fields(self):
+        envelope = json.dumps({'value': [1, 2], 'updated_timestamp': self.timestamp})
+        expected = {'value': [1, 2], 'updated_timestamp': self.timestamp}
+        self.assertEqual(utils_codec.decode_field(envelope), expected)
+        self.assertEqual(utils_codec.decode_field(envelope.encode('utf-8')), expected)
+        self.assertEqual(utils_codec.decode_field(json.dumps(envelope).encode('utf-8')), expected)
+        for value in (None, b'', b'plain', b'\x7f12:abc', b'\x11:not zlib', b'5'):
+            self.assertIsNone(utils_codec.decode_field(value))
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from global_cache import utils_dump
+from global_cache import utils_global_cache
+
+redis_connection = get_redis_connection()
+
+
+class TestDump(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.device = factories.create_device()
+        self.variables = []
+        for index in range(30):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.device
+            self.variables.append(variable)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'global_cache.dump')
+
+    def tearDown(self):
+        redis_connection.flushdb()
+        self.directory.cleanup()
+
+    def test_dump_restore(self):
+        utils_global_cache.Variable.save_many(self.variables, connection=redis_connection)
+        utils_global_cache.Device(self.device, connection=redis_connection).save()
+        utils_global_cache.Variable(primary_key='other', deployment='OTHER',
+                                    connection=redis_connection).save()
+        redis_connection.pexpire(utils_global_cache.Device(self.device).hash_key, 100000)
+        keys = {key: redis_connection.type(key) for key in redis_connection.keys('INDUSTRIAL:*')}
+        values = {key: redis_connection.hgetall(key) for key in keys if keys[key] == b'hash'}
+        stats = utils_dump.dump(redis_connection, self.path, chunk_size=7)
+        self.assertEqual(stats['keys'], len(keys))
+        self.assertEqual(stats['chunks'], -(-len(keys) // 7))
+        redis_connection.flushdb()
+        stats = utils_dump.restore(redis_connection, self.path, workers=2)
+        self.assertEqual(stats['keys'], len(keys))
+        self.assertEqual(set(redis_connection.keys('*')), set(keys))
+        for key in values:
+            self.assertEqual(redis_connection.hgetall(key), values[key])
+        self.assertGreater(redis_connection.pttl(utils_global_cache.Device(self.device).hash_key), 0)
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variables[3], connection=redis_connection)
+        self.assertEqual(variable_by_label_cache.name, self.variables[3].name)
+
+    def test_corrupted_dump(self):
+        utils_global_cache.Variable.save_many(self.variables, connection=redis_connection)
+        utils_dump.dump(redis_connection, self.path)
+        with open(self.path, 'r+b') as dump_file:
+            dump_file.seek(-10, os.SEEK_END)
+            dump_file.write(b'corrupted!')
+        with self.assertRaises(ValueError):
+            utils_dump.restore(redis_connection, self.path)
+        with open(self.path, 'wb') as dump_file:
+            dump_file.write(b'nothing')
+        with self.assertRaises(ValueError):
+            utils_dump.restore(redis_connection, self.path)
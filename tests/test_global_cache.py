@@ -1,7 +1,12 @@
+import json
 import unittest
+from redis.exceptions import ResponseError
 from tests.factories import get_redis_connection
 from tests import factories
+from tests import utils_redis
+from global_cache import utils_codec
 from global_cache import utils_global_cache
+from global_cache import utils_local_cache
 
 redis_connection = get_redis_connection()
 
@@ -141,3 +146,553 @@ class TestVariableEntity(unittest.TestCase):
         for attribute in user_cache.attributes:
             self.assertEqual(getattr(user_cache, attribute),
                              None)
+
+    def test_get_attributes(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        variable_cache.save()
+        names = ['name', 'unit', 'last_value', 'missing']
+        data = variable_cache.get_attributes(names)
+        self.assertEqual(data, {'name': self.variable.name, 'unit': self.variable.unit,
+                                'last_value': self.variable.last_value, 'missing': None})
+        self.assertEqual(variable_cache.get_attributes([]), {})
+        variable_cache = utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection).fetch('name', 'unit')
+        redis_connection.hdel(variable_cache.hash_key, 'name', 'unit')
+        self.assertEqual(variable_cache.name, self.variable.name)
+        self.assertEqual(variable_cache.unit, self.variable.unit)
+        self.assertEqual(variable_cache.label, self.variable.label)
+        variable_cache.delete()
+        self.assertIsNone(variable_cache.name)
+
+    def test_snapshot(self):
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection)
+        variable_by_label_cache.save()
+        variable_cache = utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection, snapshot=True)
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).load()
+        redis_connection.hset(variable_cache.hash_key, 'name', variable_cache.encode_attribute('new'))
+        redis_connection.hdel(variable_cache.hash_key, 'unit')
+        for entity_cache in (variable_cache, variable_by_label_cache):
+            self.assertEqual(entity_cache.name, self.variable.name)
+            self.assertEqual(entity_cache.unit, self.variable.unit)
+            self.assertEqual(entity_cache.last_value, self.variable.last_value)
+            entity_cache.refresh()
+            self.assertEqual(entity_cache.name, 'new')
+            self.assertIsNone(entity_cache.unit)
+        variable_cache.delete()
+        self.assertIsNone(variable_cache.load().name)
+        self.assertIsNone(variable_cache.id)
+
+    def test_delete_labels(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        variable_cache.save()
+        label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection)
+        # a label of the index pointing to another entity is kept
+        other_label_key = 'other_label_key'
+        redis_connection.hset(other_label_key, 'id', 'other_hash_key')
+        redis_connection.sadd(variable_cache.label_index_key, other_label_key)
+        self.assertTrue(redis_connection.exists(label_cache.hash_key))
+        # the hash, the fingerprints and the label index, the variable has no indexes
+        self.assertEqual(variable_cache.delete(), 3)
+        self.assertFalse(redis_connection.exists(label_cache.hash_key, variable_cache.label_index_key))
+        self.assertTrue(redis_connection.exists(other_label_key))
+        self.assertIsNone(label_cache.name)
+
+    def test_record_fields(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        variable_cache.save()
+        # hash fields that are not identifiers or that are named as the methods of the record
+        for field in ('last-value', 'get', 'as_dict'):
+            redis_connection.hset(variable_cache.hash_key, field, variable_cache.encode_attribute(field))
+        variable_cache = utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection).load()
+        self.assertEqual(variable_cache.name, self.variable.name)
+        for field in ('last-value', 'get', 'as_dict'):
+            self.assertEqual(variable_cache.record.get(field), field)
+            self.assertEqual(variable_cache.record.as_dict()[field], field)
+
+    def test_save_many(self):
+        variables = []
+        for index in range(25):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.device
+            variables.append(variable)
+        written = utils_global_cache.Variable.save_many(
+            variables, connection=redis_connection, chunk_size=10)
+        self.assertEqual(written, 50)
+        written = utils_global_cache.Entity.save_many(
+            [utils_global_cache.Device(self.device, connection=redis_connection)],
+            connection=redis_connection)
+        self.assertEqual(written, 2)
+        for variable in variables:
+            variable_cache = utils_global_cache.Variable(
+                primary_key=variable.id, connection=redis_connection)
+            self.assertEqual(variable_cache.label, variable.label)
+            variable_by_label_cache = utils_global_cache.VariableByLabel(
+                variable=variable, connection=redis_connection)
+            self.assertEqual(variable_by_label_cache.id, variable.id)
+        device_by_label_cache = utils_global_cache.DeviceByLabel(
+            device=self.device, connection=redis_connection)
+        self.assertEqual(device_by_label_cache.name, self.device.name)
+        self.assertEqual(utils_global_cache.User.save_many(
+            [self.user], connection=redis_connection, include_labels=False), 1)
+        self.assertEqual(utils_global_cache.User(
+            primary_key=self.user.id, connection=redis_connection).email, self.user.email)
+
+    def test_get_many(self):
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        utils_global_cache.User(self.user, connection=redis_connection).save()
+        primary_keys = [self.variable.id, 'missing']
+        data = utils_global_cache.Variable.get_many(primary_keys, connection=redis_connection,
+                                                    chunk_size=1)
+        self.assertEqual(set(data), set(primary_keys))
+        self.assertIsNone(data['missing'])
+        self.assertEqual(data[self.variable.id],
+                         utils_global_cache.Variable(
+                             self.variable, connection=redis_connection).get_all_attributes())
+        data = utils_global_cache.Variable.get_many(
+            primary_keys, attributes=['name', 'unknown'], connection=redis_connection)
+        self.assertIsNone(data['missing'])
+        self.assertEqual(list(data[self.variable.id]), ['name'])
+        self.assertEqual(data[self.variable.id]['name']['value'], self.variable.name)
+        data = utils_global_cache.User.get_many([self.user.id], connection=redis_connection)
+        self.assertEqual(data[self.user.id]['email']['value'], self.user.email)
+
+    def test_resolve_many(self):
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        utils_global_cache.VariableByLabel(variable=self.variable, connection=redis_connection).save()
+        utils_global_cache.DeviceByLabel(device=self.device, connection=redis_connection).save()
+        label_key = '{0}:{1}:{2}'.format(self.device.owner_id, self.device.label, self.variable.label)
+        label_keys = [label_key, '{0}:{1}:unknown'.format(self.device.owner_id, self.device.label)]
+        data = utils_global_cache.VariableByLabel.resolve_many(label_keys, connection=redis_connection)
+        self.assertEqual(data, {
+            label_keys[0]: utils_global_cache.Variable(
+                self.variable, connection=redis_connection).get_all_attributes(),
+            label_keys[1]: None})
+        data = utils_global_cache.VariableByLabel.resolve_many(
+            label_keys, attributes=['unit', 'label'], connection=redis_connection, chunk_size=1)
+        self.assertIsNone(data[label_keys[1]])
+        self.assertEqual({key: value['value'] for key, value in data[label_key].items()},
+                         {'unit': self.variable.unit, 'label': self.variable.label})
+        # the device label exists but the device hash was never saved
+        data = utils_global_cache.DeviceByLabel.resolve_many(
+            ['{0}:{1}'.format(self.device.owner_id, self.device.label)], connection=redis_connection)
+        self.assertEqual(list(data.values()), [None])
+
+    def test_get_attributes_nested(self):
+        utils_global_cache.Device(self.device, connection=redis_connection).save(include_labels=False)
+        device_by_label_cache = utils_global_cache.DeviceByLabel(
+            device=self.device, connection=redis_connection)
+        names = ['name', 'context', 'missing']
+        self.assertEqual(device_by_label_cache.get_attributes_nested('id', names),
+                         {'name': None, 'context': None, 'missing': None})
+        device_by_label_cache.save()
+        self.assertEqual(device_by_label_cache.get_attributes_nested('id', names),
+                         {'name': self.device.name, 'context': self.device.context, 'missing': None})
+        device_by_label_cache.fetch('name', 'label')
+        redis_connection.delete(utils_global_cache.Device(self.device).hash_key)
+        self.assertEqual(device_by_label_cache.name, self.device.name)
+        self.assertEqual(device_by_label_cache.label, self.device.label)
+        self.assertIsNone(device_by_label_cache.context)
+
+    def test_codecs(self):
+        codecs = [utils_global_cache.default_codec, utils_codec.CompressedCodec(threshold=16)]
+        if utils_codec.msgpack is not None:
+            codecs.append(utils_codec.MsgpackCodec())
+        for codec in codecs:
+            redis_connection.flushdb()
+            variable_cache = utils_global_cache.Variable(
+                self.variable, connection=redis_connection, codec=codec)
+            variable_cache.save()
+            utils_global_cache.VariableByLabel(
+                variable=self.variable, connection=redis_connection).save()
+            variable_by_label_cache = utils_global_cache.VariableByLabel(
+                variable=self.variable, connection=redis_connection)
+            data = variable_cache.get_all_attributes()
+            nested_data = variable_by_label_cache.get_all_attributes_nested('id')
+            for attribute in variable_cache.attributes:
+                expected = getattr(self.variable, attribute)
+                self.assertEqual(getattr(variable_cache, attribute), expected)
+                self.assertEqual(getattr(variable_by_label_cache, attribute), expected)
+                self.assertEqual(data[attribute]['value'], expected)
+                self.assertEqual(nested_data[attribute]['value'], expected)
+            variable_cache.save_attribute('name', 'renamed')
+            self.assertEqual(variable_cache.name, 'renamed')
+            self.assertEqual(variable_by_label_cache.get_attributes_nested('id', ['name']),
+                             {'name': 'renamed'})
+        # fields written with the former double JSON encoding are still readable
+        redis_connection.hset(variable_cache.hash_key, 'unit', json.dumps(json.dumps(
+            {'value': 'Feet', 'updated_timestamp': 1})))
+        self.assertEqual(variable_cache.unit, 'Feet')
+
+    def test_local_cache(self):
+        local_cache = utils_local_cache.LocalCache(ttls={'variable': 60})
+        variable_cache = utils_global_cache.Variable(
+            self.variable, connection=redis_connection, local_cache=local_cache)
+        variable_cache.save_many([variable_cache], connection=redis_connection)
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection, local_cache=local_cache)
+        self.assertEqual(variable_cache.name, self.variable.name)
+        self.assertEqual(variable_by_label_cache.unit, self.variable.unit)
+        self.assertEqual(variable_cache.get_attributes(['name', 'unit', 'icon']),
+                         {'name': self.variable.name, 'unit': self.variable.unit,
+                          'icon': self.variable.icon})
+        self.assertEqual(local_cache.stats()['misses'], 3)
+        # remote writes are not seen until the entries are invalidated
+        redis_connection.hset(variable_cache.hash_key, 'name', variable_cache.encode_attribute('remote'))
+        self.assertEqual(variable_cache.name, self.variable.name)
+        self.assertEqual(variable_by_label_cache.name, self.variable.name)
+        self.assertEqual(variable_by_label_cache.unit, self.variable.unit)
+        local_cache.invalidate(variable_cache.hash_key)
+        self.assertEqual(variable_by_label_cache.name, 'remote')
+        variable_cache.save_attribute('name', 'local')
+        self.assertEqual(variable_cache.name, 'local')
+        self.assertEqual(variable_by_label_cache.name, 'local')
+        variable_cache.delete()
+        self.assertIsNone(variable_by_label_cache.name)
+        self.assertIsNone(utils_global_cache.VariableByLabel(
+            primary_key='unknown', connection=redis_connection, local_cache=local_cache).name)
+
+    def test_schema(self):
+        self.assertEqual(utils_global_cache.Variable.entity, 'variable')
+        self.assertEqual(utils_global_cache.VariableByLabel.primary_key_name, 'label')
+        for attribute in utils_global_cache.Variable.attributes:
+            self.assertIsInstance(getattr(utils_global_cache.Variable, attribute), property)
+            self.assertIsInstance(getattr(utils_global_cache.VariableByLabel, attribute), property)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        with self.assertRaises(AttributeError):
+            variable_cache.unknown_attribute = 1
+        variable_cache.save()
+        device_by_label_cache = utils_global_cache.DeviceByLabel(
+            primary_key='{0}:{1}'.format(self.device.owner_id, self.device.label),
+            connection=redis_connection)
+        self.assertEqual(device_by_label_cache.hash_key, utils_global_cache.DeviceByLabel(
+            device=self.device, connection=redis_connection).hash_key)
+        variable_cache.load()
+        self.assertEqual(variable_cache.name, self.variable.name)
+        # the cached hash key follows the key attributes
+        hash_key = variable_cache.hash_key
+        variable_cache.primary_key = 'other'
+        self.assertEqual(variable_cache.hash_key, 'INDUSTRIAL:variable:id:other')
+        variable_cache.hash_tags = True
+        self.assertEqual(variable_cache.hash_key, 'INDUSTRIAL:variable:id:{other}')
+        variable_cache.primary_key, variable_cache.hash_tags = self.variable.id, False
+        self.assertEqual(variable_cache.hash_key, hash_key)
+        # the mappers are built per class, instances can still override them
+        self.assertEqual([name for name, mapper in utils_global_cache.Variable.mappers],
+                         utils_global_cache.Variable.attributes)
+        projected = utils_global_cache.Variable(
+            self.variable, attributes=['name', 'unit'],
+            attributes_mapper={'name': lambda variable, value: value.upper()})
+        self.assertEqual(projected.attribute_values(), [('name', 'VARIABLE_NAME'), ('unit', 'Meters')])
+        # class level options can still be configured
+        utils_global_cache.Variable.connection = redis_connection
+        try:
+            self.assertEqual(utils_global_cache.Variable(primary_key=self.variable.id).name,
+                             self.variable.name)
+        finally:
+            utils_global_cache.Variable.connection = None
+
+    def test_save_with_labels(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        variable_cache.save()
+        old_label_key = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).hash_key
+        self.assertEqual(utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).name, self.variable.name)
+        self.variable.label = 'renamed'
+        renamed_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        labels = renamed_cache.label_entities()
+        script, keys, args = renamed_cache.save_call(labels=labels)
+        applied, moved = script(redis_connection, keys=keys, args=args)
+        self.assertEqual([utils_global_cache.decode_binary_string(key) for key in moved],
+                         [old_label_key])
+        self.assertTrue(all(renamed_cache.saved(labels, [applied, moved]).values()))
+        self.assertFalse(redis_connection.exists(old_label_key))
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection)
+        self.assertEqual(variable_by_label_cache.label, 'renamed')
+        self.assertEqual(redis_connection.smembers(variable_cache.label_index_key),
+                         {variable_by_label_cache.hash_key.encode('utf-8')})
+        # a label taken over by another entity is not deleted
+        other = factories.create_variable()
+        other.id = 'e' * 24
+        other.datasource = self.device
+        other.label = 'renamed'
+        utils_global_cache.Variable(other, connection=redis_connection).save()
+        self.variable.label = 'again'
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        self.assertEqual(variable_by_label_cache.id, other.id)
+        device_cache = utils_global_cache.Device(self.device, connection=redis_connection)
+        device_cache.save()
+        self.assertEqual(utils_global_cache.DeviceByLabel(
+            device=self.device, connection=redis_connection).name, self.device.name)
+
+    def test_touch(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        device_cache = utils_global_cache.Device(self.device, connection=redis_connection)
+        now = utils_global_cache.utc_now_milliseconds()
+        self.assertEqual(variable_cache.touch({'value': 1.0}, now - 60000), {})
+        self.assertFalse(redis_connection.exists(variable_cache.hash_key))
+        self.variable.device_id = self.device.id
+        variable_cache.save()
+        device_cache.save()
+        # the hot fields are saved with their datapoint timestamp, not with the time of the save
+        self.assertEqual(variable_cache.touch({'value': 2.0}, now - 60000),
+                         {'last_value': True, 'last_activity': True, 'device_last_activity': True})
+        self.assertEqual(variable_cache.last_value, {'value': 2.0})
+        self.assertEqual(variable_cache.last_activity, now - 60000)
+        self.assertEqual(device_cache.last_activity, now - 60000)
+        self.assertEqual(variable_cache.name, self.variable.name)
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection)
+        self.assertTrue(all(variable_by_label_cache.touch({'value': 3.0}, now).values()))
+        self.assertEqual(variable_cache.get_all_attributes()['last_value'],
+                         {'value': {'value': 3.0}, 'updated_timestamp': now})
+        self.assertEqual(device_cache.last_activity, now)
+        updates = [(variable_cache, {'value': 4.0}, now + 100),
+                   (variable_by_label_cache, {'value': 5.0}, now + 200),
+                   (utils_global_cache.Variable(primary_key='missing'), {'value': 6.0}, now + 300)]
+        self.assertEqual(utils_global_cache.Variable.touch_many(updates, connection=redis_connection), 2)
+        self.assertEqual(variable_cache.last_value, {'value': 5.0})
+        self.assertEqual(device_cache.last_activity, now + 200)
+        # older datapoints don't overwrite the newer ones
+        self.assertEqual(variable_cache.touch({'value': 0.0}, now),
+                         {'last_value': False, 'last_activity': False, 'device_last_activity': False})
+        self.assertEqual(variable_cache.last_value, {'value': 5.0})
+        self.assertEqual(device_cache.last_activity, now + 200)
+        self.assertEqual(utils_global_cache.Variable.touch_many(
+            updates[:1], connection=redis_connection), 0)
+        # a save followed by an older touch keeps the saved datapoint
+        self.variable.last_value, self.variable.last_activity = {'value': 7.0}, now + 60000
+        self.device.last_activity = now + 60000
+        variable_cache.save()
+        device_cache.save()
+        self.assertEqual(variable_cache.touch({'value': 8.0}, now + 1000),
+                         {'last_value': False, 'last_activity': False, 'device_last_activity': False})
+        self.assertEqual(variable_cache.last_value, {'value': 7.0})
+        self.assertEqual(variable_cache.last_activity, now + 60000)
+        self.assertEqual(device_cache.last_activity, now + 60000)
+        # and a save of an older datapoint doesn't hide a newer touch
+        self.assertTrue(all(variable_cache.touch({'value': 9.0}, now + 120000).values()))
+        self.assertFalse(variable_cache.save()['last_value'])
+        self.assertEqual(variable_cache.last_value, {'value': 9.0})
+        # the scripts can't decompress the device_id, it must be given
+        compressed_cache = utils_global_cache.Variable(
+            self.variable, connection=redis_connection, codec=utils_codec.CompressedCodec(threshold=0))
+        self.assertRaises(ValueError, compressed_cache.touch, {'value': 10.0}, now + 180000)
+        compressed_cache.save()
+        self.assertRaises(ResponseError, variable_cache.touch, {'value': 10.0}, now + 180000)
+        self.assertEqual(variable_cache.last_value, {'value': 9.0})
+        applied = compressed_cache.touch({'value': 10.0}, now + 180000, self.device.id)
+        self.assertTrue(all(applied.values()))
+        self.assertEqual(device_cache.last_activity, now + 180000)
+
+    def test_last_writer_wins(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        now = utils_global_cache.utc_now_milliseconds()
+        self.assertTrue(variable_cache.save_attribute('name', 'newer', now + 1000))
+        self.assertFalse(variable_cache.save_attribute('name', 'older', now + 500))
+        self.assertEqual(variable_cache.name, 'newer')
+        applied = variable_cache.save()
+        self.assertFalse(applied['name'])
+        self.assertTrue(applied['unit'])
+        self.assertEqual(variable_cache.name, 'newer')
+        self.assertEqual(variable_cache.unit, self.variable.unit)
+        # fields written twice encoded or without timestamp are compared too
+        redis_connection.hset(variable_cache.hash_key, 'icon', json.dumps(json.dumps(
+            {'value': 'old', 'updated_timestamp': now + 1000})))
+        self.assertFalse(variable_cache.save_attribute('icon', 'new', now))
+        self.assertTrue(variable_cache.save_attribute('icon', 'new', now + 1000))
+        redis_connection.hset(variable_cache.hash_key, 'state', json.dumps({'value': 0}))
+        self.assertTrue(variable_cache.save_attribute('state', 2, now))
+        compressed_cache = utils_global_cache.Variable(
+            self.variable, connection=redis_connection, codec=utils_codec.CompressedCodec(threshold=0))
+        self.assertFalse(compressed_cache.save_attribute('state', 3, now - 1))
+        self.assertTrue(compressed_cache.save_attribute('state', 3, now + 1))
+        self.assertFalse(variable_cache.save_attribute('state', 4, now))
+        self.assertEqual(variable_cache.state, 3)
+
+    def test_save_delta(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        report = variable_cache.save_delta()
+        self.assertEqual(report['skipped'], [])
+        self.assertTrue(all(report['applied'].values()))
+        self.assertEqual(utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).name, self.variable.name)
+        report = variable_cache.save_delta()
+        self.assertEqual(report['written'], [])
+        self.assertGreater(report['bytes_saved'], 0)
+        self.variable.name = 'changed'
+        self.assertEqual(variable_cache.save_delta()['written'], ['name'])
+        self.assertEqual(variable_cache.name, 'changed')
+        # attributes written by other paths are saved again
+        variable_cache.save_attribute('unit', 'Feet')
+        self.assertEqual(variable_cache.save_delta()['written'], ['unit'])
+        self.assertEqual(variable_cache.unit, self.variable.unit)
+        # renamed labels are moved
+        old_label_key = utils_global_cache.VariableByLabel(variable=self.variable).hash_key
+        self.variable.label = 'renamed'
+        self.assertEqual(variable_cache.save_delta()['written'], ['label'])
+        self.assertFalse(redis_connection.exists(old_label_key))
+        self.assertEqual(utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).label, 'renamed')
+        other = factories.create_variable()
+        other.id = 'e' * 24
+        other.datasource = self.device
+        totals = utils_global_cache.Variable.save_many_delta(
+            [self.variable, other], connection=redis_connection, chunk_size=1)
+        self.assertEqual(totals['entities'], 2)
+        self.assertEqual(totals['written'], len(variable_cache.attributes))
+        self.assertEqual(totals['skipped'], len(variable_cache.attributes))
+        variable_cache.delete()
+        self.assertFalse(redis_connection.exists(variable_cache.fingerprint_key))
+        self.assertEqual(variable_cache.save_delta()['skipped'], [])
+
+    def test_iter_all(self):
+        variables = []
+        for index in range(12):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.device
+            variables.append(variable)
+        utils_global_cache.Variable.save_many(variables, connection=redis_connection)
+        utils_global_cache.Device(self.device, connection=redis_connection).save()
+        utils_global_cache.Variable(primary_key='other', deployment='OTHER',
+                                    connection=redis_connection).save()
+        entities = list(utils_global_cache.Entity.iter_all(
+            entity='variable', connection=redis_connection, batch_size=5, scan_count=3))
+        self.assertTrue(all(isinstance(entity, utils_global_cache.Variable) for entity in entities))
+        self.assertEqual({entity.primary_key: entity.label for entity in entities},
+                         {variable.id: variable.label for variable in variables})
+        devices = list(utils_global_cache.Device.iter_all(connection=redis_connection))
+        self.assertEqual([device.name for device in devices], [self.device.name])
+        self.assertEqual(len(list(utils_global_cache.Variable.iter_all(
+            deployment='OTHER', connection=redis_connection))), 1)
+
+    def test_hash_tags(self):
+        utils_global_cache.Entity.hash_tags = True
+        self.addCleanup(setattr, utils_global_cache.Entity, 'hash_tags', False)
+        connection = utils_redis.SingleSlotConnection(redis_connection)
+        self.variable.device_id = self.device.id
+        variable_cache = utils_global_cache.Variable(self.variable, connection=connection)
+        device_cache = utils_global_cache.Device(self.device, connection=connection)
+        self.assertEqual(variable_cache.hash_key,
+                         'INDUSTRIAL:variable:id:{{{0}}}'.format(self.variable.id))
+        self.assertTrue(all(variable_cache.save().values()))
+        device_cache.save()
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=connection)
+        self.assertTrue(variable_by_label_cache.hash_tags)
+        self.assertEqual(redis_connection.hget(variable_by_label_cache.hash_key, 'id').decode(),
+                         variable_cache.hash_key)
+        self.assertEqual(variable_by_label_cache.name, self.variable.name)
+        self.assertEqual(variable_by_label_cache.get_attributes_nested('id', ['name', 'unit']),
+                         {'name': self.variable.name, 'unit': self.variable.unit})
+        self.assertEqual(variable_by_label_cache.get_all_attributes_nested('id')['label']['value'],
+                         self.variable.label)
+        self.assertEqual(variable_by_label_cache.get_attribute_nested_with_age('id', 'name')[0],
+                         self.variable.name)
+        resolved = utils_global_cache.VariableByLabel.resolve_many(
+            [variable_by_label_cache.primary_key, 'missing'], connection=connection)
+        self.assertEqual(resolved[variable_by_label_cache.primary_key]['name']['value'],
+                         self.variable.name)
+        self.assertIsNone(resolved['missing'])
+        # renamed labels are deleted
+        old_label_key = variable_by_label_cache.hash_key
+        self.variable.label = 'renamed'
+        variable_cache.save()
+        self.assertFalse(redis_connection.exists(old_label_key))
+        self.assertEqual(utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=connection).label, 'renamed')
+        # touch through the variable and its label
+        now = utils_global_cache.utc_now_milliseconds()
+        self.assertEqual(variable_cache.touch({'value': 1.0}, now - 60000),
+                         {'last_value': True, 'last_activity': True, 'device_last_activity': True})
+        self.assertEqual(variable_cache.last_value, {'value': 1.0})
+        self.assertEqual(device_cache.last_activity, now - 60000)
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=connection)
+        self.assertTrue(all(variable_by_label_cache.touch({'value': 2.0}, now + 100).values()))
+        self.assertEqual(device_cache.last_activity, now + 100)
+        self.assertEqual(variable_cache.touch({'value': 0.0}, now),
+                         {'last_value': False, 'last_activity': False, 'device_last_activity': False})
+        updates = [(variable_cache, {'value': 3.0}, now + 200),
+                   (utils_global_cache.Variable(primary_key='missing'), {'value': 4.0}, now + 300)]
+        self.assertEqual(utils_global_cache.Variable.touch_many(updates, connection=connection), 1)
+        self.assertEqual(variable_cache.last_value, {'value': 3.0})
+        # bulk and delta saves
+        other = factories.create_variable()
+        other.id = 'e' * 24
+        other.datasource = self.device
+        self.assertEqual(utils_global_cache.Variable.save_many([other], connection=connection), 2)
+        other_cache = utils_global_cache.Variable(other, connection=connection)
+        self.assertEqual(other_cache.save_delta()['skipped'], [])
+        self.assertEqual(other_cache.save_delta()['written'], [])
+        other.label = 'other_renamed'
+        self.assertEqual(other_cache.save_delta()['written'], ['label'])
+        self.assertEqual(utils_global_cache.VariableByLabel(variable=other, connection=connection).name,
+                         other.name)
+        entities = list(utils_global_cache.Variable.iter_all(connection=connection))
+        self.assertEqual({entity.primary_key for entity in entities}, {self.variable.id, other.id})
+        self.assertTrue(all(entity.hash_tags for entity in entities))
+        # the labels are deleted with their entity
+        label_key = utils_global_cache.VariableByLabel(variable=other, connection=connection).hash_key
+        other_cache.delete()
+        self.assertFalse(redis_connection.exists(label_key, other_cache.label_index_key))
+
+    def test_indexes(self):
+        now = utils_global_cache.utc_now_milliseconds()
+        variables = []
+        for index, tags in enumerate([['a', 'b'], ['b', 'c'], ['c'], []]):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.tags = tags
+            variable.datasource = self.device
+            variables.append(variable)
+        variables[3].device_id = 'other'
+        utils_global_cache.Variable.save_many(variables, connection=redis_connection)
+        utils_global_cache.Device(self.device, connection=redis_connection).save()
+        ids = [variable.id for variable in variables]
+        find = utils_global_cache.Variable.find_by_tags
+        self.assertEqual(find(all_of=['b'], connection=redis_connection), {ids[0], ids[1]})
+        self.assertEqual(find(any_of=['a', 'c'], connection=redis_connection), {ids[0], ids[1], ids[2]})
+        self.assertEqual(find(all_of=['c'], any_of=['a', 'b'], connection=redis_connection), {ids[1]})
+        self.assertEqual(find(connection=redis_connection), set())
+        self.assertEqual(utils_global_cache.Device.find_by_tags(
+            all_of=['abab'], connection=redis_connection), {self.device.id})
+        device_cache = utils_global_cache.Device(self.device, connection=redis_connection)
+        hydrated = device_cache.get_variables()
+        self.assertEqual([variable.primary_key for variable in hydrated], ids[:3])
+        self.assertEqual([variable.label for variable in hydrated], [v.label for v in variables[:3]])
+        self.assertEqual([variable.name for variable in find(any_of=['c'], connection=redis_connection,
+                                                               hydrate=True)], [variables[1].name] * 2)
+        # tag changes, delta saves, single attribute saves and deletes keep the indexes consistent
+        variables[0].tags = ['c']
+        utils_global_cache.Variable(variables[0], connection=redis_connection).save()
+        self.assertEqual(find(all_of=['a'], connection=redis_connection), set())
+        self.assertEqual(find(all_of=['c'], connection=redis_connection), {ids[0], ids[1], ids[2]})
+        # the first delta save writes every attribute with its fingerprint
+        utils_global_cache.Variable(variables[1], connection=redis_connection).save_delta()
+        variables[1].tags = ['d']
+        variable_cache = utils_global_cache.Variable(variables[1], connection=redis_connection)
+        self.assertEqual(variable_cache.save_delta()['written'], ['tags'])
+        self.assertEqual(find(any_of=['b', 'd'], connection=redis_connection), {ids[1]})
+        variable_cache = utils_global_cache.Variable(variables[2], connection=redis_connection)
+        self.assertTrue(variable_cache.save_attribute('tags', ['e'], now + 1000))
+        self.assertFalse(variable_cache.save_attribute('tags', ['f'], now + 500))
+        self.assertEqual(find(any_of=['c', 'e', 'f'], connection=redis_connection), {ids[0], ids[2]})
+        self.assertTrue(variable_cache.save_attribute('device_id', 'other'))
+        self.assertEqual(device_cache.get_variables(hydrate=False), ids[:2])
+        variable_cache.delete()
+        self.assertEqual(find(any_of=['e'], connection=redis_connection), set())
+        other_device = utils_global_cache.Device(primary_key='other', connection=redis_connection)
+        self.assertEqual(other_device.get_variables(hydrate=False), [ids[3]])
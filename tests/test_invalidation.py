@@ -0,0 +1,73 @@
+import unittest
+from time import sleep, monotonic
+from tests import factories, settings
+from tests.factories import get_redis_connection
+from global_cache import utils_global_cache
+from global_cache import utils_invalidation
+from global_cache import utils_local_cache
+
+redis_connection = get_redis_connection()
+connection_kwargs = {'db': settings.EVENTS_REDIS_DATABASE_DB,
+                     'host': settings.EVENTS_REDIS_DATABASE_HOST,
+                     'port': settings.EVENTS_REDIS_DATABASE_PORT,
+                     'password': settings.EVENTS_REDIS_DATABASE_PASSWORD}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        sleep(0.01)
+    return condition()
+
+
+class TestTrackingInvalidator(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.local_cache = utils_local_cache.LocalCache()
+        self.invalidator = utils_invalidation.TrackingInvalidator(
+            self.local_cache, utils_invalidation.entity_prefixes(['variable', 'device']),
+            health_check_interval=0.05, reconnect_interval=0.05, **connection_kwargs)
+
+    def tearDown(self):
+        self.invalidator.stop(timeout=5)
+        redis_connection.flushdb()
+
+    def test_entity_prefixes(self):
+        self.assertEqual(utils_invalidation.entity_prefixes(['variable'], deployment='X'),
+                         ['X:variable:'])
+
+    def test_handle_invalidation(self):
+        self.local_cache.set('a', 'name', b'1')
+        self.local_cache.set('b', 'name', b'2')
+        self.local_cache.set('c', 'name', b'3')
+        self.invalidator.handle_invalidation([b'a', 'b'])
+        self.assertIs(self.local_cache.get('a', 'name'), utils_local_cache.missing)
+        self.assertIs(self.local_cache.get('b', 'name'), utils_local_cache.missing)
+        self.assertEqual(self.local_cache.get('c', 'name'), b'3')
+        self.invalidator.handle_invalidation(None)
+        self.assertIs(self.local_cache.get('c', 'name'), utils_local_cache.missing)
+
+    def test_version(self):
+        version = self.local_cache.version
+        self.invalidator.handle_invalidation([b'a'])
+        self.local_cache.set('a', 'name', b'stale', version=version)
+        self.assertIs(self.local_cache.get('a', 'name'), utils_local_cache.missing)
+
+    def test_tracking(self):
+        self.invalidator.start()
+        if not self.invalidator.wait_connected(timeout=2):
+            self.assertFalse(self.local_cache.enabled)
+            self.skipTest('client tracking is not available: {0}'.format(self.invalidator.last_error))
+        variable = factories.create_variable()
+        variable_cache = utils_global_cache.Variable(
+            variable, connection=redis_connection, local_cache=self.local_cache)
+        variable_cache.save()
+        self.assertEqual(variable_cache.name, variable.name)
+        self.assertEqual(self.local_cache.stats()['entries'], 1)
+        redis_connection.hset(variable_cache.hash_key, 'name', variable_cache.encode_attribute('remote'))
+        self.assertTrue(wait_for(lambda: variable_cache.name == 'remote'))
+        # a lost tracking connection disables the local cache until tracking is restored
+        redis_connection.client_kill_filter(_type='pubsub')
+        self.assertTrue(wait_for(lambda: self.invalidator.reconnections > 0))
+        self.assertTrue(self.invalidator.wait_connected(timeout=5))
+        self.assertEqual(self.local_cache.stats()['entries'], 0)
@@ -0,0 +1,118 @@
+import threading
+import time
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from global_cache import utils_global_cache
+from global_cache import utils_loader
+from global_cache import utils_retention
+
+redis_connection = get_redis_connection()
+
+
+class TestReadThroughLoader(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.variable = factories.create_variable()
+        self.calls = []
+
+    def tearDown(self):
+        utils_global_cache.Variable.loader = None
+        redis_connection.flushdb()
+
+    def load_variable(self, primary_key):
+        self.calls.append(primary_key)
+        time.sleep(0.2)
+        return {True: self.variable, False: None}.get(primary_key == self.variable.id)
+
+    def run_concurrently(self, function, threads=8):
+        results = []
+        workers = [threading.Thread(target=lambda index=index: results.append(function(index)))
+                   for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def test_single_flight(self):
+        loader = utils_loader.ReadThroughLoader(self.load_variable)
+        utils_global_cache.Variable.loader = loader
+        results = self.run_concurrently(lambda index: utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection).name)
+        self.assertEqual(results, [self.variable.name] * 8)
+        self.assertEqual(self.calls, [self.variable.id])
+        self.assertEqual(utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection).get_attributes(['unit']),
+            {'unit': self.variable.unit})
+        self.assertEqual(self.calls, [self.variable.id])
+        self.assertIsNone(utils_global_cache.Variable(
+            primary_key='missing', connection=redis_connection).name)
+        self.assertEqual(self.calls, [self.variable.id, 'missing'])
+
+    def test_redis_lock(self):
+        # every loader stands for a different process
+        loaders = [utils_loader.ReadThroughLoader(self.load_variable, lock_timeout=2000,
+                                                  poll_interval=0.01)
+                   for _ in range(4)]
+        results = self.run_concurrently(lambda index: loaders[index % len(loaders)].load(
+            utils_global_cache.Variable(primary_key=self.variable.id, connection=redis_connection)))
+        # the processes that didn't load the variable read it from redis
+        self.assertEqual(len([values for values in results if values is not None]), 2)
+        self.assertEqual(sum(loader.loads for loader in loaders), 1)
+        self.assertEqual(self.calls, [self.variable.id])
+        self.assertFalse(redis_connection.exists(loaders[0].lock_key(
+            utils_global_cache.Variable(primary_key=self.variable.id))))
+        self.assertEqual(utils_global_cache.Variable(
+            primary_key=self.variable.id, connection=redis_connection).load().label, self.variable.label)
+
+    def test_entity_options(self):
+        utils_global_cache.Variable.loader = utils_loader.ReadThroughLoader(self.load_variable)
+        retention = utils_retention.RetentionPolicy(ttl=3600)
+        variable_cache = utils_global_cache.Variable(primary_key=self.variable.id,
+                                                     connection=redis_connection,
+                                                     hash_tags=True, retention=retention)
+        self.assertEqual(variable_cache.name, self.variable.name)
+        # the loaded entity is saved at the key of the entity read, with its retention
+        self.assertGreater(redis_connection.pttl(variable_cache.hash_key), 0)
+        untagged_key = utils_global_cache.Variable(primary_key=self.variable.id).hash_key
+        self.assertFalse(redis_connection.exists(untagged_key))
+        self.assertEqual(variable_cache.get_attributes(['unit']), {'unit': self.variable.unit})
+        self.assertEqual(self.calls, [self.variable.id])
+
+    def test_max_age(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        now = utils_global_cache.utc_now_milliseconds()
+        variable_cache.save_attribute('name', 'old name', now - 10000)
+        value, age = variable_cache.get_attribute_with_age('name')
+        self.assertEqual(value, 'old name')
+        self.assertGreaterEqual(age, 10000)
+        self.assertEqual(variable_cache.get_attribute_with_age('unit'), (None, None))
+        # without loader stale values are returned as they are
+        self.assertEqual(variable_cache.get_attribute_with_age('name', max_age_ms=1000)[0], 'old name')
+        loader = utils_loader.ReadThroughLoader(self.load_variable)
+        utils_global_cache.Variable.loader = loader
+        value, age = variable_cache.get_attribute_with_age(
+            'name', max_age_ms=1000, stale_while_revalidate=False)
+        self.assertEqual((value, age), (self.variable.name, 0))
+        self.assertEqual(self.calls, [self.variable.id])
+        # stale while revalidate, the guarded writes don't store older values
+        self.assertFalse(variable_cache.save_attribute('name', 'old name', now - 10000))
+        redis_connection.hset(variable_cache.hash_key, 'name',
+                              variable_cache.encode_attribute('old name', now - 10000))
+        self.variable.name = 'new name'
+        variable_by_label_cache = utils_global_cache.VariableByLabel(
+            primary_key='owner:device:{0}'.format(self.variable.label), connection=redis_connection)
+        redis_connection.hset(variable_by_label_cache.hash_key, 'id', variable_cache.hash_key)
+        results = self.run_concurrently(
+            lambda index: variable_by_label_cache.get_attribute_nested_with_age('id', 'name',
+                                                                                max_age_ms=1000))
+        self.assertEqual([value for value, age in results], ['old name'] * 8)
+        for _ in range(50):
+            if loader.loads == 2 and not loader.revalidating:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.calls, [self.variable.id] * 2)
+        value, age = variable_by_label_cache.get_attribute_nested_with_age('id', 'name', max_age_ms=1000)
+        self.assertEqual(value, 'new name')
+        self.assertLess(age, 1000)
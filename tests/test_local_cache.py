@@ -0,0 +1,83 @@
+import threading
+import unittest
+from global_cache import utils_local_cache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = utils_local_cache.LocalCache(max_entries=2)
+        cache.set('a', 'name', b'1')
+        cache.set('b', 'name', b'2')
+        self.assertEqual(cache.get('a', 'name'), b'1')
+        cache.set('c', 'name', None)
+        self.assertIs(cache.get('b', 'name'), utils_local_cache.missing)
+        self.assertEqual(cache.get('a', 'name'), b'1')
+        self.assertIsNone(cache.get('c', 'name'))
+        self.assertEqual(cache.stats(),
+                         {'entries': 2, 'bytes': 11, 'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_max_bytes(self):
+        cache = utils_local_cache.LocalCache(max_entries=None, max_bytes=20)
+        cache.set('a', 'f', b'x' * 8)
+        cache.set('b', 'f', b'x' * 8)
+        self.assertEqual(cache.stats()['entries'], 2)
+        cache.set('c', 'f', b'x' * 8)
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['bytes'], 20)
+        self.assertIs(cache.get('a', 'f'), utils_local_cache.missing)
+        cache.set('d', 'f', b'x' * 30)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = utils_local_cache.LocalCache(default_ttl=10, ttls={'variable': 1}, clock=clock)
+        cache.set('device_key', 'name', b'd', 'device')
+        cache.set('variable_key', 'name', b'v', 'variable')
+        clock.now = 2
+        self.assertIs(cache.get('variable_key', 'name'), utils_local_cache.missing)
+        self.assertEqual(cache.get('device_key', 'name'), b'd')
+        clock.now = 11
+        self.assertIs(cache.get('device_key', 'name'), utils_local_cache.missing)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_invalidate(self):
+        cache = utils_local_cache.LocalCache()
+        cache.set('a', 'name', b'1')
+        cache.set('a', 'unit', b'2')
+        cache.set('b', 'name', b'3')
+        cache.invalidate('a')
+        cache.invalidate('unknown')
+        self.assertIs(cache.get('a', 'unit'), utils_local_cache.missing)
+        self.assertEqual(cache.get('b', 'name'), b'3')
+        cache.clear()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_threads(self):
+        cache = utils_local_cache.LocalCache(max_entries=50)
+
+        def work(index):
+            for item in range(500):
+                key = '{0}'.format(item % 80)
+                cache.set(key, 'f', b'v')
+                cache.get(key, 'f')
+                if item % 7 == index:
+                    cache.invalidate(key)
+
+        threads = [threading.Thread(target=work, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertLessEqual(stats['entries'], 50)
+        self.assertEqual(stats['bytes'], sum(entry[2] for entry in cache.entries.values()))
+        self.assertEqual(sum(len(fields) for fields in cache.fields.values()), stats['entries'])
@@ -0,0 +1,84 @@
+import unittest
+from redis import Redis
+from tests.factories import get_redis_connection
+from tests import factories
+from tests import settings
+from global_cache import utils_global_cache
+from global_cache import utils_migration
+
+redis_connection = get_redis_connection()
+# stands for the cluster the keys are migrated to
+target_connection = Redis(db=settings.REDIS_DATABASE_DB + 2, host=settings.REDIS_DATABASE_HOST,
+                          port=settings.REDIS_DATABASE_PORT, password=settings.REDIS_DATABASE_PASSWORD)
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.device = factories.create_device()
+        self.variables = []
+        for index in range(10):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.device
+            self.variables.append(variable)
+
+    def tearDown(self):
+        redis_connection.flushdb()
+        target_connection.flushdb()
+
+    def test_migrate_keys(self):
+        utils_global_cache.Variable.save_many(self.variables, connection=redis_connection)
+        utils_global_cache.Device(self.device, connection=redis_connection).save()
+        redis_connection.pexpire(utils_global_cache.Variable(self.variables[0]).hash_key, 60000)
+        keys_count = len(redis_connection.keys('*'))
+        # the index sets keep their keys
+        index_keys = set(redis_connection.keys('*:index:*'))
+        self.assertTrue(index_keys)
+        stats = utils_migration.migrate_keys(redis_connection, delete=True, chunk_size=7)
+        self.assertEqual(stats, {'keys': keys_count - len(index_keys), 'skipped': len(index_keys)})
+        self.assertEqual(len(redis_connection.keys('*')), keys_count)
+        self.assertEqual(set(redis_connection.keys('*:index:*')), index_keys)
+        self.assertEqual(utils_migration.migrate_keys(redis_connection),
+                         {'keys': 0, 'skipped': keys_count})
+        utils_global_cache.Entity.hash_tags = True
+        self.addCleanup(setattr, utils_global_cache.Entity, 'hash_tags', False)
+        variable_cache = utils_global_cache.Variable(self.variables[0], connection=redis_connection)
+        self.assertGreater(redis_connection.pttl(variable_cache.hash_key), 0)
+        for variable in self.variables:
+            label_cache = utils_global_cache.VariableByLabel(variable=variable,
+                                                             connection=redis_connection)
+            self.assertEqual(label_cache.label, variable.label)
+        self.assertEqual(utils_global_cache.DeviceByLabel(
+            device=self.device, connection=redis_connection).name, self.device.name)
+        # the label index points to the migrated labels, renames still delete them
+        old_label_key = utils_global_cache.VariableByLabel(variable=self.variables[0]).hash_key
+        self.variables[0].label = 'renamed'
+        variable_cache.save()
+        self.assertFalse(redis_connection.exists(old_label_key))
+
+    def test_migrate_indexes(self):
+        utils_global_cache.Variable.save_many(self.variables, connection=redis_connection)
+        keys_count = len(redis_connection.keys('*'))
+        stats = utils_migration.migrate_keys(redis_connection, target_connection, delete=True)
+        self.assertEqual(stats, {'keys': keys_count, 'skipped': 0})
+        self.assertEqual(redis_connection.keys('*'), [])
+        utils_global_cache.Entity.hash_tags = True
+        self.addCleanup(setattr, utils_global_cache.Entity, 'hash_tags', False)
+        # the index sets and the index entries are copied
+        self.assertEqual(utils_global_cache.Variable.find_by_tags(
+            all_of=['a'], connection=target_connection), {variable.id for variable in self.variables})
+        device_cache = utils_global_cache.Device(self.device, connection=target_connection)
+        self.assertEqual(device_cache.get_variables(hydrate=False),
+                         sorted(variable.id for variable in self.variables))
+        variable_cache = utils_global_cache.Variable(self.variables[0], connection=target_connection)
+        self.assertTrue(target_connection.exists(variable_cache.index_entries_key))
+        # the label index sets are tagged and point to the tagged labels
+        label_cache = utils_global_cache.VariableByLabel(variable=self.variables[0],
+                                                         connection=target_connection)
+        self.assertEqual(target_connection.smembers(variable_cache.label_index_key),
+                         {label_cache.hash_key.encode()})
+        self.assertEqual(label_cache.name, self.variables[0].name)
+        variable_cache.delete()
+        self.assertFalse(target_connection.exists(label_cache.hash_key))
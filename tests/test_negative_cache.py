@@ -0,0 +1,130 @@
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from tests import utils_redis
+from global_cache import utils_global_cache
+from global_cache import utils_negative_cache
+
+redis_connection = get_redis_connection()
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.now = [0.0]
+        self.commands = []
+        self.connection = utils_redis.ReplicaConnection(redis_connection, self.commands)
+        self.negative_cache = utils_negative_cache.NegativeCache(ttl=5, clock=lambda: self.now[0])
+        utils_global_cache.EntityByLabel.negative_cache = self.negative_cache
+        self.addCleanup(setattr, utils_global_cache.EntityByLabel, 'negative_cache', None)
+        self.variable = factories.create_variable()
+        self.variable.datasource = factories.create_device()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def test_missing_labels(self):
+        label_cache = utils_global_cache.VariableByLabel(variable=self.variable,
+                                                         connection=self.connection)
+        self.assertEqual(label_cache.get_all_attributes_nested('id'), {})
+        self.assertEqual(label_cache.get_all_attributes_nested('id'), {})
+        self.assertIsNone(label_cache.name)
+        self.assertEqual(label_cache.get_attributes_nested('id', ['name', 'unit']),
+                         {'name': None, 'unit': None})
+        self.assertTrue(label_cache.known_absent())
+        self.assertEqual(self.commands.count('EVALSHA'), 1)
+        resolved = utils_global_cache.VariableByLabel.resolve_many(
+            [label_cache.primary_key, 'other:label'], connection=self.connection)
+        self.assertEqual(resolved, {label_cache.primary_key: None, 'other:label': None})
+        self.assertEqual(self.commands.count('EVALSHA'), 2)
+        self.assertEqual(self.negative_cache.stats()['entries'], 2)
+        # saving the label forgets its absence
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        self.assertFalse(label_cache.known_absent())
+        self.assertEqual(label_cache.name, self.variable.name)
+        # labels created by other processes are read once their entry expires
+        other_label = utils_global_cache.VariableByLabel(primary_key='other:label',
+                                                         connection=redis_connection)
+        other_label.save_attribute('id', utils_global_cache.Variable(self.variable).hash_key)
+        self.negative_cache.add(label_cache.hash_key)
+        self.assertIsNone(label_cache.name)
+        self.now[0] = 5
+        self.assertEqual(label_cache.name, self.variable.name)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.now = [0.0]
+        self.variable = factories.create_variable()
+        self.variable.datasource = factories.create_device()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def test_local_filter(self):
+        label_filter = utils_negative_cache.BloomFilter(capacity=1000, error_rate=0.01)
+        self.assertEqual((label_filter.size, label_filter.hash_count), (9586, 7))
+        keys = ['INDUSTRIAL:variable:label:{0}'.format(index) for index in range(1000)]
+        label_filter.add(*keys)
+        self.assertTrue(all(label_filter.might_contain(key) for key in keys))
+        false_positives = sum(label_filter.might_contain('INDUSTRIAL:variable:label:x{0}'.format(index))
+                              for index in range(1000))
+        self.assertLess(false_positives, 30)
+
+    def test_redis_filter(self):
+        utils_global_cache.Variable(self.variable, connection=redis_connection).save()
+        label_filter = utils_negative_cache.RedisBloomFilter(
+            redis_connection, capacity=1000, error_rate=0.01, clock=lambda: self.now[0])
+        self.assertEqual(utils_negative_cache.fill_label_filter(label_filter, redis_connection), 1)
+        utils_global_cache.EntityByLabel.label_filter = label_filter
+        self.addCleanup(setattr, utils_global_cache.EntityByLabel, 'label_filter', None)
+        label_cache = utils_global_cache.VariableByLabel(variable=self.variable,
+                                                         connection=redis_connection)
+        self.assertFalse(label_cache.known_absent())
+        self.assertEqual(label_cache.name, self.variable.name)
+        missing_label = utils_global_cache.DeviceByLabel(primary_key='owner:missing',
+                                                         connection=redis_connection)
+        self.assertTrue(missing_label.known_absent())
+        self.assertEqual(missing_label.get_all_attributes_nested('id'), {})
+        # labels saved directly are added to the filter too
+        device = self.variable.datasource
+        utils_global_cache.Device(device, connection=redis_connection).save(include_labels=False)
+        device_label = utils_global_cache.DeviceByLabel(device=device, connection=redis_connection)
+        self.assertTrue(device_label.known_absent())
+        device_label.save()
+        self.assertFalse(device_label.known_absent())
+        self.assertEqual(device_label.name, device.name)
+        saved_label = utils_global_cache.DeviceByLabel(primary_key='owner:saved',
+                                                       connection=redis_connection)
+        self.assertTrue(saved_label.known_absent())
+        saved_label.save_attribute('id', utils_global_cache.Device(device).hash_key)
+        self.assertFalse(saved_label.known_absent())
+        other_deployment = utils_global_cache.DeviceByLabel(primary_key='owner:missing',
+                                                            deployment='OTHER')
+        self.assertFalse(other_deployment.known_absent())
+        # labels saved by other processes are seen once the local copy is reloaded
+        other_filter = utils_negative_cache.RedisBloomFilter(redis_connection, capacity=1000,
+                                                             error_rate=0.01)
+        utils_global_cache.EntityByLabel.label_filter = other_filter
+        variables = [factories.create_variable() for _ in range(3)]
+        for index, variable in enumerate(variables):
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = self.variable.datasource
+        utils_global_cache.Variable.save_many(variables, connection=redis_connection)
+        utils_global_cache.EntityByLabel.label_filter = label_filter
+        new_label = utils_global_cache.VariableByLabel(variable=variables[0],
+                                                       connection=redis_connection)
+        self.assertTrue(new_label.known_absent())
+        self.now[0] = 1
+        self.assertFalse(new_label.known_absent())
+        self.assertEqual(new_label.name, variables[0].name)
+        self.assertEqual(label_filter.stats()['refreshes'], 2)
+        label_filter.refresh_interval = 0
+        self.assertFalse(new_label.known_absent())
+        self.assertTrue(missing_label.known_absent())
+
+
+if __name__ == '__main__':
+    unittest.main()
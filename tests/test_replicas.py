@@ -0,0 +1,100 @@
+import unittest
+from redis import Redis
+from tests.factories import get_redis_connection
+from tests import factories
+from tests import settings
+from tests import utils_redis
+from global_cache import utils_global_cache
+from global_cache import utils_replicas
+
+redis_connection = get_redis_connection()
+# stands for a replica lagging behind the primary, it never receives the writes
+replica_connection = Redis(db=settings.REDIS_DATABASE_DB + 1, host=settings.REDIS_DATABASE_HOST,
+                           port=settings.REDIS_DATABASE_PORT, password=settings.REDIS_DATABASE_PASSWORD)
+
+
+class TestReplicaSet(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        replica_connection.flushdb()
+        self.now = [0.0]
+        self.replica = utils_redis.ReplicaConnection(replica_connection)
+        self.replicas = utils_replicas.ReplicaSet([self.replica], read_your_writes=1.0,
+                                                  clock=lambda: self.now[0])
+        self.variable = factories.create_variable()
+        self.variable.datasource = factories.create_device()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+        replica_connection.flushdb()
+
+    def test_read_your_writes(self):
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     replicas=self.replicas)
+        variable_cache.save()
+        # written keys are read from the primary during the window
+        self.assertEqual(variable_cache.name, self.variable.name)
+        label_cache = variable_cache.label_entities()[0]
+        self.assertIs(label_cache.replicas, self.replicas)
+        self.assertEqual(label_cache.name, self.variable.name)
+        self.assertEqual(self.replicas.stats()['replica_reads'], 0)
+        self.now[0] = 1.5
+        self.assertIsNone(variable_cache.name)
+        self.assertIsNone(label_cache.name)
+        self.assertEqual(self.replicas.stats(),
+                         {'primary_reads': 2, 'replica_reads': 2, 'pinned_keys': 0})
+        self.assertEqual(self.replica.commands[0], 'HGET')
+        self.assertEqual(self.replica.commands[-1], 'EVALSHA_RO')
+        # class level replicas serve the bulk reads
+        utils_global_cache.Entity.replicas = self.replicas
+        self.addCleanup(setattr, utils_global_cache.Entity, 'replicas', None)
+        utils_global_cache.Entity.connection = redis_connection
+        self.addCleanup(setattr, utils_global_cache.Entity, 'connection', None)
+        self.assertEqual(utils_global_cache.Variable.get_many([self.variable.id]),
+                         {self.variable.id: None})
+        self.assertEqual(utils_global_cache.VariableByLabel.resolve_many([label_cache.primary_key]),
+                         {label_cache.primary_key: None})
+        variable_cache.save_attribute('name', 'changed')
+        data = utils_global_cache.Variable.get_many([self.variable.id])
+        self.assertEqual(data[self.variable.id]['name']['value'], 'changed')
+
+    def test_label_read_your_writes(self):
+        # the replica holds a copy of the entity and of its label older than the write
+        for connection in (redis_connection, replica_connection):
+            utils_global_cache.Variable(self.variable, connection=connection).save()
+            utils_global_cache.VariableByLabel(variable=self.variable, connection=connection).save()
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     replicas=self.replicas)
+        label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection, replicas=self.replicas)
+        self.assertEqual(label_cache.name, self.variable.name)
+        self.assertEqual(self.replicas.stats()['replica_reads'], 1)
+        # only the key of the variable is written, the label is read from the primary
+        variable_cache.save_attribute('name', 'changed')
+        self.assertEqual(label_cache.name, 'changed')
+        self.assertEqual(label_cache.get_attributes_nested('id', ['name']), {'name': 'changed'})
+        self.assertEqual(label_cache.get_all_attributes_nested('id')['name']['value'], 'changed')
+        utils_global_cache.Entity.replicas = self.replicas
+        self.addCleanup(setattr, utils_global_cache.Entity, 'replicas', None)
+        utils_global_cache.Entity.connection = redis_connection
+        self.addCleanup(setattr, utils_global_cache.Entity, 'connection', None)
+        data = utils_global_cache.VariableByLabel.resolve_many([label_cache.primary_key], ['name'])
+        self.assertEqual(data[label_cache.primary_key]['name']['value'], 'changed')
+        self.assertEqual(self.replicas.stats()['replica_reads'], 1)
+        self.now[0] = 1.5
+        self.assertEqual(label_cache.name, self.variable.name)
+
+    def test_read_only_scripts(self):
+        replicas = utils_replicas.ReplicaSet([self.replica], read_your_writes=0, read_only_scripts=False)
+        replica_cache = utils_global_cache.Variable(self.variable, connection=replica_connection)
+        replica_cache.save()
+        label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection, replicas=replicas)
+        self.assertEqual(label_cache.get_attributes_nested('id', ['name']), {'name': self.variable.name})
+        self.assertEqual(self.replica.commands[-1], 'EVALSHA')
+        replicas = utils_replicas.ReplicaSet([], read_your_writes=1.0)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     replicas=replicas)
+        variable_cache.save()
+        self.assertEqual(variable_cache.name, self.variable.name)
+        self.assertEqual(replicas.stats()['primary_reads'], 1)
@@ -0,0 +1,169 @@
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from tests import utils_redis
+from global_cache import utils_global_cache
+from global_cache import utils_reports
+from global_cache import utils_retention
+
+redis_connection = get_redis_connection()
+day = 86400
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.now = [0.0]
+        self.variable = factories.create_variable()
+        self.variable.datasource = factories.create_device()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def assertTtl(self, key, ttl):
+        self.assertAlmostEqual(redis_connection.pttl(key), ttl * 1000, delta=5000, msg=key)
+
+    def test_saves(self):
+        retention = utils_retention.RetentionPolicy(ttl=day)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     retention=retention)
+        variable_cache.save()
+        label_cache = variable_cache.label_entities()[0]
+        index_key = utils_global_cache.index_key('INDUSTRIAL', 'variable', 'tags', 'a')
+        for key in [variable_cache.hash_key, variable_cache.label_index_key,
+                    variable_cache.index_entries_key, label_cache.hash_key, index_key]:
+            self.assertTtl(key, day)
+        # the index sets shared with other entities only get longer ttls
+        redis_connection.pexpire(index_key, 2 * day * 1000)
+        variable_cache.save_delta()
+        self.assertTtl(index_key, 2 * day)
+        self.assertTtl(variable_cache.fingerprint_key, day)
+        redis_connection.pexpire(variable_cache.hash_key, 1000)
+        self.assertTrue(variable_cache.save_attribute('name', 'new name'))
+        self.assertTtl(variable_cache.hash_key, day)
+        user_cache = utils_global_cache.User(factories.create_user(), connection=redis_connection,
+                                             retention=retention)
+        user_cache.save()
+        self.assertTtl(user_cache.hash_key, day)
+        # without retention the keys don't expire
+        device_cache = utils_global_cache.Device(self.variable.datasource, connection=redis_connection)
+        device_cache.save()
+        self.assertEqual(redis_connection.pttl(device_cache.hash_key), -1)
+        self.assertEqual(redis_connection.pttl(device_cache.label_entities()[0].hash_key), -1)
+
+    def test_index_pruning(self):
+        retention = utils_retention.RetentionPolicy(ttl=day)
+        self.variable.device_id = self.variable.datasource.id
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     retention=retention)
+        variable_cache.save()
+        device_cache = utils_global_cache.Device(self.variable.datasource, connection=redis_connection)
+        find = utils_global_cache.Variable.find_by_tags
+        self.assertEqual(find(all_of=['a'], connection=redis_connection), {self.variable.id})
+        self.assertEqual(device_cache.get_variables(hydrate=False), [self.variable.id])
+        # the members whose hash expired are removed from the shared index sets when read
+        redis_connection.delete(variable_cache.hash_key)
+        self.assertEqual(find(any_of=['a', 'b'], connection=redis_connection), set())
+        tags_keys = [utils_global_cache.index_key('INDUSTRIAL', 'variable', 'tags', tag) for tag in 'bx']
+        self.assertFalse(redis_connection.exists(tags_keys[0]))
+        self.assertTrue(redis_connection.exists(tags_keys[1]))
+        self.assertEqual(device_cache.get_variables(hydrate=False), [])
+        self.assertEqual(find(all_of=['x'], connection=redis_connection), set())
+
+    def test_class_retention(self):
+        utils_global_cache.Variable.retention = utils_retention.RetentionPolicy(ttl=day)
+        self.addCleanup(setattr, utils_global_cache.Variable, 'retention', None)
+        utils_global_cache.Device.retention = utils_retention.RetentionPolicy(ttl=2 * day)
+        self.addCleanup(setattr, utils_global_cache.Device, 'retention', None)
+        utils_global_cache.Variable.save_many([self.variable], connection=redis_connection)
+        utils_global_cache.Device(self.variable.datasource, connection=redis_connection).save()
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection)
+        device_cache = utils_global_cache.Device(self.variable.datasource, connection=redis_connection)
+        label_cache = utils_global_cache.VariableByLabel(variable=self.variable,
+                                                         connection=redis_connection)
+        self.assertEqual(label_cache.retention, utils_global_cache.Variable.retention)
+        self.assertTtl(label_cache.hash_key, day)
+        self.assertTtl(device_cache.hash_key, 2 * day)
+        # the touches extend the ttl of the variable, of its label and of its device
+        for key in [variable_cache.hash_key, label_cache.hash_key, device_cache.hash_key]:
+            redis_connection.pexpire(key, 1000)
+        self.assertTrue(label_cache.touch(12))
+        self.assertTtl(variable_cache.hash_key, day)
+        self.assertTtl(label_cache.hash_key, day)
+        self.assertTtl(device_cache.hash_key, 2 * day)
+
+    def test_hash_tags(self):
+        retention = utils_retention.RetentionPolicy(ttl=day)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     retention=retention, hash_tags=True)
+        variable_cache.save()
+        label_cache = variable_cache.label_entities()[0]
+        for key in [variable_cache.hash_key, variable_cache.label_index_key, label_cache.hash_key]:
+            self.assertTtl(key, day)
+        self.assertEqual(label_cache.name, self.variable.name)
+
+    def test_sliding_expiration(self):
+        retention = utils_retention.RetentionPolicy(ttl=day, sliding=True, refresh_interval=60,
+                                                    clock=lambda: self.now[0])
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     retention=retention)
+        variable_cache.save()
+        label_cache = utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection, retention=retention)
+        for key in [variable_cache.hash_key, label_cache.hash_key]:
+            redis_connection.pexpire(key, 1000)
+        self.assertEqual(variable_cache.name, self.variable.name)
+        self.assertTtl(variable_cache.hash_key, day)
+        redis_connection.pexpire(variable_cache.hash_key, 1000)
+        self.assertEqual(label_cache.unit, self.variable.unit)
+        self.assertTtl(label_cache.hash_key, day)
+        self.assertTtl(variable_cache.hash_key, day)
+        # one extension per refresh interval
+        redis_connection.pexpire(variable_cache.hash_key, 1000)
+        self.assertEqual(variable_cache.get_attributes(['name'])['name'], self.variable.name)
+        self.assertLessEqual(redis_connection.pttl(variable_cache.hash_key), 1000)
+        self.now[0] = 60
+        self.assertEqual(variable_cache.load().name, self.variable.name)
+        self.assertTtl(variable_cache.hash_key, day)
+        self.assertEqual(retention.stats()['refreshes'], 3)
+
+
+class TestMemoryReport(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def test_memory_report(self):
+        device = factories.create_device()
+        variables = []
+        for index in range(20):
+            variable = factories.create_variable()
+            variable.id = '{0:024x}'.format(index)
+            variable.label = 'variable_{0}'.format(index)
+            variable.datasource = device
+            variables.append(variable)
+        utils_global_cache.Variable.save_many(variables[:10], connection=redis_connection)
+        utils_global_cache.Variable.save_many(variables[10:], connection=redis_connection,
+                                              include_labels=False)
+        utils_global_cache.Device(device, connection=redis_connection).save()
+        connection = utils_redis.MemoryUsageConnection(redis_connection)
+        report = utils_reports.memory_report(connection, sample_size=5)
+        self.assertEqual(report[('variable', 'id')]['keys'], 20)
+        self.assertEqual(report[('variable', 'id')]['sampled'], 5)
+        self.assertEqual(report[('variable', 'label')]['keys'], 10)
+        self.assertEqual(report[('device', 'id')]['keys'], 1)
+        self.assertEqual(report[('variable', 'id')]['without_ttl'], 20)
+        row = report[('variable', 'id')]
+        self.assertEqual(row['estimated_bytes'], int(row['mean_bytes'] * 20))
+        self.assertGreater(row['mean_bytes'], 0)
+        totals = utils_reports.entity_totals(report)
+        self.assertEqual(set(totals), {'variable', 'device'})
+        self.assertIn('variable', utils_reports.format_report(report))
+        redis_connection.pexpire(utils_global_cache.Device(device).hash_key, 10000)
+        self.assertEqual(utils_reports.memory_report(connection)[('device', 'id')]['without_ttl'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from tests.factories import get_redis_connection
+from tests import factories
+from global_cache import utils_global_cache
+from global_cache import utils_write_behind
+
+redis_connection = get_redis_connection()
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+    def setUp(self):
+        redis_connection.flushdb()
+        self.variable = factories.create_variable()
+        self.variable.datasource = factories.create_device()
+        self.now = utils_global_cache.utc_now_milliseconds()
+
+    def tearDown(self):
+        redis_connection.flushdb()
+
+    def test_coalescing(self):
+        buffer = utils_write_behind.WriteBehindBuffer(max_pending=1000)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     write_behind=buffer)
+        for index in range(100):
+            self.assertTrue(variable_cache.save_attribute('last_value', index, self.now + index))
+        # an older value arriving late doesn't replace the newest one
+        variable_cache.save_attribute('last_value', -1, self.now)
+        self.assertFalse(redis_connection.exists(variable_cache.hash_key))
+        stats = buffer.stats()
+        self.assertEqual(
+            (stats['pending_fields'], stats['pending_keys'], stats['added'], stats['coalesced']),
+            (1, 1, 101, 100))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(variable_cache.last_value, 99)
+        self.assertEqual(buffer.stats()['pending_fields'], 0)
+        self.assertEqual(buffer.flush(), 0)
+        # saves keep their labels
+        self.assertTrue(all(variable_cache.save().values()))
+        self.assertEqual(buffer.flush(), len(set(variable_cache.attributes)))
+        self.assertEqual(utils_global_cache.VariableByLabel(
+            variable=self.variable, connection=redis_connection).name, self.variable.name)
+        self.assertEqual(variable_cache.last_value, 99)
+
+    def test_triggers(self):
+        buffer = utils_write_behind.WriteBehindBuffer(max_pending=3)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     write_behind=buffer)
+        variable_cache.save_attribute('name', 'a')
+        variable_cache.save_attribute('unit', 'b')
+        self.assertIsNone(variable_cache.name)
+        variable_cache.save_attribute('icon', 'c')
+        self.assertEqual((variable_cache.name, variable_cache.unit, variable_cache.icon),
+                         ('a', 'b', 'c'))
+        self.assertEqual(buffer.stats()['flushes'], 1)
+        buffer = utils_write_behind.WriteBehindBuffer(max_pending=1000, flush_interval=0.01).start()
+        thread = buffer.thread
+        self.assertIs(buffer.start().thread, thread)
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     write_behind=buffer)
+        variable_cache.save_attribute('name', 'd')
+        buffer.stop(timeout=5)
+        self.assertEqual(variable_cache.name, 'd')
+        self.assertIsNotNone(buffer.stats()['last_flush_latency'])
+
+    def test_failed_flush(self):
+        buffer = utils_write_behind.WriteBehindBuffer()
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     write_behind=buffer)
+        variable_cache.save_attribute('name', 'lost', self.now)
+
+        def unreachable_write(writes):
+            raise ConnectionError('redis unreachable')
+        buffer.write = unreachable_write
+        with self.assertRaises(ConnectionError):
+            buffer.flush()
+        self.assertEqual(buffer.stats()['errors'], 1)
+        self.assertEqual(buffer.stats()['pending_fields'], 1)
+        del buffer.write
+        variable_cache.save_attribute('name', 'kept', self.now + 1)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(variable_cache.name, 'kept')
+        # the values buffered during a failed flush are kept, equal timestamps included
+        buffer = utils_write_behind.WriteBehindBuffer()
+        variable_cache = utils_global_cache.Variable(self.variable, connection=redis_connection,
+                                                     write_behind=buffer)
+        variable_cache.save_attribute('name', 'retried', self.now + 2)
+        variable_cache.save_attribute('unit', 'retried', self.now + 2)
+
+        def failing_write(writes):
+            variable_cache.save_attribute('name', 'buffered', self.now + 2)
+            raise ValueError('write failed')
+        buffer.write = failing_write
+        with self.assertRaises(ValueError):
+            buffer.flush()
+        stats = buffer.stats()
+        self.assertEqual((stats['pending_fields'], stats['coalesced']), (2, 0))
+        del buffer.write
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual((variable_cache.name, variable_cache.unit), ('buffered', 'retried'))
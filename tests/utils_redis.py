@@ -1,4 +1,5 @@
 from redis import Redis
+from redis.crc import key_slot
 from tests import settings
 
 
@@ -14,3 +15,88 @@ def get_global_cache_connection():
                  host=settings.GLOBAL_CACHE_REDIS_DATABASE_HOST,
                  port=settings.GLOBAL_CACHE_REDIS_DATABASE_PORT,
                  password=settings.GLOBAL_CACHE_REDIS_DATABASE_PASSWORD)
+
+
+class SingleSlotConnection(object):
+    """
+    Wraps a redis connection asserting that every script call (EVAL, EVALSHA) only
+    accesses keys of one redis cluster slot, as a cluster requires.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute_command(self, *args, **options):
+        if args[0] in ('EVAL', 'EVALSHA'):
+            keys = args[3:3 + int(args[2])]
+            slots = {key_slot(getattr(key, 'encode', lambda c: key)('utf-8')) for key in keys}
+            assert len(slots) <= 1, 'Keys of different cluster slots: {0}'.format(keys)
+        return self.connection.execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        return SingleSlotConnection(self.connection.pipeline(*args, **kwargs))
+
+
+class ReplicaConnection(object):
+    """
+    Wraps the connection of a test replica recording the commands it runs, the read only
+    script commands (redis >= 7) run as EVALSHA and EVAL.
+    """
+
+    def __init__(self, connection, commands=None):
+        self.connection = connection
+        self.commands = [] if commands is None else commands
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute_command(self, *args, **options):
+        self.commands.append(args[0])
+        command = {'EVALSHA_RO': 'EVALSHA', 'EVAL_RO': 'EVAL'}.get(args[0], args[0])
+        return self.connection.execute_command(command, *args[1:], **options)
+
+    def pipeline(self, *args, **kwargs):
+        return ReplicaConnection(self.connection.pipeline(*args, **kwargs), self.commands)
+
+    def hget(self, *args):
+        self.commands.append('HGET')
+        return self.connection.hget(*args)
+
+    def hgetall(self, *args):
+        self.commands.append('HGETALL')
+        return self.connection.hgetall(*args)
+
+
+class MemoryUsageConnection(object):
+    """
+    Wraps a test connection whose server doesn't implement MEMORY USAGE, the memory used by
+    a key is the size of its DUMP payload.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # positions of the MEMORY USAGE commands of a pipeline
+        self.measured = []
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def memory_usage(self, key, samples=None):
+        if hasattr(self.connection, 'command_stack'):
+            self.measured.append(len(self.connection.command_stack))
+            return self.connection.dump(key)
+        payload = self.connection.dump(key)
+        return None if payload is None else len(payload)
+
+    def pipeline(self, *args, **kwargs):
+        return MemoryUsageConnection(self.connection.pipeline(*args, **kwargs))
+
+    def execute(self):
+        results = self.connection.execute()
+        for position in self.measured:
+            results[position] = None if results[position] is None else len(results[position])
+        self.measured = []
+        return results